@@ -66,9 +66,20 @@ LikeLines = {};
 		// Back-end Throttle
 		backendThrottle: 5.0, // 1 request per 5 seconds
 		
+		// POST interactions of all players on the page (sharing a back-end)
+		// in compressed batches when the browser supports CORS, instead of JSONP
+		backendPost: true,
+		backendBatchDelay: 0.5, // seconds to wait for other players' interactions
+		
 		// Back-end read-only flag
 		backendReadOnly: false,
 		
+		// Let the back-end compute the heatmap (see BackendServer.heatmap)
+		serverHeatmap: false,
+		
+		// Fetch playbacks and likes binned per second instead of raw
+		binnedAggregate: false,
+		
 		// Not an option, but an auto-generated property:
 		videoCanonical: undefined
 	};
@@ -391,8 +402,14 @@ LikeLines = {};
 	LikeLines.Player.prototype.updateHeatmap = function () {
 		var self = this;
 		
+		if (this.options.serverHeatmap) {
+			this.updateHeatmapFromServer();
+			return;
+		}
+		
 		var d = this.getDuration();
-		var playback = LikeLines.Util.zeros(d);
+		var binned = this.options.binnedAggregate && d > 0;
+		var bins = binned ? Math.ceil(d) : undefined;
 		
 		var video = this.options['videoCanonical'];
 		this.backend.aggregate(function (aggregate) {
@@ -402,22 +419,43 @@ LikeLines = {};
 				return;
 			}
 			
-			var playbacks = aggregate['playbacks'];
-			var likedPoints = aggregate['likedPoints'];
+			var playback;
+			var likedPoints;
+			var likeWeights = undefined;
 			var myLikes = aggregate['myLikes'];
 			var mca = aggregate['mca'];
 			
-			var limit = playbacks.length;
-			
-			for (var i=0; i < limit; i++) {
-				var playbackSession = playbacks[i];
-				for (var j=0; j < playbackSession.length; j++) {
-					var playedSegment = playbackSession[j];
-					var begin = Math.floor(playedSegment[0]);
-					var end = Math.floor(playedSegment[1]);
-					
-					for (var s=begin; s <= end && s < d; s++) {
-						playback[s]++;
+			if (binned) {
+				// 1 bin per second: playback curve can be used as-is,
+				// likes are represented by weighted bin centers
+				var likeCounts = aggregate['likeCounts'];
+				playback = aggregate['playbackCurve'];
+				likedPoints = [];
+				likeWeights = [];
+				for (var i=0; i < likeCounts.length; i++) {
+					if (likeCounts[i] > 0) {
+						likedPoints.push(i + 0.5);
+						likeWeights.push(likeCounts[i]);
+					}
+				}
+			}
+			else {
+				var playbacks = aggregate['playbacks'];
+				likedPoints = aggregate['likedPoints'];
+				playback = LikeLines.Util.zeros(d);
+				
+				var limit = playbacks.length;
+				
+				for (var i=0; i < limit; i++) {
+					var playbackSession = playbacks[i];
+					for (var j=0; j < playbackSession.length; j++) {
+						var playedSegment = playbackSession[j];
+						var begin = Math.floor(playedSegment[0]);
+						var end = Math.floor(playedSegment[1]);
+						
+						for (var s=begin; s <= end && s < d; s++) {
+							playback[s]++;
+						}
 					}
 				}
 			}
@@ -427,7 +465,8 @@ LikeLines = {};
 				likedPoints, /* likes */
 				playback, /* playback */
 				undefined, /* seeks */
-				mca /* mca */
+				mca, /* mca */
+				likeWeights /* likeWeights */
 			];
 			self.gui.heatmap.computeHeatmapArgs = args;
 			var heatmap = self.gui.heatmap.computeHeatmap.apply(self.gui.heatmap, args);
@@ -437,10 +476,35 @@ LikeLines = {};
 			for (var i=0; i < myLikes.length; i++) {
 				self.gui.heatmap.addMarker(myLikes[i], 'LIKE');
 			}
+		}, bins && {bins: bins, duration: bins}, this.gui.heatmap.canvasWidth);
+	};
+	LikeLines.Player.prototype.updateHeatmapFromServer = function () {
+		var self = this;
+		var heatmap = this.gui.heatmap;
+		
+		var video = this.options['videoCanonical'];
+		this.backend.heatmap(heatmap.canvasWidth, this.getDuration(), function (json) {
+			if (video !== self.options['videoCanonical'] || json['error'] !== undefined) {
+				return;
+			}
+			
+			heatmap.computeHeatmapArgs = undefined;
+			heatmap.paintHeatmap(json['heatmap']);
+			
+			var myLikes = json['myLikes'];
+			heatmap.clearMarkers();
+			for (var i=0; i < myLikes.length; i++) {
+				heatmap.addMarker(myLikes[i], 'LIKE');
+			}
 		});
 	};
 	LikeLines.Player.prototype.updateHeatmapCached = function () {
 		var self = this;
+		if (this.gui.heatmap.computeHeatmapArgs === undefined) {
+			// heatmap was computed by the back-end
+			this.updateHeatmapFromServer();
+			return;
+		}
 		var args = this.gui.heatmap.computeHeatmapArgs;
 		var heatmap = this.gui.heatmap.computeHeatmap.apply(this.gui.heatmap, args);
 		this.gui.heatmap.paintHeatmap(heatmap);
@@ -657,10 +721,11 @@ LikeLines = {};
 		this.paintHeatmap(heatmap);
 		this.gui.llplayer.options.palette = oldPalette;
 	};
-	LikeLines.GUI.Navigation.Heatmap.prototype.computeHeatmap = function(duration, likes, playback, seeks, mca) {
+	LikeLines.GUI.Navigation.Heatmap.prototype.computeHeatmap = function(duration, likes, playback, seeks, mca, likeWeights) {
 		/*
 		 * duration: number of seconds of corresponding video
 		 * likes: [timepoints] of likes
+		 * likeWeights?: [weights] of the likes timepoints (e.g., counts of binned likes)
 		 * playback: [weights] per time bin from playing behaviour
 		 * seeks: [timepoints] of seeks [unimplemented, subject to change]
 		 * mca: {name: {
@@ -727,7 +792,7 @@ LikeLines = {};
 		
 		// convert all timecode-level evidence to an Array(w)
 		var conversionTasks = {
-			likes:     ['point',  likes],
+			likes:     ['point',  likes, likeWeights],
 			playback:  ['curve',  playback],
 			seeks:     ['point',  seeks],
 			mca:       ['curve',  mcaCurve]
@@ -737,6 +802,7 @@ LikeLines = {};
 		for (var evidenceName in conversionTasks) {
 			var evidenceType = conversionTasks[evidenceName][0];
 			var evidenceData = conversionTasks[evidenceName][1];
+			var evidenceWeights = conversionTasks[evidenceName][2];
 			
 			if (evidenceData === undefined) {
 				continue;
@@ -745,7 +811,7 @@ LikeLines = {};
 			var arr;
 			if (evidenceType === 'point') {
 				var arr = [];
-				var f_smooth = LikeLines.Util.kernelSmooth(evidenceData, undefined, K);
+				var f_smooth = LikeLines.Util.kernelSmooth(evidenceData, evidenceWeights, K);
 				var step = (duration-1 - 0)/(w-1);
 				
 				for (var i = 0; i < w-1; i++) {
@@ -837,12 +903,64 @@ LikeLines = {};
 		this.baseUrl = baseUrl;
 		this.videoId = videoId;
 		this.buffer = [];
+		this.seq = 0;           // sequence number of the last batch cut from the buffer
+		this.unacked = [];      // [{seq, interactions}] sent, but not yet acknowledged
+		this.sending = false;
 		this.lastSend = 0;
 		this.sessionToken = undefined;
 		this.readonly = options['backendReadOnly'];
 		this.options = options || LikeLines.options.defaults;
 		this.seenFirstNonTickEvent = false;
+		this.instanceId = LikeLines.BackendServer.instances++;
+		this.aggregateState = undefined; // merged result of delta /aggregate requests
+		this.jsonpQueues = {};           // callback name -> requests waiting for it
+		this.jsonpTimeouts = 0;          // JSONP requests that timed out
 	}
+	LikeLines.BackendServer.instances = 0;
+	LikeLines.BackendServer.prototype.getCacheableJSONP = function (url, callbackName, callback) {
+		// Unlike jQuery.getJSON, use a stable URL and callback name such that
+		// the browser can revalidate its cached copy (ETag) with the back-end.
+		// Requests sharing a callback name are sent one at a time, as they
+		// would otherwise replace each other's handler.
+		var queue = this.jsonpQueues[callbackName] = this.jsonpQueues[callbackName] || [];
+		queue.push({url: url, callback: callback});
+		if (queue.length === 1) {
+			this.sendCacheableJSONP(callbackName);
+		}
+	};
+	LikeLines.BackendServer.prototype.sendCacheableJSONP = function (callbackName) {
+		var self = this;
+		var queue = this.jsonpQueues[callbackName];
+		var request = queue[0];
+		var name = 'LikeLines_' + callbackName + '_' + this.instanceId;
+		if (this.jsonpTimeouts > 0) {
+			// A late response must not reach the handler of a later request
+			name += '_' + this.jsonpTimeouts;
+		}
+		
+		jQuery.ajax({
+			url: request.url,
+			dataType: 'jsonp',
+			cache: true,
+			timeout: 10000,
+			jsonpCallback: name,
+			success: function (json) {
+				if (request.callback)
+					request.callback(json);
+			},
+			error: function (xhr, status) {
+				if (status === 'timeout') {
+					self.jsonpTimeouts++;
+				}
+			},
+			complete: function () {
+				queue.shift();
+				if (queue.length > 0) {
+					self.sendCacheableJSONP(callbackName);
+				}
+			}
+		});
+	};
 	LikeLines.BackendServer.prototype.createNewInteractionSession = function (cb) {
 		if (this.readonly) {
 			if (cb) cb();
@@ -886,22 +1004,85 @@ LikeLines = {};
 		}
 		else if (forceSend===true || canSend) {
 			this.simplifyBuffer();
-			
-			var url = this.baseUrl + 'sendInteractions?' + jQuery.param({
-				token: this.sessionToken, 
-				interactions: JSON.stringify(this.buffer)
-			}) + '&callback=?';
-			//console.log(cur_ts, url);
-			
-			jQuery.getJSON(url, function(json) {
-				self.buffer = [];
-			});
+			if (this.buffer.length > 0) {
+				// The batch keeps its sequence number when it is sent again,
+				// so the back-end applies it only once
+				this.unacked.push({seq: ++this.seq, interactions: this.buffer});
+				this.buffer = [];
+			}
+			this.sendBatches(forceSend===true);
 			self.lastSend = cur_ts;
 		}
 		else if (this.buffer.length > 100) {
 			this.simplifyBuffer();
 		}
 	}
+	LikeLines.BackendServer.prototype.sendBatches = function (flushNow) {
+		// Sends the unacknowledged batches, one request at a time
+		if (this.sending || this.unacked.length === 0) return;
+		this.sending = true;
+		
+		var self = this;
+		var batcher = LikeLines.InteractionBatcher.get(this.baseUrl, this.options);
+		var batches = this.unacked.slice();
+		var done = function (ok) {
+			self.sending = false;
+			if (ok) {
+				var lastSeq = batches[batches.length-1].seq;
+				while (self.unacked.length > 0 && self.unacked[0].seq <= lastSeq) {
+					self.unacked.shift();
+				}
+				self.sendBatches(flushNow);
+			}
+			else {
+				var delay = batcher.available ? batcher.retryDelay(self.options.backendThrottle) : self.options.backendThrottle;
+				window.setTimeout(function () { self.sendBatches(); }, delay * 1000);
+			}
+		};
+		
+		if (batcher.available && batcher.shouldProbe()) {
+			// The POSTs keep failing without a status: find out with JSONP
+			// whether the back-end can be reached at all
+			batches = batches.slice(0, 1);
+			this.sendInteractionsJSONP(batches[0], function (ok) {
+				if (ok) {
+					batcher.reachable = true;
+				}
+				done(ok);
+			});
+		}
+		else if (batcher.available) {
+			batcher.add(this.sessionToken, batches, flushNow, function (ok) {
+				if (!ok && !batcher.available) {
+					// Retry right away using JSONP
+					self.sending = false;
+					self.sendBatches(flushNow);
+				}
+				else {
+					done(ok);
+				}
+			});
+		}
+		else {
+			batches = batches.slice(0, 1);
+			this.sendInteractionsJSONP(batches[0], done);
+		}
+	}
+	LikeLines.BackendServer.prototype.sendInteractionsJSONP = function (batch, callback) {
+		var url = this.baseUrl + 'sendInteractions?' + jQuery.param({
+			token: this.sessionToken, 
+			seq: batch.seq,
+			interactions: JSON.stringify(batch.interactions)
+		});
+		
+		jQuery.ajax({
+			url: url,
+			dataType: 'jsonp',
+			timeout: 10000,
+			success: function (json) { callback(true); },
+			error: function () { callback(false); }
+		});
+	}
 	LikeLines.BackendServer.prototype.containsNonTickEvent = function (interactions) {
 		var n = interactions.length;
 		for (var i=0; i < n; i++) {
@@ -958,24 +1139,223 @@ LikeLines = {};
 		}
 		this.buffer = newBuffer;
 	}
-	LikeLines.BackendServer.prototype.aggregate = function (callback) {
+	LikeLines.BackendServer.prototype.aggregate = function (callback, binning, width) {
+		/*
+		 * binning (optional): {bins: number of bins, duration?: seconds spanned by the bins}
+		 * width (optional): width of the heatmap, curve MCAs are downsampled accordingly
+		 */
 		if (this.baseUrl === undefined) {
 			console.log('BackendServer.aggregate(): Warning: no back-end specified');
 			return;
 		}
 		
 		var self = this;
-	
-		var url = this.baseUrl + 'aggregate?' + jQuery.param({
-			videoId: this.videoId
-		}) + '&callback=?';
+		
+		var params = LikeLines.Util.merge({videoId: this.videoId}, binning || {});
+		if (width) {
+			params.width = width;
+		}
+		if (!binning) {
+			// Only fetch what changed since the previous request
+			params.since = this.aggregateState ? this.aggregateState.cursor : 0;
+		}
+		var url = this.baseUrl + 'aggregate?' + jQuery.param(params);
 		console.log(url);
 		
-		jQuery.getJSON(url, function(json) {
-			if (callback)
-				callback(json);
+		this.getCacheableJSONP(url, 'aggregate', function (json) {
+			if (binning || json['cursor'] === undefined) {
+				if (callback) callback(json);
+				return;
+			}
+			
+			var state = self.mergeAggregate(json, params.since);
+			var playbacks = [];
+			var likedPoints = [];
+			var taggedPoints = [];
+			for (var token in state.playbacks) {
+				if (state.playbacks.hasOwnProperty(token)) {
+					playbacks.push(state.playbacks[token]);
+				}
+			}
+			for (token in state.likedPoints) {
+				if (state.likedPoints.hasOwnProperty(token)) {
+					likedPoints = likedPoints.concat(state.likedPoints[token]);
+				}
+			}
+			for (token in state.taggedPoints) {
+				if (state.taggedPoints.hasOwnProperty(token)) {
+					taggedPoints = taggedPoints.concat(state.taggedPoints[token]);
+				}
+			}
+			if (callback) {
+				callback(LikeLines.Util.merge({
+					playbacks: playbacks,
+					likedPoints: likedPoints,
+					taggedPoints: taggedPoints
+				}, json));
+			}
 		});
 	}
+	LikeLines.BackendServer.prototype.mergeAggregate = function (json, since) {
+		var state = this.aggregateState;
+		if (json['delta'] && state !== undefined && state.cursor !== since) {
+			// A concurrent request has already applied these changes
+			return state;
+		}
+		if (!json['delta'] || state === undefined) {
+			state = this.aggregateState = {playbacks: {}, likedPoints: {}, taggedPoints: {}};
+		}
+		
+		// Sessions are replaced as a whole; a null playback marks a removed session
+		var keys = ['playbacks', 'likedPoints', 'taggedPoints'];
+		for (var i = 0; i < keys.length; i++) {
+			var sessions = json[keys[i]];
+			for (var token in sessions) {
+				if (!sessions.hasOwnProperty(token)) continue;
+				if (sessions[token] === null || sessions[token].length === 0) {
+					delete state[keys[i]][token];
+				}
+				else {
+					state[keys[i]][token] = sessions[token];
+				}
+			}
+		}
+		state.cursor = json['cursor'];
+		return state;
+	}
+	LikeLines.BackendServer.prototype.heatmap = function (width, duration, callback) {
+		if (this.baseUrl === undefined) {
+			console.log('BackendServer.heatmap(): Warning: no back-end specified');
+			return;
+		}
+		
+		var kernel = this.options.kernelFunction;
+		var params = {
+			videoId: this.videoId,
+			width: width,
+			duration: duration,
+			bandwidth: this.options.smoothingBandwidth,
+			weights: JSON.stringify(this.options.heatmapWeights)
+		};
+		if (typeof kernel === 'string') {
+			// custom kernel functions are not supported by the back-end
+			params.kernel = kernel;
+		}
+		
+		var url = this.baseUrl + 'heatmap?' + jQuery.param(params);
+		
+		this.getCacheableJSONP(url, 'heatmap', callback);
+	}
+	
+	
+	/*--------------------------------------------------------------------*
+	 * Interaction batcher (shared by the back-ends of a page with the same
+	 * base URL): combines interaction batches of several sessions into one
+	 * compressed CORS POST request to /postInteractions
+	 *--------------------------------------------------------------------*/
+	LikeLines.InteractionBatcher = function (baseUrl, options) {
+		this.baseUrl = baseUrl;
+		this.delay = options.backendBatchDelay;
+		this.available = options.backendPost && LikeLines.InteractionBatcher.isSupported();
+		this.pending = {};    // token -> {interactions, callbacks}
+		this.timer = undefined;
+		this.failures = 0;    // consecutive POSTs that failed without a status
+		this.reachable = false; // JSONP reached the back-end after such failures
+	}
+	LikeLines.InteractionBatcher.batchers = {};
+	LikeLines.InteractionBatcher.probeAfter = 3;      // failures before probing with JSONP
+	LikeLines.InteractionBatcher.maxRetryDelay = 300; // seconds
+	LikeLines.InteractionBatcher.get = function (baseUrl, options) {
+		var batchers = LikeLines.InteractionBatcher.batchers;
+		if (!batchers.hasOwnProperty(baseUrl)) {
+			batchers[baseUrl] = new LikeLines.InteractionBatcher(baseUrl, options);
+		}
+		return batchers[baseUrl];
+	};
+	LikeLines.InteractionBatcher.isSupported = function () {
+		return window.XMLHttpRequest !== undefined && 'withCredentials' in new XMLHttpRequest();
+	};
+	LikeLines.InteractionBatcher.prototype.add = function (token, batches, flushNow, callback) {
+		// batches: [{seq, interactions}] of a session, oldest first
+		var entry = this.pending[token] || {callbacks: []};
+		entry.batches = batches;
+		entry.callbacks.push(callback);
+		this.pending[token] = entry;
+		
+		var self = this;
+		if (flushNow) {
+			this.flush();
+		}
+		else if (this.timer === undefined) {
+			this.timer = window.setTimeout(function () { self.flush(); }, this.delay * 1000);
+		}
+	};
+	LikeLines.InteractionBatcher.prototype.flush = function () {
+		if (this.timer !== undefined) {
+			window.clearTimeout(this.timer);
+			this.timer = undefined;
+		}
+		
+		var batches = [];
+		var callbacks = [];
+		for (var token in this.pending) {
+			if (this.pending.hasOwnProperty(token)) {
+				var entry = this.pending[token];
+				for (var i = 0; i < entry.batches.length; i++) {
+					batches.push({token: token, seq: entry.batches[i].seq, interactions: entry.batches[i].interactions});
+				}
+				callbacks.push.apply(callbacks, entry.callbacks);
+			}
+		}
+		this.pending = {};
+		if (batches.length === 0) return;
+		
+		var self = this;
+		LikeLines.Util.compress(JSON.stringify({batches: batches}), function (body, encoding) {
+			self.post(body, encoding, callbacks);
+		});
+	};
+	LikeLines.InteractionBatcher.prototype.post = function (body, encoding, callbacks) {
+		var self = this;
+		var xhr = new XMLHttpRequest();
+		xhr.open('POST', this.baseUrl + 'postInteractions', true);
+		xhr.withCredentials = true;  // the user session cookie
+		xhr.setRequestHeader('Content-Type', 'application/json');
+		if (encoding) {
+			xhr.setRequestHeader('Content-Encoding', encoding);
+		}
+		xhr.onreadystatechange = function () {
+			if (xhr.readyState !== 4) return;
+			
+			var ok = xhr.status === 200;
+			if (xhr.status === 404 || xhr.status === 405 || (xhr.status === 0 && self.reachable)) {
+				// Back-end without /postInteractions, or one that JSONP reaches
+				// while it keeps blocking the CORS (preflight) request
+				console.log('InteractionBatcher: falling back to JSONP');
+				self.available = false;
+			}
+			else if (xhr.status === 0) {
+				// Network error or CORS failure: retried with backoff
+				self.failures++;
+			}
+			else {
+				self.failures = 0;
+				self.reachable = false;
+			}
+			for (var i = 0; i < callbacks.length; i++) {
+				callbacks[i](ok);
+			}
+		};
+		xhr.send(body);
+	};
+	LikeLines.InteractionBatcher.prototype.shouldProbe = function () {
+		return this.failures >= LikeLines.InteractionBatcher.probeAfter && !this.reachable;
+	};
+	LikeLines.InteractionBatcher.prototype.retryDelay = function (delay) {
+		// Exponential backoff (seconds) while the POSTs fail without a status
+		var n = Math.max(this.failures - 1, 0);
+		return Math.min(delay * Math.pow(2, n), LikeLines.InteractionBatcher.maxRetryDelay);
+	};
 	
 	
 	/*--------------------------------------------------------------------*
@@ -1019,6 +1399,20 @@ LikeLines = {};
 		res[player] = video;
 		return res;
 	};
+	LikeLines.Util.compress = function (text, callback) {
+		// Calls callback(body, encoding), gzip-compressed if the browser
+		// supports it and uncompressed (encoding undefined) otherwise
+		if (window.CompressionStream === undefined || window.Response === undefined || window.Blob === undefined) {
+			callback(text);
+			return;
+		}
+		var stream = new Blob([text]).stream().pipeThrough(new CompressionStream('gzip'));
+		new Response(stream).arrayBuffer().then(function (buf) {
+			callback(buf, 'gzip');
+		}, function () {
+			callback(text);
+		});
+	};
 	LikeLines.Util.merge = function (a, b) {
 		var res = {};
 		var prop;
@@ -0,0 +1,82 @@
+# CLI utility to rebuild the aggregates of videos in a LikeLines database
+# License: MIT
+#
+# Like the migrate utility, this one accesses the database directly. Large
+# videos are aggregated by a pool of worker processes (see mapreduce.py).
+# A running server keeps serving cached responses of the rebuilt videos
+# until they expire (RESPONSE_CACHE_TTL).
+
+import os, sys
+import time
+from optparse import OptionParser
+
+from LikeLines.server import create_app, create_db, default_config
+from LikeLines import aggregates
+
+import multiprocessing
+
+def get_optionparser():
+    qualified_module_name = '%s.%s' % (__package__, os.path.splitext(os.path.basename(__file__))[0])
+    usage = 'usage: python -m %s [OPTION] VIDEO_ID...' % qualified_module_name
+    
+    parser = OptionParser(usage=usage)
+    
+    parser.add_option('--storage',
+                      dest='storage',
+                      metavar='ENGINE',
+                      choices=['mongo', 'sqlite'],
+                      default=default_config['STORAGE_ENGINE'],
+                      help='Storage engine: mongo or sqlite (default: %s)' % default_config['STORAGE_ENGINE'])
+    
+    parser.add_option('--sqlite',
+                      dest='sqlite_path',
+                      metavar='PATH',
+                      default=default_config['SQLITE_PATH'],
+                      help='SQLite database file (default: %s)' % default_config['SQLITE_PATH'])
+    
+    parser.add_option('--db',
+                      dest='dbname',
+                      metavar='NAME',
+                      default=default_config['MONGO_DBNAME'],
+                      help='MongoDB database name (default: %s)' % default_config['MONGO_DBNAME'])
+    
+    parser.add_option('-w',
+                      dest='workers',
+                      metavar='N',
+                      type='int',
+                      default=multiprocessing.cpu_count(),
+                      help='Number of worker processes, 0 to aggregate serially (default: %d)' % multiprocessing.cpu_count())
+    
+    parser.add_option('--min-sessions',
+                      dest='min_sessions',
+                      metavar='N',
+                      type='int',
+                      default=default_config['AGGREGATE_PARALLEL_MIN_SESSIONS'],
+                      help='Aggregate smaller videos serially (default: %d)' % default_config['AGGREGATE_PARALLEL_MIN_SESSIONS'])
+    
+    return parser
+
+if __name__ == "__main__":
+    parser = get_optionparser()
+    options, videoIds = parser.parse_args()
+    
+    if not videoIds:
+        parser.print_help(file = sys.stderr)
+        sys.exit(-1)
+    
+    app = create_app({
+        'STORAGE_ENGINE': options.storage,
+        'SQLITE_PATH': options.sqlite_path,
+        'MONGO_DBNAME': options.dbname,
+        'METRICS_ENABLED': False,
+        'AGGREGATE_WORKERS': options.workers,
+        'AGGREGATE_PARALLEL_MIN_SESSIONS': options.min_sessions
+    })
+    with app.app_context():
+        app.storage = create_db(app)
+        for videoId in videoIds:
+            start = time.time()
+            aggregate = aggregates.rebuild_video_aggregate(videoId)
+            elapsed = time.time() - start
+            print '%s: %d sessions in %.2f s' % (videoId, aggregate['numSessions'], elapsed)
+            sys.stdout.flush()
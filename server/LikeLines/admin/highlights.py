@@ -0,0 +1,114 @@
+# CLI utility and background job that keeps the highlights index of a LikeLines database up to date
+# License: MIT
+#
+# Like the migrate utility, this one accesses the database directly. Given
+# video IDs, it recomputes their highlights. Otherwise, it runs as a job that
+# recomputes the highlights marked as stale by updates of the aggregates or
+# MCA of videos (see highlights.py), so only videos with new sessions,
+# interactions or MCA are revisited.
+
+import os, sys
+import time
+import logging
+from optparse import OptionParser
+
+from LikeLines.server import create_app, create_db, default_config
+from LikeLines import highlights
+
+log = logging.getLogger(__name__)
+
+def get_optionparser():
+    qualified_module_name = '%s.%s' % (__package__, os.path.splitext(os.path.basename(__file__))[0])
+    usage = 'usage: python -m %s [OPTION] [VIDEO_ID...]' % qualified_module_name
+    
+    parser = OptionParser(usage=usage)
+    
+    parser.add_option('--storage',
+                      dest='storage',
+                      metavar='ENGINE',
+                      choices=['mongo', 'sqlite'],
+                      default=default_config['STORAGE_ENGINE'],
+                      help='Storage engine: mongo or sqlite (default: %s)' % default_config['STORAGE_ENGINE'])
+    
+    parser.add_option('--sqlite',
+                      dest='sqlite_path',
+                      metavar='PATH',
+                      default=default_config['SQLITE_PATH'],
+                      help='SQLite database file (default: %s)' % default_config['SQLITE_PATH'])
+    
+    parser.add_option('--db',
+                      dest='dbname',
+                      metavar='NAME',
+                      default=default_config['MONGO_DBNAME'],
+                      help='MongoDB database name (default: %s)' % default_config['MONGO_DBNAME'])
+    
+    parser.add_option('-k',
+                      dest='k',
+                      metavar='K',
+                      type='int',
+                      default=default_config['HIGHLIGHTS_K'],
+                      help='Top segments kept per video (default: %d)' % default_config['HIGHLIGHTS_K'])
+    
+    parser.add_option('-n',
+                      dest='batch_size',
+                      metavar='N',
+                      type='int',
+                      default=100,
+                      help='Stale videos recomputed per round (default: 100)')
+    
+    parser.add_option('-i',
+                      dest='interval',
+                      metavar='SECONDS',
+                      type='float',
+                      default=10.0,
+                      help='Poll interval when no highlights are stale (default: 10.0)')
+    
+    parser.add_option('--once',
+                      dest='once',
+                      action='store_true',
+                      default=False,
+                      help='Exit once no highlights are stale')
+    
+    return parser
+
+if __name__ == "__main__":
+    parser = get_optionparser()
+    options, videoIds = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(name)s: %(message)s')
+    
+    app = create_app({
+        'STORAGE_ENGINE': options.storage,
+        'SQLITE_PATH': options.sqlite_path,
+        'MONGO_DBNAME': options.dbname,
+        'METRICS_ENABLED': False,
+        'HIGHLIGHTS_K': options.k
+    })
+    with app.app_context():
+        app.storage = create_db(app)
+        
+        if videoIds:
+            for videoId in videoIds:
+                start = time.time()
+                stored = app.storage.get_highlights(videoId)
+                videoHighlights = highlights.refresh_highlights(videoId, stored and stored.get('version'))
+                elapsed = time.time() - start
+                print '%s: %d segments in %.2f s' % (videoId, len(videoHighlights['segments']), elapsed)
+                sys.stdout.flush()
+            sys.exit(0)
+        
+        while True:
+            start = time.time()
+            try:
+                refreshed = highlights.refresh_stale_highlights(options.batch_size)
+            except Exception:
+                # e.g., the database is unavailable: retry later
+                log.exception('Refreshing highlights failed; will retry')
+                time.sleep(options.interval)
+                continue
+            if refreshed:
+                log.info('Refreshed the highlights of %d videos in %.2f s' % (len(refreshed), time.time() - start))
+            
+            if len(refreshed) < options.batch_size:
+                if options.once:
+                    break
+                time.sleep(options.interval)
@@ -0,0 +1,123 @@
+# Worker that folds the ingestion log of a LikeLines server into its database
+# License: MIT
+#
+# Run next to a server started with --ingest log, on the same host and with
+# the same --ingest-log directory. The worker tails the log, applies the
+# logged interaction batches in bulk and checkpoints how far it got, so it
+# can be stopped and restarted at any time. Batches applied just before a
+# crash may be applied again after a restart. Batches that cannot be applied
+# (other than because the database is unavailable) are moved to the file
+# 'quarantine' in the log directory, one JSON line per batch.
+
+import os, sys
+import json
+import time
+import logging
+from optparse import OptionParser
+
+from LikeLines.server import create_app, create_db, default_config
+from LikeLines.ingest import IngestLogReader, APPLY_STAGES, apply_in_stages
+
+log = logging.getLogger(__name__)
+
+def get_optionparser():
+    qualified_module_name = '%s.%s' % (__package__, os.path.splitext(os.path.basename(__file__))[0])
+    usage = 'usage: python -m %s [OPTION]' % qualified_module_name
+    
+    parser = OptionParser(usage=usage)
+    
+    parser.add_option('--storage',
+                      dest='storage',
+                      metavar='ENGINE',
+                      choices=['mongo', 'sqlite'],
+                      default=default_config['STORAGE_ENGINE'],
+                      help='Storage engine: mongo or sqlite (default: %s)' % default_config['STORAGE_ENGINE'])
+    
+    parser.add_option('--sqlite',
+                      dest='sqlite_path',
+                      metavar='PATH',
+                      default=default_config['SQLITE_PATH'],
+                      help='SQLite database file (default: %s)' % default_config['SQLITE_PATH'])
+    
+    parser.add_option('--db',
+                      dest='dbname',
+                      metavar='NAME',
+                      default=default_config['MONGO_DBNAME'],
+                      help='MongoDB database name (default: %s)' % default_config['MONGO_DBNAME'])
+    
+    parser.add_option('--ingest-log',
+                      dest='ingest_log_dir',
+                      metavar='DIR',
+                      default=default_config['INGEST_LOG_DIR'],
+                      help='Directory of the ingestion log (default: %s)' % default_config['INGEST_LOG_DIR'])
+    
+    parser.add_option('-n',
+                      dest='batch_size',
+                      metavar='N',
+                      type='int',
+                      default=default_config['INGEST_FLUSH_SIZE'],
+                      help='Interactions applied per bulk write (default: %d)' % default_config['INGEST_FLUSH_SIZE'])
+    
+    parser.add_option('-i',
+                      dest='interval',
+                      metavar='SECONDS',
+                      type='float',
+                      default=default_config['INGEST_FLUSH_INTERVAL'],
+                      help='Poll interval when the log has been drained (default: %.1f)' % default_config['INGEST_FLUSH_INTERVAL'])
+    
+    parser.add_option('--once',
+                      dest='once',
+                      action='store_true',
+                      default=False,
+                      help='Exit once the log has been drained')
+    
+    return parser
+
+def quarantine(path, batches):
+    with open(path, 'a') as fh:
+        for batch in batches:
+            fh.write(json.dumps(batch, separators=(',', ':')) + '\n')
+        fh.flush()
+        os.fsync(fh.fileno())
+    log.error('Quarantined %d batches that cannot be applied in %s' % (len(batches), path))
+
+if __name__ == "__main__":
+    parser = get_optionparser()
+    options, _ = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(name)s: %(message)s')
+    
+    if not os.path.isdir(options.ingest_log_dir):
+        print >>sys.stderr, 'Cannot find ingestion log: %s' % options.ingest_log_dir
+        sys.exit(1)
+    
+    app = create_app({
+        'STORAGE_ENGINE': options.storage,
+        'SQLITE_PATH': options.sqlite_path,
+        'MONGO_DBNAME': options.dbname,
+        'METRICS_ENABLED': False,
+        'INGEST_MODE': 'direct'
+    })
+    with app.app_context():
+        app.storage = create_db(app)
+        reader = IngestLogReader(options.ingest_log_dir)
+        quarantinePath = os.path.join(options.ingest_log_dir, 'quarantine')
+        
+        while True:
+            batches, offset = reader.read(options.batch_size)
+            pending = [batches] + [[] for _ in APPLY_STAGES[1:]]
+            while any(pending):
+                pending, failed = apply_in_stages(pending)
+                if failed:
+                    quarantine(quarantinePath, failed)
+                if any(pending):
+                    # e.g., the database is unavailable: retry the stages that failed
+                    log.warning('Applying %d batches failed; will retry' % sum(map(len, pending)))
+                    time.sleep(options.interval)
+            if offset != reader.offset:
+                reader.commit(offset)
+                log.info('Applied %d batches, %d bytes pending' % (len(batches), reader.pending()))
+            
+            if not batches:
+                if options.once:
+                    break
+                time.sleep(options.interval)
@@ -5,17 +5,20 @@
 import os, sys
 import urllib, urllib2
 import json
+import zlib
 
 from optparse import OptionParser
-from LikeLines.secretkey import compute_signature
+from LikeLines.secretkey import compute_signature, new_signature, finish_signature
 
-VALID_COMMANDS = ['download', 'upload', 'delete']
+VALID_COMMANDS = ['download', 'upload', 'delete', 'rebuild']
 COMMANDS_REQ_FILE = ['upload']
+CHUNK_SIZE = 64*1024
 
 def get_optionparser():
     qualified_module_name = '%s.%s' % (__package__, os.path.splitext(os.path.basename(__file__))[0])
     usage = 'usage: python -m %s COMMAND VIDEO_ID [FILE]' % qualified_module_name
     usage += '\n\nValid COMMANDs: %s' % ', '.join(VALID_COMMANDS)
+    usage += '\nFILE is the input of upload and the (optional) output of download.'
     
     parser = OptionParser(usage=usage)
     
@@ -35,8 +38,83 @@ def get_optionparser():
                       metavar='SERVER',
                       help='LikeLines server')
     
+    parser.add_option('--ndjson',
+                      dest='ndjson',
+                      action='store_true',
+                      default=False,
+                      help='Download/upload newline-delimited JSON instead of a JSON array (uploads are streamed)')
+    
+    parser.add_option('--resume',
+                      dest='resume',
+                      action='store_true',
+                      default=False,
+                      help='Resume an interrupted --ndjson download into FILE')
+    
     return parser
 
+def stream_to_file(response, fh):
+    """Copies a (possibly gzip-compressed) response to `fh` chunk by chunk."""
+    decompressor = None
+    if response.info().get('Content-Encoding') == 'gzip':
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    
+    while True:
+        chunk = response.read(CHUNK_SIZE)
+        if not chunk:
+            break
+        fh.write(decompressor.decompress(chunk) if decompressor else chunk)
+    
+    if decompressor:
+        fh.write(decompressor.flush())
+
+class UploadBody(object):
+    """File-like body of a streamed upload: a header line followed by the contents of a file."""
+    
+    def __init__(self, header, path):
+        self.header = header
+        self.path = path
+        self.fh = None
+    
+    def __len__(self):
+        return len(self.header) + os.path.getsize(self.path)
+    
+    def signature(self, key):
+        mac = new_signature(key)
+        mac.update(self.header)
+        with open(self.path, 'rb') as fh:
+            for chunk in iter(lambda: fh.read(CHUNK_SIZE), ''):
+                mac.update(chunk)
+        return finish_signature(mac)
+    
+    def read(self, size):
+        if self.fh is None:
+            self.fh = open(self.path, 'rb')
+            return self.header
+        chunk = self.fh.read(size)
+        if not chunk:
+            self.fh.close()
+        return chunk
+
+def prepare_resume(path):
+    """
+    Truncates a partially downloaded NDJSON file after its last complete line
+    and returns the _id of the last document in it (or None).
+    """
+    with open(path, 'r+b') as fh:
+        fh.seek(0, os.SEEK_END)
+        pos = fh.tell()
+        tail = ''
+        while pos > 0 and tail.count('\n') < 2:
+            step = min(CHUNK_SIZE, pos)
+            pos -= step
+            fh.seek(pos)
+            tail = fh.read(step) + tail
+        
+        end = tail.rfind('\n') + 1
+        fh.truncate(pos + end)
+        lines = tail[:end].splitlines()
+        return json.loads(lines[-1])['_id'] if lines else None
+
 if __name__ == "__main__":
     parser = get_optionparser()
     options, args = parser.parse_args()
@@ -79,6 +157,10 @@ if __name__ == "__main__":
         print >>sys.stderr, 'FILE is required'
         sys.exit(3)
     
+    if options.resume and not (cmd == 'download' and options.ndjson and interactionFile):
+        print >>sys.stderr, '--resume requires the download command, --ndjson and FILE'
+        sys.exit(4)
+    
     url = options.server
     if not url.endswith('/'):
         url += '/'
@@ -89,14 +171,28 @@ if __name__ == "__main__":
         'cmd': cmd,
         'data': None
     }
+    streamed = cmd == 'upload' and options.ndjson
     data = None
-    if interactionFile is not None:
+    if cmd in COMMANDS_REQ_FILE and not streamed:
         with open(interactionFile,'r') as fh:
             data = json.load(fh)
     payload['data'] = data    
     
-    serialized_payload = json.dumps(payload)
-    sig = compute_signature(serverkey, serialized_payload)
+    if cmd == 'download':
+        payload['format'] = 'ndjson' if options.ndjson else 'json'
+        if options.resume and os.path.exists(interactionFile):
+            payload['after'] = prepare_resume(interactionFile)
+    
+    if streamed:
+        # header line, followed by the NDJSON file
+        del payload['data']
+        serialized_payload = json.dumps(payload)
+        body = UploadBody(serialized_payload + '\n', interactionFile)
+        sig = body.signature(serverkey)
+    else:
+        serialized_payload = json.dumps(payload)
+        body = serialized_payload
+        sig = compute_signature(serverkey, serialized_payload)
     url += '?s=%s' % urllib.quote_plus(sig)
     
     print >>sys.stderr, 'Server request:'
@@ -110,10 +206,17 @@ if __name__ == "__main__":
     print >>sys.stderr, 'Server response:'
     print >>sys.stderr, '-' * 40
     req = urllib2.Request(url)
-    req.add_header('Content-Type', 'application/json')
+    req.add_header('Content-Type', 'application/x-ndjson' if streamed else 'application/json')
+    req.add_header('Content-Length', str(len(body)))
+    req.add_header('Accept-Encoding', 'gzip')
     try:
-        response = urllib2.urlopen(req, serialized_payload)
-        print response.read()
+        response = urllib2.urlopen(req, body)
+        if cmd == 'download' and interactionFile is not None:
+            with open(interactionFile, 'ab' if options.resume else 'wb') as fh:
+                stream_to_file(response, fh)
+            print >>sys.stderr, 'Written to %s' % interactionFile
+        else:
+            stream_to_file(response, sys.stdout)
     except urllib2.HTTPError, e:
         print >>sys.stderr, e.read()
 
@@ -0,0 +1,94 @@
+# CLI utility to re-encode the interaction logs stored in a LikeLines database
+# License: MIT
+#
+# Unlike the other admin utilities, this one accesses the database directly.
+# It can run while the server is up: sessions that receive new interactions
+# while being re-encoded are skipped and can be migrated in a later run.
+
+import os, sys
+import json
+from optparse import OptionParser
+
+from LikeLines.server import create_app, create_db, default_config
+from LikeLines.codec import ENCODINGS, encode_interactions, decode_interactions
+
+PROGRESS_INTERVAL = 10000
+
+def get_optionparser():
+    qualified_module_name = '%s.%s' % (__package__, os.path.splitext(os.path.basename(__file__))[0])
+    usage = 'usage: python -m %s [OPTION] ENCODING' % qualified_module_name
+    usage += '\n\nValid ENCODINGs: %s' % ', '.join(ENCODINGS)
+    
+    parser = OptionParser(usage=usage)
+    
+    parser.add_option('--storage',
+                      dest='storage',
+                      metavar='ENGINE',
+                      choices=['mongo', 'sqlite'],
+                      default=default_config['STORAGE_ENGINE'],
+                      help='Storage engine: mongo or sqlite (default: %s)' % default_config['STORAGE_ENGINE'])
+    
+    parser.add_option('--sqlite',
+                      dest='sqlite_path',
+                      metavar='PATH',
+                      default=default_config['SQLITE_PATH'],
+                      help='SQLite database file (default: %s)' % default_config['SQLITE_PATH'])
+    
+    parser.add_option('--db',
+                      dest='dbname',
+                      metavar='NAME',
+                      default=default_config['MONGO_DBNAME'],
+                      help='MongoDB database name (default: %s)' % default_config['MONGO_DBNAME'])
+    
+    parser.add_option('--after',
+                      dest='after',
+                      metavar='ID',
+                      help='Resume after the interaction session with this _id')
+    
+    return parser
+
+def migrate(storage, encoding, after=None):
+    """Re-encodes the interactions of every session chunk by chunk. Returns statistics."""
+    stats = {'sessions': 0, 'migrated': 0, 'skipped': 0, 'bytesBefore': 0, 'bytesAfter': 0}
+    
+    def encode(interactions):
+        encoded = encode_interactions(decode_interactions(interactions), encoding)
+        stats['bytesBefore'] += len(json.dumps(interactions))
+        stats['bytesAfter'] += len(json.dumps(encoded))
+        return encoded
+    
+    for interactionSession in storage.scan('interactionSessions', after=after):
+        # chunks that received interactions in the meantime are skipped
+        migrated, skipped = storage.reencode_interactions(interactionSession['_id'], encode)
+        
+        stats['sessions'] += 1
+        stats['migrated'] += migrated
+        stats['skipped'] += skipped
+        
+        if stats['sessions'] % PROGRESS_INTERVAL == 0:
+            print >>sys.stderr, '%d sessions, last _id: %s' % (stats['sessions'], interactionSession['_id'])
+    
+    return stats
+
+if __name__ == "__main__":
+    parser = get_optionparser()
+    options, args = parser.parse_args()
+    
+    if len(args) != 1 or args[0] not in ENCODINGS:
+        parser.print_help(file = sys.stderr)
+        sys.exit(-1)
+    
+    app = create_app({
+        'STORAGE_ENGINE': options.storage,
+        'SQLITE_PATH': options.sqlite_path,
+        'MONGO_DBNAME': options.dbname,
+        'METRICS_ENABLED': False
+    })
+    with app.app_context():
+        storage = create_db(app)
+        stats = migrate(storage, args[0], options.after)
+    
+    print 'Sessions: %(sessions)d, migrated chunks: %(migrated)d, skipped chunks: %(skipped)d' % stats
+    if stats['bytesAfter']:
+        print 'Interactions size: %d -> %d bytes (%.1fx)' % (stats['bytesBefore'], stats['bytesAfter'],
+                                                             float(stats['bytesBefore']) / stats['bytesAfter'])
@@ -4,7 +4,11 @@
 
 import os, sys
 import urllib, urllib2
+import httplib, socket, urlparse
 import json
+import zlib
+from threading import Thread, Lock
+from Queue import Queue
 
 from optparse import OptionParser
 from LikeLines.secretkey import compute_signature
@@ -12,9 +16,14 @@ from LikeLines.secretkey import compute_signature
 OP_UPLOAD, OP_DELETE = range(2)
 VALID_MCA_TYPES = ['curve', 'point']
 
+# Limits the size of a batch besides the number of MCAs in it
+BATCH_MAX_VALUES = 1000000
+
 def get_optionparser():
     qualified_module_name = '%s.%s' % (__package__, os.path.splitext(os.path.basename(__file__))[0])
-    parser = OptionParser(usage='usage: python -m %s VIDEO_ID MCA_NAME [MCA_TYPE MCA_FILE] [OPTION]' % qualified_module_name)
+    usage = ('usage: python -m %s VIDEO_ID MCA_NAME [MCA_TYPE MCA_FILE] [OPTION]\n'
+             '       python -m %s --dir DIR [OPTION]') % (qualified_module_name, qualified_module_name)
+    parser = OptionParser(usage=usage)
     parser.add_option('-k',
                       dest='key',
                       metavar='KEY',
@@ -43,27 +52,170 @@ def get_optionparser():
                       type='float',
                       help='Weight of MCA (default: 1.0)')
     
+    parser.add_option('--dir',
+                      dest='directory',
+                      metavar='DIR',
+                      help='Upload all MCA files in DIR, laid out as DIR/VIDEO_ID/MCA_NAME.MCA_TYPE')
+    
+    parser.add_option('-b',
+                      dest='batch_size',
+                      metavar='N',
+                      type='int',
+                      default=50,
+                      help='MCAs per request with --dir (default: 50)')
+    
+    parser.add_option('-c',
+                      dest='concurrency',
+                      metavar='N',
+                      type='int',
+                      default=4,
+                      help='Concurrent requests with --dir (default: 4)')
+    
+    parser.add_option('--state',
+                      dest='state',
+                      metavar='FILE',
+                      help='Record uploaded MCAs in FILE and skip those already recorded (resume)')
+    
     return parser
 
 def read_mca_file(path):
     if os.path.exists(path):
-        res = []
         with open(path, 'r') as fh:
-            for line in fh:
-                line = line.strip()
-                if line.startswith('#'):
-                    continue
-                x = float(line)
-                res.append(x)
-        return res
+            return [float(line) for line in fh.read().splitlines() if line.strip() and not line.lstrip().startswith('#')]
     else:
         return False
 
+def find_mca_files(directory):
+    """Yields (videoId, mcaName, mcaType, path) of the MCA files in a directory."""
+    for videoId in sorted(os.listdir(directory)):
+        videoDir = os.path.join(directory, videoId)
+        if not os.path.isdir(videoDir):
+            continue
+        for filename in sorted(os.listdir(videoDir)):
+            mcaName, ext = os.path.splitext(filename)
+            if ext[1:] in VALID_MCA_TYPES:
+                yield videoId, mcaName, ext[1:], os.path.join(videoDir, filename)
+
+
+class MCAUploader(object):
+    """Posts batches of MCAs to /postMCA over a persistent connection."""
+    
+    def __init__(self, url, serverkey):
+        parts = urlparse.urlsplit(url)
+        connection_cls = httplib.HTTPSConnection if parts.scheme == 'https' else httplib.HTTPConnection
+        self.conn = connection_cls(parts.netloc)
+        self.path = parts.path
+        self.serverkey = serverkey
+    
+    def post(self, mcas):
+        serialized_payload = json.dumps({'mcas': mcas})
+        sig = compute_signature(self.serverkey, serialized_payload)
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        body = compressor.compress(serialized_payload) + compressor.flush()
+        headers = {'Content-Type': 'application/json', 'Content-Encoding': 'gzip'}
+        url = '%s?s=%s' % (self.path, urllib.quote_plus(sig))
+        
+        # Retry once in case the server closed the idle connection
+        for attempt in xrange(2):
+            try:
+                self.conn.request('POST', url, body, headers)
+                response = self.conn.getresponse()
+                content = response.read()
+                break
+            except (httplib.HTTPException, socket.error):
+                self.conn.close()
+                if attempt:
+                    raise
+        
+        if response.status != 200:
+            raise IOError('HTTP %d: %s' % (response.status, content))
+        res = json.loads(content)
+        if res.get('ok') != 'ok':
+            raise IOError(content)
+        return res['count']
+
+
+def batch_upload(url, serverkey, options):
+    """Uploads the MCA files in options.directory, returns the number of failed batches and unreadable files."""
+    done = set()
+    if options.state and os.path.exists(options.state):
+        with open(options.state, 'r') as fh:
+            done.update(tuple(line.rstrip('\n').split('\t')) for line in fh)
+    stateFile = open(options.state, 'a') if options.state else None
+    
+    lock = Lock()
+    stats = {'uploaded': 0, 'failed': 0, 'skipped': 0}
+    queue = Queue(options.concurrency * 2)
+    
+    def worker():
+        uploader = MCAUploader(url, serverkey)
+        while True:
+            batch = queue.get()
+            if batch is None:
+                break
+            try:
+                uploader.post(batch)
+            except (IOError, ValueError, httplib.HTTPException, socket.error), e:
+                with lock:
+                    stats['failed'] += 1
+                    print >>sys.stderr, 'Batch of %d MCAs failed: %s' % (len(batch), e)
+                continue
+            with lock:
+                stats['uploaded'] += len(batch)
+                if stateFile is not None:
+                    for mca in batch:
+                        stateFile.write('%s\t%s\n' % (mca['videoId'], mca['mcaName']))
+                    stateFile.flush()
+                print >>sys.stderr, '%d MCAs uploaded' % stats['uploaded']
+    
+    workers = [Thread(target=worker) for _ in xrange(options.concurrency)]
+    for thread in workers:
+        thread.start()
+    
+    # The workers are stopped even if reading the files fails
+    try:
+        batch = []
+        numValues = 0
+        for videoId, mcaName, mcaType, path in find_mca_files(options.directory):
+            if (videoId, mcaName) in done:
+                continue
+            try:
+                mcaData = read_mca_file(path)
+            except (IOError, ValueError), e:
+                stats['skipped'] += 1
+                print >>sys.stderr, 'Skipping %s: %s' % (path, e)
+                continue
+            batch.append({
+                'videoId': videoId,
+                'mcaName': mcaName,
+                'mcaType': mcaType,
+                'mcaData': mcaData,
+                'mcaWeight': options.weight
+            })
+            numValues += len(mcaData)
+            if len(batch) >= options.batch_size or numValues >= BATCH_MAX_VALUES:
+                queue.put(batch)
+                batch = []
+                numValues = 0
+        if batch:
+            queue.put(batch)
+    finally:
+        for thread in workers:
+            queue.put(None)
+        for thread in workers:
+            thread.join()
+        if stateFile is not None:
+            stateFile.close()
+    
+    print >>sys.stderr, 'Done: %d MCAs uploaded, %d batches failed, %d files skipped' % (
+        stats['uploaded'], stats['failed'], stats['skipped'])
+    return stats['failed'] + stats['skipped']
+
 if __name__ == "__main__":
     parser = get_optionparser()
     options, args = parser.parse_args()
     
-    if len(args) == 0:
+    if len(args) == 0 and not options.directory:
         parser.print_help(file = sys.stderr)
         sys.exit(-1)
     
@@ -87,6 +239,13 @@ if __name__ == "__main__":
         print >>sys.stderr, '-s flag is required'
         sys.exit(-3)
     
+    if options.directory:
+        url = options.server
+        if not url.endswith('/'):
+            url += '/'
+        failed = batch_upload(url + 'postMCA', serverkey, options)
+        sys.exit(5 if failed else 0)
+    
     operation = OP_UPLOAD
     videoId, mcaName, mcaType, mcaFile = (args + [None]*4)[:4]
     mcaData = None
@@ -0,0 +1,334 @@
+"""
+Materialized per-video aggregates.
+
+Instead of replaying every interaction session of a video on each request,
+the contribution of each session to the aggregate of its video is kept in a
+single document per video (see Storage.get_video_aggregate):
+
+  {
+    '_id':          videoId,
+    'numSessions':  int,
+    'epoch':        ms,
+    'size':         bytes,
+    'playbacks':    {token: [[start, end], ...]},
+    'likedPoints':  {token: [tc, ...]},
+    'taggedPoints': {token: [[tc, tag], ...]},
+    'changed':      {token: ms},
+    'versions':     {token: int},
+    'sizes':        {token: bytes}
+  }
+
+The playback and points of a session depend on its full (sorted) interaction
+log, so sessions that receive new interactions are recomputed when these are
+stored and their entries folded into the aggregate. An entry is versioned by
+the number of interactions it was computed from, so that a fold racing a
+later one cannot go back. Entries are bounded per session and the entries of
+an aggregate in total (see storage.base.MAX_AGGREGATE_SIZE); sessions that no
+longer fit keep their last entry or, if new, are left out.
+
+`epoch` is the time at which the aggregate was last rebuilt and `changed`
+the time at which each session was last folded. Clients holding the
+aggregate as of some time (a cursor) can thus be sent just the sessions
+changed since (see changes_since), which replace the ones they hold.
+"""
+
+from flask import current_app
+from codec import decode_interactions
+from flaskutil import dumps
+from storage.base import set_aggregate_session
+import heatmap
+import mapreduce
+
+import math
+import random
+import time
+
+# Playback segments kept per session (the most recent ones)
+MAX_SESSION_SEGMENTS = 10000
+
+# Liked and tagged points kept per session (the most recent ones)
+MAX_SESSION_POINTS = 1000
+
+# Changes folded up to this many ms before a cursor are resent, as the
+# clocks of the servers folding sessions may differ
+CURSOR_SLACK = 5000
+
+
+def processInteractionSession(interactions, playbacks, likedPoints, taggedPoints):
+    playback = []
+    curStart = None
+    prev_tick = None
+    prev_last_tc = None
+    prev_ts = None
+    prev_tc = None
+    
+    for curInteraction in sorted(decode_interactions(interactions)):
+        ts, evtType, tc, last_tc = curInteraction
+        if evtType == 'LIKE':
+            likedPoints.append(tc)
+        elif evtType.startswith('TAG_'):
+            tag = evtType[4:]
+            taggedPoints.append( (tc, tag) )
+        
+        elif evtType == 'PLAYING':
+            if curStart is not None:
+                playback.append( (curStart, last_tc) )
+            curStart = tc
+        elif evtType == 'PAUSED':
+            if curStart is not None:
+                playback.append( (curStart, last_tc) )
+                curStart = None
+        
+        # issue 16
+        # Arbitrary factor: 30
+        elif evtType == 'TICK':
+            if prev_ts is not None and prev_tc is not None and (ts-prev_ts)*30 < (tc-prev_tc):
+                # Treat this as a skip and end the current interval
+                if curStart is not None:
+                    playback.append( (curStart, prev_tc) )
+                    curStart = tc
+        
+        prev_ts = ts
+        prev_tc = tc
+        prev_last_tc = last_tc
+    
+    if curStart is not None and prev_last_tc is not None:
+        playback.append( (curStart, prev_last_tc) )
+    
+    # only add non-empty playbacks
+    if playback:
+        playbacks.append(playback)
+
+
+def extractLikesAndTags(interactions):
+    likes = []
+    tags = []
+    for ts, evtType, tc, last_tc in interactions:
+        if evtType == 'LIKE':
+            likes.append(tc)
+        elif evtType.startswith('TAG_'):
+            tag = evtType[4:]
+            tags.append( [tc, tag] )
+    return likes, tags
+
+
+def summarize_session(interactions):
+    """
+    Returns the entry (version, playback, likedPoints, taggedPoints, size)
+    of an interaction session in its video aggregate.
+    """
+    interactions = decode_interactions(interactions)
+    playbacks = []
+    likedPoints = []
+    taggedPoints = []
+    processInteractionSession(interactions, playbacks, likedPoints, taggedPoints)
+    playback = playbacks[0][-MAX_SESSION_SEGMENTS:] if playbacks else []
+    likedPoints = likedPoints[-MAX_SESSION_POINTS:]
+    taggedPoints = [list(point) for point in taggedPoints[-MAX_SESSION_POINTS:]]
+    return len(interactions), playback, likedPoints, taggedPoints, len(dumps([playback, likedPoints, taggedPoints]))
+
+
+def empty_aggregate_object(videoId):
+    return {
+        '_id':          videoId,
+        'numSessions':  0,
+        'epoch':        0,
+        'size':         0,
+        'playbacks':    {},
+        'likedPoints':  {},
+        'taggedPoints': {},
+        'changed':      {},
+        'versions':     {},
+        'sizes':        {}
+    }
+
+
+def liked_points(aggregate):
+    """Returns the liked points of all sessions of an aggregate."""
+    points = aggregate['likedPoints']
+    return [tc for token in sorted(points) for tc in points[token]]
+
+
+def tagged_points(aggregate):
+    """Returns the tagged points of all sessions of an aggregate."""
+    points = aggregate['taggedPoints']
+    return [point for token in sorted(points) for point in points[token]]
+
+
+def on_session_created(videoId, token):
+    current_app.storage.increment_session_count(videoId)
+    current_app.storage.add_to_session_sample(videoId, token, current_app.config['AGGREGATE_SAMPLE_SIZE'])
+    current_app.response_cache.invalidate(videoId)
+
+
+def apply_interaction_updates(videoUpdates):
+    """
+    Recomputes the sessions that received new interactions and folds their
+    entries into the aggregates of their videos in bulk. Doing so again is
+    harmless, as entries are recomputed from all interactions of a session.
+    
+    videoUpdates: {videoId: tokens}
+    """
+    if not videoUpdates:
+        return
+    
+    tokens = [token for sessionTokens in videoUpdates.itervalues() for token in sessionTokens]
+    sessions = {}
+    for interactionSession in current_app.storage.get_interaction_sessions(tokens):
+        entry = summarize_session(interactionSession['interactions'])
+        sessions.setdefault(interactionSession['videoId'], {})[interactionSession['_id']] = entry
+    current_app.storage.fold_aggregate_sessions(sessions, int(time.time() * 1000))
+    current_app.storage.mark_highlights_stale(videoUpdates.keys())
+    
+    for videoId in videoUpdates:
+        current_app.response_cache.invalidate(videoId)
+
+
+def is_built(aggregate):
+    """Whether a stored aggregate is built (not a stub of increment_session_count)."""
+    return aggregate is not None and bool(aggregate.get('epoch')) and 'versions' in aggregate
+
+
+def get_video_aggregate(videoId):
+    aggregate = current_app.storage.get_video_aggregate(videoId)
+    if not is_built(aggregate):
+        return rebuild_video_aggregate(videoId)
+    return aggregate
+
+
+def get_video_aggregates(videoIds):
+    """Like get_video_aggregate for several videos, read with a single query: {videoId: aggregate}."""
+    stored = current_app.storage.get_video_aggregates(videoIds)
+    
+    res = {}
+    for videoId in videoIds:
+        aggregate = stored.get(videoId)
+        res[videoId] = aggregate if is_built(aggregate) else rebuild_video_aggregate(videoId)
+    return res
+
+
+def aggregate_sessions(interactionSessions, aggregate):
+    """Adds interaction sessions to an aggregate and returns it."""
+    for interactionSession in interactionSessions:
+        aggregate['numSessions'] += 1
+        entry = summarize_session(interactionSession['interactions'])
+        set_aggregate_session(aggregate, interactionSession['_id'], aggregate['epoch'], *entry)
+    return aggregate
+
+
+def merge_aggregates(aggregate, partial):
+    """Adds a partial aggregate (of other sessions) to an aggregate."""
+    aggregate['numSessions'] += partial['numSessions']
+    for token, version in partial['versions'].iteritems():
+        set_aggregate_session(aggregate, token, aggregate['epoch'], version,
+                              partial['playbacks'].get(token, []), partial['likedPoints'].get(token, []),
+                              partial['taggedPoints'].get(token, []), partial['sizes'][token])
+
+
+def rebuild_video_aggregate(videoId):
+    aggregate = empty_aggregate_object(videoId)
+    previous = current_app.storage.get_video_aggregate(videoId)
+    aggregate['epoch'] = max(int(time.time() * 1000), previous.get('epoch', 0) + 1 if previous else 0)
+    
+    pool = current_app.aggregate_pool
+    if pool is None or not mapreduce.rebuild(pool, aggregate):
+        aggregate_sessions(current_app.storage.find_interaction_sessions(videoId), aggregate)
+    
+    aggregate['changed'] = dict( (token, aggregate['epoch']) for token in aggregate['versions'] )
+    current_app.storage.save_video_aggregate(aggregate)
+    current_app.storage.mark_highlights_stale([videoId])
+    current_app.response_cache.invalidate(videoId)
+    return aggregate
+
+
+def cursor(videoAggregate):
+    """Returns the cursor of (the current state of) an aggregate."""
+    return max([videoAggregate['epoch']] + videoAggregate['changed'].values())
+
+
+def changes_since(videoAggregate, since):
+    """
+    Returns the tokens of the sessions changed after cursor `since` (and
+    some before, see CURSOR_SLACK), or None if the changes are not known
+    (e.g., since the aggregate was rebuilt).
+    """
+    if not since or since < videoAggregate['epoch']:
+        return None
+    return set( token for token, changed in videoAggregate['changed'].iteritems() if changed > since - CURSOR_SLACK )
+
+
+def get_session_sample(videoId):
+    """
+    Returns the uniform random sample of at most AGGREGATE_SAMPLE_SIZE
+    sessions kept per video: {'_id': videoId, 'n': numSessions, 'tokens'}.
+    Sessions created later are added by reservoir sampling; missing samples
+    are drawn from all sessions of the video.
+    """
+    storage = current_app.storage
+    sample = storage.get_session_sample(videoId)
+    if sample is None:
+        ids = storage.find_interaction_session_ids(videoId)
+        size = current_app.config['AGGREGATE_SAMPLE_SIZE']
+        sample = {'_id': videoId, 'n': len(ids), 'tokens': random.sample(ids, min(size, len(ids)))}
+        storage.save_session_sample(sample)
+    return sample
+
+
+def sample_video_aggregate(videoId, sampleSize):
+    """
+    Aggregates (at most) `sampleSize` sessions of the session sample of a
+    video. The result reports the true numSessions and the `sampleSize` used.
+    """
+    sample = get_session_sample(videoId)
+    tokens = [token for token in sample['tokens'] if token is not None]
+    if sampleSize < len(tokens):
+        # Seeded, such that the same sample is used as long as it is unchanged
+        tokens = random.Random(videoId).sample(tokens, sampleSize)
+    
+    aggregate = aggregate_sessions(current_app.storage.get_interaction_sessions(tokens), empty_aggregate_object(videoId))
+    aggregate['sampleSize'] = aggregate['numSessions']
+    aggregate['numSessions'] = max(sample['n'], aggregate['sampleSize'])
+    return aggregate
+
+
+def delete_video_aggregate(videoId):
+    current_app.storage.delete_video_aggregate(videoId)
+    current_app.storage.mark_highlights_stale([videoId])
+    current_app.response_cache.invalidate(videoId)
+
+
+def observed_duration(videoAggregate):
+    """Number of seconds up to and including the last second observed in a video aggregate."""
+    timecodes = [end for playback in videoAggregate['playbacks'].itervalues() for _, end in playback]
+    timecodes.extend(liked_points(videoAggregate))
+    timecodes.extend(tc for tc, _ in tagged_points(videoAggregate))
+    return math.floor(max(timecodes)) + 1 if timecodes else 0
+
+
+def bin_video_aggregate(videoAggregate, bins, duration=None):
+    """
+    Folds a video aggregate into `bins` fixed-size bins spanning `duration`
+    seconds (by default: up to and including the last observed second). Returns the
+    playback coverage curve and the number of likes and tags per bin.
+    """
+    intervals = [segment for playback in videoAggregate['playbacks'].values() for segment in playback]
+    likedPoints = liked_points(videoAggregate)
+    taggedPoints = tagged_points(videoAggregate)
+    
+    if duration is None:
+        duration = observed_duration(videoAggregate)
+    binWidth = float(duration) / bins if duration > 0 else 1.0
+    
+    pointsPerTag = {}
+    for tc, tag in taggedPoints:
+        pointsPerTag.setdefault(tag, []).append(tc)
+    
+    return {
+        'bins': bins,
+        'binWidth': binWidth,
+        'duration': duration,
+        'playbackCurve': heatmap.coverage_histogram(intervals, bins, binWidth).astype(int).tolist(),
+        'likeCounts': heatmap.point_histogram(likedPoints, bins, binWidth).tolist(),
+        'tagCounts': dict((tag, heatmap.point_histogram(points, bins, binWidth).tolist())
+                          for tag, points in pointsPerTag.iteritems())
+    }
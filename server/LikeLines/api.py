@@ -2,79 +2,81 @@
 Core API Blueprints. 
 """
 
-from flask import Blueprint, current_app, jsonify, request
-from flask import Response
-from flaskutil import jsonp, crossdomain, p3p
-from pymongo.errors import DuplicateKeyError
+from flask import Blueprint, current_app, request
+from flaskutil import api_response, jsonify, json_response, dumps, make_etag, not_modified
+from flaskutil import stream_response, ndjson_chunks, json_array_chunks, read_body
 
-from usersession import get_session_id, get_serverside_session
+from usersession import get_session_id, get_user_likes, get_user_likes_many
+from usersession import remember_interaction_session, get_interaction_session_owner
 from tokengen import generate_unique_token
-from secretkey import compute_signature
+from secretkey import compute_signature, new_signature, finish_signature
+from aggregates import processInteractionSession
+from cache import response_entry
+from codec import encode_interactions, decode_interactions, decoded_session
+import aggregates
+import heatmap
+import highlights
+import ingest
 
 import json
+import math
+import tempfile
+
+# Bulk uploads are read in chunks of this many bytes and inserted in batches
+UPLOAD_CHUNK_SIZE = 64*1024
+UPLOAD_BATCH_SIZE = 1000
+# Bound the number of skipped _ids listed in an upload report
+MAX_REPORTED_IDS = 1000
 
 blueprint = Blueprint('api', __name__)
 
 
+def bad_request(message):
+    resp = jsonify({'error': message})
+    resp.status_code = 400
+    return resp
+
+
 @blueprint.route('/createSession')
-@crossdomain()
-@p3p
-@jsonp
+@api_response()
 def LL_create_session():
     token = generate_unique_token()
     videoId = request.args.get('videoId')
     ts = request.args.get('ts')
     session_id = get_session_id()
     
-    mongo = current_app.mongo
-    mongo.db.interactionSessions.insert({
+    current_app.storage.create_interaction_session({
         '_id': token,
         'videoId': videoId,
         'ts': ts,
         'interactions': [],
+        'numInteractions': 0,
+        'seq': 0,
         'userSession': session_id
     })
-    mongo.db.interactionSessions.ensure_index('videoId')
-    mongo.db.interactionSessions.ensure_index('userSession')
+    remember_interaction_session(token, videoId, session_id)
+    aggregates.on_session_created(videoId, token)
     
     return jsonify({'token': token})
 
 
 @blueprint.route('/sendInteractions')
-@crossdomain()
-@p3p
-@jsonp
+@api_response()
 def LL_send_interactions():
-    mongo = current_app.mongo
     error = None
     session_id = get_session_id()
     token = request.args.get('token')
-    interactionSession = mongo.db.interactionSessions.find_one({'_id': token})
-    if interactionSession:
-        if interactionSession['userSession'] == session_id:
-            interactions = json.loads( request.args.get('interactions') )
-            mongo.db.interactionSessions.update({'_id': token}, {
-                '$pushAll': {'interactions': interactions}
-            })
-            
-            likes = []
-            tags = []
-            for ts, evtType, tc, last_tc in interactions:
-                if evtType == 'LIKE':
-                    likes.append(tc)
-                elif evtType.startswith('TAG_'):
-                    tag = evtType[4:]
-                    tags.append( [tc, tag] )
-            
-            if likes:
-                mongo.db.userSessions.update({'_id': session_id}, {
-                    '$pushAll': {'likes.%s' % (interactionSession['videoId']): likes}
-                })
-            
-            if tags:
-                mongo.db.userSessions.update({'_id': session_id}, {
-                    '$pushAll': {'tags.%s' % (interactionSession['videoId']): tags}
-                })
+    owner = get_interaction_session_owner(token)
+    if owner:
+        videoId, userSession = owner
+        if userSession == session_id:
+            try:
+                interactions = json.loads( request.args.get('interactions') )
+                ingest.validate_interactions(interactions)
+            except (ValueError, TypeError), e:
+                return bad_request('malformed interactions: %s' % e)
+            seq = request.args.get('seq', type=int)
+            ingest.submit(token, videoId, session_id, interactions, seq)
             
         else:
             error = 403
@@ -83,92 +85,371 @@ def LL_send_interactions():
     
     return jsonify({'ok': 'ok'} if not error else {'error': error})
 
+@blueprint.route('/postInteractions', methods=['POST', 'OPTIONS'])
+@api_response(headers=['Content-Type', 'Content-Encoding'], credentials=True)
+def LL_post_interactions():
+    """
+    Batched alternative to /sendInteractions for clients that support CORS:
+    a (gzip or deflate compressed) JSON body with the interactions of one or
+    more interaction sessions of the user:
+    
+      {"batches": [{"token": token, "seq": seq, "interactions": [...]}, ...]}
+    
+    The optional seq numbers the batches of a session (from 1), such that a
+    batch that is sent again is only applied once. Returns {"ok": "ok"},
+    plus {"errors": {token: 403|404}} for batches of sessions that are
+    unknown or belong to another user.
+    """
+    try:
+        payload = json.loads(read_body(current_app.config['MAX_BATCH_BODY_SIZE']))
+        batches = [(batch['token'], batch['interactions'], batch.get('seq')) for batch in payload['batches']]
+        for _, interactions, _ in batches:
+            ingest.validate_interactions(interactions)
+        if not all(seq is None or isinstance(seq, (int, long)) for _, _, seq in batches):
+            raise TypeError('seq must be an integer')
+    except (ValueError, KeyError, TypeError), e:
+        return bad_request('malformed batch: %s' % e)
+    
+    session_id = get_session_id()
+    errors = {}
+    for token, interactions, seq in batches:
+        owner = get_interaction_session_owner(token)
+        if not owner:
+            errors[token] = 404
+        elif owner[1] != session_id:
+            errors[token] = 403
+        else:
+            ingest.submit(token, owner[0], session_id, interactions, seq)
+    
+    res = {'ok': 'ok'}
+    if errors:
+        res['errors'] = errors
+    return jsonify(res)
+
+
+
+def number_param(params, name, type, maximum=float('inf'), allowZero=False):
+    """
+    Returns the value of an optional number parameter (a query argument or a
+    member of a JSON object) or None. Raises ValueError if it is malformed or
+    not in (0, maximum], or [0, maximum] if `allowZero`.
+    """
+    value = params.get(name)
+    if value is None:
+        return None
+    try:
+        value = type(value)
+    except (TypeError, ValueError):
+        raise ValueError('%s must be a number' % name)
+    # Also rejects nan
+    if not (0 <= value if allowZero else 0 < value) or not value <= maximum:
+        raise ValueError('%s out of range' % name)
+    return value
+
+def aggregate_params(params):
+    """
+    Returns the (bins, duration, width, sample, since) parameters of
+    /aggregate and /aggregateMany. Raises ValueError if any is invalid.
+    """
+    config = current_app.config
+    bins = number_param(params, 'bins', int, config['MAX_AGGREGATE_BINS'])
+    duration = number_param(params, 'duration', float, config['MAX_HEATMAP_DURATION'])
+    width = number_param(params, 'width', int, config['MAX_HEATMAP_WIDTH'])
+    sampleSize = number_param(params, 'sample', int)
+    since = number_param(params, 'since', int, allowZero=True)
+    if since is not None and bins is not None:
+        raise ValueError('since cannot be combined with bins')
+    if since is not None and sampleSize is not None:
+        raise ValueError('since cannot be combined with sample')
+    return bins, duration, width, sampleSize, since
+
+def check_video_ids(videoIds):
+    if not 0 < len(videoIds) <= current_app.config['MAX_AGGREGATE_VIDEOS']:
+        raise ValueError('number of videoIds out of range')
 
 
 @blueprint.route('/aggregate')
-@crossdomain()
-@p3p
-@jsonp
+@api_response()
 def LL_aggregate():
-    userSession = get_serverside_session()
     videoId = request.args.get('videoId')
     
-    numSessions = 0
-    playbacks = []
+    try:
+        bins, duration, width, sampleSize, since = aggregate_params(request.args)
+    except ValueError, e:
+        return bad_request(str(e))
+    
+    # Curve MCAs are served at the stored resolution closest to the width
+    level = heatmap.mca_level(width)
+    
+    # Approximate aggregate of a sample of (at most) this many sessions
+    maxSampleSize = current_app.config['AGGREGATE_SAMPLE_SIZE']
+    approxMinSessions = current_app.config['AGGREGATE_APPROX_MIN_SESSIONS']
+    
+    myLikes = get_user_likes(videoId)
+    
+    if sampleSize is not None:
+        sampleSize = min(sampleSize, maxSampleSize)
+        return cached_video_response(videoId, ('aggregate', bins, duration, level, 'sample', sampleSize), myLikes,
+                                     compute_sampled_aggregate, videoId, bins, duration, level, sampleSize)
+    if approxMinSessions and since is None:
+        # Whether to approximate is decided on a cache miss and cached with
+        # the response
+        return cached_video_response(videoId, ('aggregate', bins, duration, level, 'auto'), myLikes,
+                                     compute_auto_aggregate, videoId, bins, duration, level,
+                                     maxSampleSize, approxMinSessions)
+    # Responses to a cursor (other than 0) are not cached, as cursors vary
+    # per client and would crowd out the shared variants
+    variant = ('aggregate', bins, duration, level, since) if not since else None
+    return cached_video_response(videoId, variant, myLikes,
+                                 compute_aggregate, videoId, bins, duration, level, since)
+
+def compute_aggregate(videoId, bins=None, duration=None, level=None, since=None):
+    return aggregate_response(aggregates.get_video_aggregate(videoId), getMCAFromDB(videoId, level), bins, duration, since)
+
+def compute_auto_aggregate(videoId, bins, duration, level, sampleSize, approxMinSessions):
+    if aggregates.get_session_sample(videoId)['n'] >= approxMinSessions:
+        return compute_sampled_aggregate(videoId, bins, duration, level, sampleSize)
+    return compute_aggregate(videoId, bins, duration, level)
+
+def compute_sampled_aggregate(videoId, bins, duration, level, sampleSize):
+    return aggregate_response(aggregates.sample_video_aggregate(videoId, sampleSize), getMCAFromDB(videoId, level),
+                              bins, duration)
+
+def aggregate_response(videoAggregate, mca, bins=None, duration=None, since=None):
+    """
+    Computes the aggregate response of a video. If a `since` cursor is given
+    (0 for a full response), playbacks and liked and tagged points are keyed
+    by session token and a new `cursor` is returned. If `delta` is true, the
+    response only contains the sessions changed since the cursor, which
+    replace those held by the client (null playbacks are removed).
+    
+    For an aggregate of a sample of sessions, the `sampleSize` and the
+    `scale` (numSessions / sampleSize) are reported. Binned counts are
+    scaled to all sessions; playbacks and points are those of the sample.
+    """
     seeks = None
-    mca = None
-    likedPoints = []
-    taggedPoints = []
-    
-    myLikes = userSession['likes'].get(videoId, [])
-    
-    for interactionSession in current_app.mongo.db.interactionSessions.find({'videoId': videoId}):
-        numSessions += 1
-        processInteractionSession(interactionSession['interactions'], playbacks, likedPoints, taggedPoints)
-    
-    mca = getMCAFromDB(videoId)
-    
-    aggregate = dict(numSessions=numSessions, playbacks=playbacks, seeks=seeks, mca=mca, likedPoints = likedPoints, myLikes=myLikes, taggedPoints=taggedPoints)
-    return jsonify(aggregate)
-
-def processInteractionSession(interactions, playbacks, likedPoints, taggedPoints):
-    playback = []
-    curStart = None
-    prev_tick = None
-    prev_last_tc = None
-    prev_ts = None
-    prev_tc = None
-    
-    for curInteraction in sorted(interactions):
-        ts, evtType, tc, last_tc = curInteraction
-        if evtType == 'LIKE':
-            likedPoints.append(tc)
-        elif evtType.startswith('TAG_'):
-            tag = evtType[4:]
-            taggedPoints.append( (tc, tag) )
-            
-        elif evtType == 'PLAYING':
-            if curStart is not None:
-                playback.append( (curStart, last_tc) )
-            curStart = tc
-        elif evtType == 'PAUSED':
-            if curStart is not None:
-                playback.append( (curStart, last_tc) )
-                curStart = None
-        
-        # issue 16
-        # Arbitrary factor: 30
-        elif evtType == 'TICK':
-            if prev_ts is not None and prev_tc is not None and (ts-prev_ts)*30 < (tc-prev_tc):
-                # Treat this as a skip and end the current interval
-                if curStart is not None:
-                    playback.append( (curStart, prev_tc) )
-                    curStart = tc
-        
-        prev_ts = ts
-        prev_tc = tc
-        prev_last_tc = last_tc
-    
-    if curStart is not None and prev_last_tc is not None:
-        playback.append( (curStart, prev_last_tc) )
-    
-    # only add non-empty playbacks
-    if playback:
-        playbacks.append(playback)
-
-
-def getMCAFromDB(videoId):
-    mongo = current_app.mongo
-    mca = mongo.db.mca.find_one({'_id': videoId})
-    if mca:
-        del mca['_id']
-        for key in mca.keys():
-            if key.startswith('mca-'):
-                mca[key[4:]] = mca.pop(key)
+    numSessions = videoAggregate['numSessions']
+    
+    if 'sampleSize' in videoAggregate:
+        sampleAggregate = dict(videoAggregate)
+        sampleSize = sampleAggregate.pop('sampleSize')
+        scale = float(numSessions) / sampleSize if sampleSize else 0.0
+        aggregate = aggregate_response(dict(sampleAggregate, numSessions=sampleSize), mca, bins, duration)
+        aggregate.update(numSessions=numSessions, sampleSize=sampleSize, scale=scale)
+        if bins is not None:
+            aggregate['playbackCurve'] = [round(count * scale, 2) for count in aggregate['playbackCurve']]
+            aggregate['likeCounts'] = [round(count * scale, 2) for count in aggregate['likeCounts']]
+            for tag, counts in aggregate['tagCounts'].iteritems():
+                aggregate['tagCounts'][tag] = [round(count * scale, 2) for count in counts]
+        return aggregate
+    
+    if bins is not None:
+        aggregate = aggregates.bin_video_aggregate(videoAggregate, bins, duration)
+        aggregate.update(numSessions=numSessions, seeks=seeks, mca=mca)
+        return aggregate
+    
+    if since is None:
+        playbacks = videoAggregate['playbacks'].values()
+        likedPoints = aggregates.liked_points(videoAggregate)
+        taggedPoints = aggregates.tagged_points(videoAggregate)
+        return dict(numSessions=numSessions, playbacks=playbacks, seeks=seeks, mca=mca, likedPoints = likedPoints, taggedPoints=taggedPoints)
+    
+    aggregate = dict(numSessions=numSessions, seeks=seeks, mca=mca, cursor=aggregates.cursor(videoAggregate))
+    tokens = aggregates.changes_since(videoAggregate, since)
+    if tokens is None:
+        aggregate.update(delta=False, playbacks=videoAggregate['playbacks'],
+                         likedPoints=videoAggregate['likedPoints'], taggedPoints=videoAggregate['taggedPoints'])
+    else:
+        aggregate.update(delta=True,
+                         playbacks=dict( (token, videoAggregate['playbacks'].get(token)) for token in tokens ),
+                         likedPoints=dict( (token, videoAggregate['likedPoints'].get(token, [])) for token in tokens ),
+                         taggedPoints=dict( (token, videoAggregate['taggedPoints'].get(token, [])) for token in tokens ))
+    return aggregate
+
+
+@blueprint.route('/aggregateMany', methods=['GET', 'POST', 'OPTIONS'])
+@api_response(headers=['Content-Type', 'Content-Encoding'], credentials=True)
+def LL_aggregate_many():
+    """
+    Aggregates of several videos (e.g., of a playlist) in one response:
+    {"aggregates": {videoId: aggregate}}, with each aggregate as returned by
+    /aggregate. Takes videoIds (comma-separated), bins, duration and width as
+    query parameters or as a (compressed) JSON body of a POST request:
+    
+      {"videoIds": [...], "bins": ..., "duration": ..., "width": ...}
+    """
+    if request.method == 'POST':
+        try:
+            params = json.loads(read_body(current_app.config['MAX_BATCH_BODY_SIZE']))
+            videoIds = [unicode(videoId) for videoId in params['videoIds']]
+        except (ValueError, KeyError, TypeError), e:
+            return bad_request('malformed request: %s' % e)
     else:
-        mca = {}
+        params = request.args
+        videoIds = filter(None, request.args.get('videoIds', '').split(','))
+    
+    # Duplicates would be reported once
+    videoIds = sorted(set(videoIds))
+    try:
+        check_video_ids(videoIds)
+        bins, duration, width, _, _ = aggregate_params(params)
+    except ValueError, e:
+        return bad_request(str(e))
+    level = heatmap.mca_level(width)
+    
+    myLikes = get_user_likes_many(videoIds)
+    
+    variant = ('aggregate', bins, duration, level, None)
+    ingest.expire_applied_responses()
+    cache = current_app.response_cache
+    entries = dict( (videoId, cache.get(videoId, variant)) for videoId in videoIds )
+    missing = [videoId for videoId, entry in entries.iteritems() if entry is None]
+    if missing:
+        generations = dict( (videoId, cache.generation(videoId)) for videoId in missing )
+        videoAggregates = aggregates.get_video_aggregates(missing)
+        mcas = current_app.storage.get_mcas(missing)
+        for videoId in missing:
+            entries[videoId] = cache.set(videoId, variant,
+                                         aggregate_response(videoAggregates[videoId],
+                                                            heatmap.select_mca_level(mcas[videoId], level),
+                                                            bins, duration),
+                                         generations[videoId])
+    
+    etag = make_etag(*[part for videoId in videoIds for part in (videoId, entries[videoId][0], myLikes[videoId])])
+    resp = not_modified(etag)
+    if resp is None:
+        parts = ['{"aggregates":{']
+        for i, videoId in enumerate(videoIds):
+            parts.extend([',' if i else '', dumps(videoId), ':{"myLikes":', dumps(myLikes[videoId]), ',',
+                          entries[videoId][1]])
+        parts.append('}}')
+        resp = json_response(parts, etag)
+    return resp
+
+
+@blueprint.route('/heatmap')
+@api_response()
+def LL_heatmap():
+    videoId = request.args.get('videoId')
+    
+    try:
+        width = number_param(request.args, 'width', int, current_app.config['MAX_HEATMAP_WIDTH'])
+        duration = number_param(request.args, 'duration', float, current_app.config['MAX_HEATMAP_DURATION'])
+        if width is None or duration is None:
+            raise ValueError('width and duration are required numbers')
+        bandwidth = number_param(request.args, 'bandwidth', float)
+        if bandwidth is None:
+            bandwidth = heatmap.DEFAULT_BANDWIDTH
+        kernel = request.args.get('kernel', heatmap.DEFAULT_KERNEL)
+        if kernel not in heatmap.KERNELS:
+            raise ValueError('unknown kernel: %s' % kernel)
+        heatmapWeights = json.loads(request.args.get('weights', '{}'))
+        if not isinstance(heatmapWeights, dict) or not all(map(is_finite_number, heatmapWeights.itervalues())):
+            raise ValueError('weights must be an object of numbers')
+    except ValueError, e:
+        return bad_request(str(e))
+    
+    myLikes = get_user_likes(videoId)
     
-    return mca
+    variant = ('heatmap', width, duration, kernel, bandwidth, json.dumps(heatmapWeights, sort_keys=True))
+    return cached_video_response(videoId, variant, myLikes,
+                                 compute_heatmap, videoId, width, duration, kernel, bandwidth, heatmapWeights)
+
+def is_finite_number(value):
+    return isinstance(value, (int, long, float)) and not isinstance(value, bool) \
+           and not math.isinf(value) and not math.isnan(value)
+
+def compute_heatmap(videoId, width, duration, kernel, bandwidth, heatmapWeights):
+    videoAggregate = aggregates.get_video_aggregate(videoId)
+    playback = heatmap.playback_curve(videoAggregate['playbacks'].values(), duration)
+    mca = getMCAFromDB(videoId, heatmap.mca_level(width))
+    
+    values = heatmap.compute_heatmap(width, duration, aggregates.liked_points(videoAggregate), playback, None, mca,
+                                     kernel, bandwidth, heatmapWeights)
+    
+    return {
+        'numSessions': videoAggregate['numSessions'],
+        'heatmap': [round(x, 3) for x in values]
+    }
+
+
+@blueprint.route('/highlights')
+@api_response()
+def LL_highlights():
+    """
+    Top segments of a video (videoId): {"numSessions", "duration", "stale",
+    "segments": [{"start", "end", "peak", "score", "views", "likes"}, ...]},
+    or across several videos (videoIds, comma-separated): {"segments": [...]},
+    with the videoId of each segment. Segments are ranked by `sort`: score,
+    views or likes (by default: score for a single video and views across
+    videos, as scores are relative to their video). Returns at most `k`
+    segments (by default: HIGHLIGHTS_K).
+    """
+    videoId = request.args.get('videoId')
+    videoIds = sorted(set(filter(None, request.args.get('videoIds', '').split(','))))
+    sort = request.args.get('sort', 'score' if videoId else 'views')
+    try:
+        if not videoId:
+            check_video_ids(videoIds)
+        k = number_param(request.args, 'k', int)
+        if k is None:
+            k = current_app.config['HIGHLIGHTS_K']
+        if sort not in highlights.SORT_KEYS:
+            raise ValueError('unknown sort: %s' % sort)
+    except ValueError, e:
+        return bad_request(str(e))
+    
+    if videoId:
+        videoHighlights = {videoId: highlights.get_highlights(videoId)}
+    else:
+        videoHighlights = highlights.get_highlights_many(videoIds)
+    
+    etag = make_etag(*[part for curVideoId in sorted(videoHighlights)
+                       for part in (curVideoId, videoHighlights[curVideoId]['ts'], videoHighlights[curVideoId].get('stale', False))])
+    resp = not_modified(etag)
+    if resp is None:
+        if videoId:
+            cur = videoHighlights[videoId]
+            segments = sorted(cur['segments'], key=lambda segment: (segment[sort], segment['score']), reverse=True)
+            resp = jsonify({
+                'numSessions': cur['numSessions'],
+                'duration': cur['duration'],
+                'stale': cur.get('stale', False),
+                'segments': segments[:k]
+            })
+        else:
+            resp = jsonify({'segments': highlights.top_segments(videoHighlights, k, sort)})
+        resp.set_etag(etag)
+    return resp
+
+
+def cached_video_response(videoId, variant, myLikes, compute, *args):
+    """
+    Serves the user-independent part of a video response from the response
+    cache (computing it with `compute(*args)` on a miss, or always for a
+    variant of None), adds the user's own likes and answers conditional
+    requests.
+    """
+    if variant is None:
+        entry = response_entry(compute(*args))
+    else:
+        ingest.expire_applied_responses()
+        cache = current_app.response_cache
+        entry = cache.get(videoId, variant)
+        if entry is None:
+            generation = cache.generation(videoId)
+            entry = cache.set(videoId, variant, compute(*args), generation)
+    videoEtag, members = entry
+    
+    etag = make_etag(videoEtag, myLikes)
+    resp = not_modified(etag)
+    if resp is None:
+        resp = json_response(['{"myLikes":', dumps(myLikes), ',', members], etag)
+    return resp
+
+
+def getMCAFromDB(videoId, level=None):
+    return heatmap.select_mca_level(current_app.storage.get_mca(videoId), level)
                 
 
 @blueprint.route('/testKey', methods=['POST'])
@@ -192,8 +473,13 @@ def LL_testKey():
 
 @blueprint.route('/postMCA', methods=['POST'])
 def LL_postMCA():
+    """
+    Sets or deletes the MCA of a video. A batch of MCAs of several videos is
+    applied in one bulk write: {"mcas": [{"videoId": ..., "mcaName": ...,
+    ...}, ...]}. The signature is computed over the (decompressed) body.
+    """
     try:
-        raw_data = request.data
+        raw_data = read_body(current_app.config['MAX_MCA_BODY_SIZE'])
         key = current_app.secret_key
         their_sig = request.args.get('s')
         our_sig = compute_signature(key, raw_data)
@@ -207,42 +493,60 @@ def LL_postMCA():
         
         data = json.loads(raw_data)
         
-        videoId = data['videoId'] # string
-        mcaName = data['mcaName'] # string
+        storage = current_app.storage
+        if 'mcas' in data:
+            try:
+                updates = [parse_mca_update(item) for item in data['mcas']]
+            except (KeyError, TypeError), e:
+                return jsonify({'error': 'malformed batch: %s' % e})
+            storage.update_mcas(updates)
+            videoIds = list(set(videoId for videoId, _, _ in updates))
+            storage.mark_highlights_stale(videoIds)
+            for videoId in videoIds:
+                current_app.response_cache.invalidate(videoId)
+            return jsonify({'ok': 'ok', 'count': len(updates)})
         
-        delete = data.get('delete', False) == True
+        videoId, mcaName, mca = parse_mca_update(data)
+        if mca is not None:
+            storage.set_mca(videoId, mcaName, mca)
+        else:
+            storage.delete_mca(videoId, mcaName)
         
-        mongo = current_app.mongo
-        if not delete:
-            mcaType = data['mcaType'] # "curve" | "point"
-            mcaData = data['mcaData'] # double[]
-            mcaWeight = data.get('mcaWeight', 1.0)
-            
-            mongo.db.mca.update({'_id': videoId}, {'$set': {
-                'mca-%s' % mcaName: {
-                    'type': mcaType,
-                    'data': mcaData,
-                    'weight': mcaWeight
-                }
-            }}, True)
-            mongo.db.interactionSessions.ensure_index('mca')
+        storage.mark_highlights_stale([videoId])
+        current_app.response_cache.invalidate(videoId)
         
-        else:
-            mongo.db.mca.update({'_id': videoId}, {'$unset': {
-                'mca-%s' % mcaName: ""
-            }})
-            
         
         return jsonify({'ok': 'ok'}) 
         
     except ValueError, e:
         return jsonify({'error': e.message})
 
+def parse_mca_update(data):
+    """Returns (videoId, mcaName, mca) of a /postMCA request, mca is None to delete."""
+    videoId = data['videoId'] # string
+    mcaName = data['mcaName'] # string
+    
+    delete = data.get('delete', False) == True
+    if delete:
+        return videoId, mcaName, None
+    
+    mcaType = data['mcaType'] # "curve" | "point"
+    mcaData = data['mcaData'] # double[]
+    mcaWeight = data.get('mcaWeight', 1.0)
+    mcaData, mcaLevels = heatmap.mca_pyramid(mcaType, mcaData)
+    
+    return videoId, mcaName, {
+        'type': mcaType,
+        'data': mcaData,
+        'levels': mcaLevels,
+        'weight': mcaWeight
+    }
+
 
 @blueprint.route('/adminInteractions', methods=['POST'])
 def LL_adminInteractions():
-    def jsonify2(x):
-        return jsonify(x) if isinstance(x, dict) else Response(json.dumps(x, indent=2),  mimetype='application/json')
+    if request.mimetype == 'application/x-ndjson':
+        return bulk_upload_interactions()
     
     try:
         raw_data = request.data
@@ -260,32 +564,32 @@ def LL_adminInteractions():
         data = json.loads(raw_data)
         
         videoId = data['videoId'] # string
-        cmd = data['cmd'].lower() # "download" | "upload" | "delete"
+        cmd = data['cmd'].lower() # "download" | "upload" | "delete" | "rebuild"
         interactionSessions = data.get('data') # json? 
         
-        mongo = current_app.mongo
+        storage = current_app.storage
         
         res = None
         if cmd == 'download':
-            res = []
-            for interactionSession in mongo.db.interactionSessions.find({'videoId': videoId}):
-                res.append(interactionSession)
+            # Streamed in _id order; resumable with 'after': <last _id>
+            sessions = (decoded_session(s) for s in storage.scan('interactionSessions', videoId, data.get('after')))
+            if data.get('format') == 'ndjson':
+                return stream_response(ndjson_chunks(sessions), 'application/x-ndjson')
+            return stream_response(json_array_chunks(sessions), 'application/json')
         
         elif cmd == 'upload':
-            dups = []
             wrongid = []
+            sessions = []
             
             for interactionSession in interactionSessions:
                 _id = interactionSession['_id']
                 if interactionSession['videoId'] != videoId:
                     wrongid.append(_id)
                     continue
-                
-                try:
-                    mongo.db.interactionSessions.insert(interactionSession)
-                except DuplicateKeyError:
-                    dups.append(_id)
-                    
+                sessions.append(encoded_session(interactionSession))
+            
+            dups = storage.insert_interaction_sessions(sessions)
+            
             res = {'ok': 'ok'}
             if dups or wrongid:
                 res['skipped'] = {}
@@ -293,13 +597,108 @@ def LL_adminInteractions():
                     res['skipped']['duplicates'] = dups
                 if wrongid:
                     res['skipped']['wrong_videoid'] = wrongid
+            
+            aggregates.rebuild_video_aggregate(videoId)
         
         elif cmd == 'delete':
-            mongo.db.interactionSessions.remove({'videoId': videoId})
+            storage.delete_interaction_sessions(videoId)
+            aggregates.delete_video_aggregate(videoId)
             res = {'ok': 'ok'}
         
-        return jsonify2(res)
+        elif cmd == 'rebuild':
+            videoAggregate = aggregates.rebuild_video_aggregate(videoId)
+            res = {'ok': 'ok', 'numSessions': videoAggregate['numSessions']}
+        
+        return jsonify(res)
         
     except ValueError, e:
         return jsonify({'error': e.message})
 
+
+def bulk_upload_interactions():
+    """
+    Bulk upload of a streamed NDJSON body: a {"videoId": ..., "cmd": "upload"}
+    header line followed by one interaction session per line.
+    
+    The body is spooled to a temporary file while its signature is computed,
+    such that nothing is inserted before the signature has been verified.
+    Sessions inserted before a malformed line are kept.
+    """
+    spool = tempfile.TemporaryFile()
+    numInserted = 0
+    try:
+        maxSize = current_app.config['MAX_UPLOAD_BODY_SIZE']
+        size = 0
+        mac = new_signature(current_app.secret_key)
+        for chunk in iter(lambda: request.stream.read(UPLOAD_CHUNK_SIZE), ''):
+            size += len(chunk)
+            if size > maxSize:
+                return jsonify({'error': 'body exceeds %d bytes' % maxSize})
+            mac.update(chunk)
+            spool.write(chunk)
+        
+        their_sig = request.args.get('s')
+        our_sig = finish_signature(mac)
+        if our_sig != their_sig:
+            return jsonify({'ok': 'no', 'their_sig': their_sig, 'our_sig': our_sig})
+        
+        spool.seek(0)
+        header = json.loads(spool.readline() or 'null')
+        if not isinstance(header, dict) or header.get('cmd', '').lower() != 'upload':
+            return jsonify({'error': 'bulk mode only supports the upload command'})
+        videoId = header['videoId']
+        
+        storage = current_app.storage
+        skipped = {'duplicates': [], 'wrong_videoid': []}
+        numSkipped = {'duplicates': 0, 'wrong_videoid': 0}
+        
+        for batch in ndjson_batches(iter(spool.readline, ''), UPLOAD_BATCH_SIZE):
+            sessions = []
+            wrongid = []
+            for interactionSession in batch:
+                if interactionSession['videoId'] != videoId:
+                    wrongid.append(interactionSession['_id'])
+                else:
+                    sessions.append(encoded_session(interactionSession))
+            
+            dups = storage.insert_interaction_sessions(sessions)
+            numInserted += len(sessions) - len(dups)
+            for reason, ids in (('duplicates', dups), ('wrong_videoid', wrongid)):
+                numSkipped[reason] += len(ids)
+                skipped[reason].extend(ids[:MAX_REPORTED_IDS - len(skipped[reason])])
+        
+        aggregates.rebuild_video_aggregate(videoId)
+        
+        res = {'ok': 'ok', 'inserted': numInserted}
+        if any(numSkipped.values()):
+            res['skipped'] = dict( (reason, ids) for reason, ids in skipped.iteritems() if ids )
+            res['numSkipped'] = numSkipped
+        return jsonify(res)
+        
+    except (ValueError, KeyError, TypeError), e:
+        if numInserted:
+            aggregates.rebuild_video_aggregate(videoId)
+        return jsonify({'error': 'malformed upload: %s' % e, 'inserted': numInserted})
+    finally:
+        spool.close()
+
+def encoded_session(interactionSession):
+    """Encodes the interactions of an uploaded session as a whole."""
+    encoding = current_app.config['INTERACTION_ENCODING']
+    if encoding != 'raw':
+        interactions = decode_interactions(interactionSession.get('interactions', []))
+        interactionSession['interactions'] = encode_interactions(interactions, encoding)
+    return interactionSession
+
+def ndjson_batches(lines, size):
+    """Parses non-empty NDJSON lines into lists of at most `size` documents."""
+    batch = []
+    for line in lines:
+        if not line.strip():
+            continue
+        batch.append(json.loads(line))
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
@@ -0,0 +1,7 @@
+"""
+Load generation and benchmarks for the LikeLines backend.
+
+ * benchmark.synth: synthetic interaction streams, shaped like likelines.js output
+ * benchmark.load:  drives createSession/sendInteractions/aggregate concurrently
+ * benchmark.scale: scale test of processInteractionSession
+"""
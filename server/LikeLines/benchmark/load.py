@@ -0,0 +1,149 @@
+# Load generator for the LikeLines backend
+# License: MIT
+#
+# Simulates concurrent viewers against an in-process LikeLines app: every
+# viewer creates an interaction session, sends synthetic interactions in the
+# batches a player would send and finally fetches the video's aggregate.
+
+import os
+import json
+import time
+import random
+import urllib
+from threading import Thread
+from optparse import OptionParser
+
+from LikeLines.server import create_app, create_db
+from LikeLines.benchmark.synth import synthesize_session, to_batches
+from LikeLines.benchmark.stats import report
+
+
+def get_optionparser():
+    qualified_module_name = '%s.%s' % (__package__, os.path.splitext(os.path.basename(__file__))[0])
+    parser = OptionParser(usage='usage: python -m %s [OPTION]' % qualified_module_name)
+    parser.add_option('-c',
+                      dest='concurrency',
+                      type='int',
+                      default=8,
+                      help='Number of concurrent viewers (default: 8)')
+    
+    parser.add_option('-n',
+                      dest='sessions',
+                      type='int',
+                      default=10,
+                      help='Number of sessions per viewer (default: 10)')
+    
+    parser.add_option('-v',
+                      dest='videos',
+                      type='int',
+                      default=5,
+                      help='Number of distinct videos (default: 5)')
+    
+    parser.add_option('-d',
+                      dest='duration',
+                      type='float',
+                      default=300.0,
+                      help='Video duration in seconds (default: 300)')
+    
+    parser.add_option('--storage',
+                      dest='storage',
+                      choices=['mongo', 'sqlite', 'memory'],
+                      default='memory',
+                      help='Storage engine (default: memory)')
+    
+    parser.add_option('--sqlite',
+                      dest='sqlite_path',
+                      default='likelines-benchmark.sqlite',
+                      help='SQLite database file (default: likelines-benchmark.sqlite)')
+    
+    parser.add_option('--db',
+                      dest='dbname',
+                      default='LikeLinesBenchmark',
+                      help='MongoDB database name (default: LikeLinesBenchmark)')
+    
+    parser.add_option('--buffered',
+                      dest='buffered',
+                      action='store_true',
+                      default=False,
+                      help='Use buffered (write-behind) ingestion')
+    
+    parser.add_option('--seed',
+                      dest='seed',
+                      type='int',
+                      default=None,
+                      help='Random seed')
+    
+    return parser
+
+
+def create_benchmark_app(options):
+    app = create_app({
+        'DEBUG': False,
+        'STORAGE_ENGINE': options.storage,
+        'SQLITE_PATH': options.sqlite_path,
+        'MONGO_DBNAME': options.dbname,
+        'INGEST_MODE': 'buffered' if options.buffered else 'direct'
+    })
+    app.storage = create_db(app)
+    app.secret_key = os.urandom(24)
+    return app
+
+
+class Viewer(Thread):
+    def __init__(self, app, options, seed):
+        Thread.__init__(self)
+        self.client = app.test_client()
+        self.options = options
+        self.rng = random.Random(seed)
+        self.latencies = {}
+        self.errors = 0
+    
+    def request(self, endpoint, **params):
+        start = time.time()
+        resp = self.client.get('/%s?%s' % (endpoint, urllib.urlencode(params)))
+        self.latencies.setdefault(endpoint, []).append(time.time() - start)
+        
+        if resp.status_code != 200:
+            self.errors += 1
+            return {}
+        res = json.loads(resp.data)
+        if 'error' in res:
+            self.errors += 1
+        return res
+    
+    def run(self):
+        for _ in xrange(self.options.sessions):
+            videoId = 'benchmark:%d' % self.rng.randrange(self.options.videos)
+            interactions = synthesize_session(self.rng, self.options.duration)
+            
+            token = self.request('createSession', videoId=videoId, ts=interactions[0][0]).get('token')
+            for batch in to_batches(interactions):
+                self.request('sendInteractions', token=token, interactions=json.dumps(batch))
+            self.request('aggregate', videoId=videoId)
+
+
+if __name__ == "__main__":
+    options, _ = get_optionparser().parse_args()
+    seed = options.seed if options.seed is not None else random.randrange(2**32)
+    
+    app = create_benchmark_app(options)
+    viewers = [Viewer(app, options, seed + i) for i in xrange(options.concurrency)]
+    
+    start = time.time()
+    for viewer in viewers:
+        viewer.start()
+    for viewer in viewers:
+        viewer.join()
+    if app.interaction_buffer is not None:
+        app.interaction_buffer.stop()
+    elapsed = time.time() - start
+    
+    latencies = {}
+    for viewer in viewers:
+        for endpoint, values in viewer.latencies.iteritems():
+            latencies.setdefault(endpoint, []).extend(values)
+    
+    print 'storage=%s concurrency=%d sessions=%d videos=%d seed=%d' % (
+        options.storage, options.concurrency, options.concurrency*options.sessions, options.videos, seed)
+    print 'elapsed: %.2fs, errors: %d' % (elapsed, sum(viewer.errors for viewer in viewers))
+    report(latencies, elapsed)
@@ -0,0 +1,105 @@
+# Scale test of processInteractionSession
+# License: MIT
+#
+# Measures how aggregation time grows with the number of sessions of a
+# video, independently of the web and storage layers.
+
+import os, sys
+import time
+import random
+import multiprocessing
+from optparse import OptionParser
+
+from LikeLines.aggregates import processInteractionSession, empty_aggregate_object, merge_aggregates
+from LikeLines.benchmark.synth import synthesize_session, to_batches
+from LikeLines.mapreduce import aggregate_batch, BATCH_SIZE
+
+DEFAULT_COUNTS = [10, 100, 1000, 10000, 100000, 1000000]
+
+
+def get_optionparser():
+    qualified_module_name = '%s.%s' % (__package__, os.path.splitext(os.path.basename(__file__))[0])
+    parser = OptionParser(usage='usage: python -m %s [OPTION]' % qualified_module_name)
+    parser.add_option('--max',
+                      dest='max',
+                      type='int',
+                      default=DEFAULT_COUNTS[-1],
+                      help='Largest number of sessions (default: %d)' % DEFAULT_COUNTS[-1])
+    
+    parser.add_option('--pool',
+                      dest='pool',
+                      type='int',
+                      default=1000,
+                      help='Number of distinct synthetic sessions to cycle through (default: 1000)')
+    
+    parser.add_option('-d',
+                      dest='duration',
+                      type='float',
+                      default=300.0,
+                      help='Video duration in seconds (default: 300)')
+    
+    parser.add_option('--workers',
+                      dest='workers',
+                      type='int',
+                      default=0,
+                      help='Aggregate in this many processes, as with AGGREGATE_WORKERS (default: 0, serial)')
+    
+    parser.add_option('--seed',
+                      dest='seed',
+                      type='int',
+                      default=0,
+                      help='Random seed (default: 0)')
+    
+    return parser
+
+
+def stored_interactions(rng, duration):
+    """Interactions of a session as stored by the server (i.e., simplified batches)."""
+    interactions = []
+    for batch in to_batches(synthesize_session(rng, duration)):
+        interactions.extend(batch)
+    return interactions
+
+
+def time_sessions(pool, numSessions):
+    playbacks = []
+    likedPoints = []
+    taggedPoints = []
+    
+    start = time.time()
+    for i in xrange(numSessions):
+        processInteractionSession(pool[i % len(pool)], playbacks, likedPoints, taggedPoints)
+    return time.time() - start
+
+def time_sessions_parallel(workers, pool, numSessions):
+    def batches():
+        for i in xrange(0, numSessions, BATCH_SIZE):
+            yield [(j, pool[j % len(pool)]) for j in xrange(i, min(i + BATCH_SIZE, numSessions))]
+    
+    aggregate = empty_aggregate_object(None)
+    start = time.time()
+    for partial in workers.imap(aggregate_batch, batches()):
+        merge_aggregates(aggregate, partial)
+    return time.time() - start
+
+
+if __name__ == "__main__":
+    options, _ = get_optionparser().parse_args()
+    
+    rng = random.Random(options.seed)
+    pool = [stored_interactions(rng, options.duration) for _ in xrange(options.pool)]
+    avgInteractions = sum(len(interactions) for interactions in pool) / float(len(pool))
+    
+    workers = multiprocessing.Pool(options.workers) if options.workers > 0 else None
+    
+    print 'pool=%d sessions, %.1f interactions/session on average' % (len(pool), avgInteractions)
+    print '%10s %10s %12s' % ('sessions', 'seconds', 'sessions/s')
+    for numSessions in DEFAULT_COUNTS:
+        if numSessions > options.max:
+            break
+        if workers is not None:
+            elapsed = time_sessions_parallel(workers, pool, numSessions)
+        else:
+            elapsed = time_sessions(pool, numSessions)
+        print '%10d %10.3f %12.0f' % (numSessions, elapsed, numSessions/elapsed if elapsed else float('inf'))
+        sys.stdout.flush()
@@ -0,0 +1,33 @@
+"""
+Latency statistics.
+"""
+
+import sys
+import math
+
+
+def percentile(sortedValues, p):
+    """Nearest-rank percentile of an already sorted list."""
+    if not sortedValues:
+        return float('nan')
+    k = max(0, int(math.ceil(p/100.0 * len(sortedValues))) - 1)
+    return sortedValues[k]
+
+
+def report(latencies, elapsed, fh=sys.stdout):
+    """
+    Prints throughput and latency percentiles per endpoint.
+
+    latencies: {endpoint: [seconds, ...]}
+    elapsed: wall clock time of the run in seconds
+    """
+    print >>fh, '%-20s %8s %10s %9s %9s %9s %9s' % ('endpoint', 'requests', 'req/s', 'mean ms', 'p50 ms', 'p95 ms', 'p99 ms')
+    for endpoint in sorted(latencies):
+        values = sorted(latencies[endpoint])
+        n = len(values)
+        print >>fh, '%-20s %8d %10.1f %9.2f %9.2f %9.2f %9.2f' % (
+            endpoint, n, n/elapsed if elapsed else float('nan'),
+            1000*sum(values)/n if n else float('nan'),
+            1000*percentile(values, 50),
+            1000*percentile(values, 95),
+            1000*percentile(values, 99))
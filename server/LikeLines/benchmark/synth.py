@@ -0,0 +1,127 @@
+"""
+Synthetic interaction streams.
+
+Interactions have the same [ts, evtType, tc, last_tc] shape as those sent by
+LikeLines.Player in likelines.js: the player emits a TICK every 250ms (for
+which tc == last_tc), state changes (PLAYING, PAUSED, ENDED) and explicit
+LIKE and TAG_<tag> events. Seeks show up as jumps in the timecode.
+"""
+
+import random
+
+TICK_INTERVAL = 0.25     # seconds, see LikeLines.Player.prototype.onVideoLoaded
+BACKEND_THROTTLE = 5.0   # seconds, see LikeLines.options.defaults
+BUFFER_LIMIT = 100       # see LikeLines.BackendServer.prototype.sendInteractions
+
+DEFAULT_TAGS = ['funny', 'boring', 'goal']
+
+
+def synthesize_session(rng=random, duration=300.0, ts=None,
+                       watchFraction=None, likeRate=0.01, tagRate=0.005,
+                       skipRate=0.005, pauseRate=0.003, tags=DEFAULT_TAGS):
+    """
+    Simulates a single viewer watching a video of `duration` seconds.
+    Rates are per tick. Returns the list of interactions in emission order.
+    """
+    if ts is None:
+        ts = 1.4e9 + rng.random()*1e8
+    if watchFraction is None:
+        watchFraction = rng.random()
+    
+    interactions = []
+    tc = 0.0
+    last_tc = 0.0
+    watched = 0.0
+    playing = True
+    
+    def emit(evtType):
+        interactions.append([round(ts, 3), evtType, round(tc, 3), round(last_tc, 3)])
+    
+    emit('PLAYING')
+    while watched < watchFraction*duration:
+        ts += TICK_INTERVAL
+        if playing:
+            tc += TICK_INTERVAL
+            watched += TICK_INTERVAL
+            if tc >= duration:
+                tc = duration
+                last_tc = tc
+                emit('ENDED')
+                break
+        
+        last_tc = tc
+        emit('TICK')
+        
+        r = rng.random()
+        if not playing:
+            if r < 0.1:
+                playing = True
+                emit('PLAYING')
+        elif r < pauseRate:
+            playing = False
+            emit('PAUSED')
+        elif r < pauseRate + skipRate:
+            # seek: timecode jumps, picked up by the next TICK
+            tc = rng.random()*duration
+        elif r < pauseRate + skipRate + likeRate:
+            emit('LIKE')
+        elif r < pauseRate + skipRate + likeRate + tagRate:
+            emit('TAG_%s' % rng.choice(tags))
+    else:
+        emit('PAUSED')
+    
+    return interactions
+
+
+def simplify_buffer(buffer):
+    """Port of LikeLines.BackendServer.prototype.simplifyBuffer."""
+    # pass 1: remove superfluous ticks
+    newBuffer = []
+    lastTickEvent = None
+    for evt in buffer:
+        if evt[1] == 'TICK':
+            lastTickEvent = evt
+        else:
+            lastTickEvent = None
+            newBuffer.append(evt)
+    if lastTickEvent is not None:
+        newBuffer.append(lastTickEvent)
+    
+    # pass 2: remove superfluous paused events
+    buffer = newBuffer
+    n = len(buffer)
+    newBuffer = []
+    for i, evt in enumerate(buffer):
+        if evt[1] == 'PAUSED' and 0 < i < n-1 and buffer[i-1][1] == 'PAUSED' and buffer[i+1][1] == 'PAUSED':
+            continue
+        newBuffer.append(evt)
+    return newBuffer
+
+
+def to_batches(interactions, throttle=BACKEND_THROTTLE):
+    """
+    Splits a session's interactions into the batches a player would send,
+    following LikeLines.BackendServer.prototype.sendInteractions.
+    """
+    batches = []
+    buffer = []
+    lastSend = 0
+    seenFirstNonTickEvent = False
+    
+    for interaction in interactions:
+        cur_ts, evtType = interaction[0], interaction[1]
+        seenFirstNonTickEvent = seenFirstNonTickEvent or evtType != 'TICK'
+        forceSend = evtType == 'ENDED' or evtType == 'LIKE' or evtType.startswith('TAG_')
+        canSend = seenFirstNonTickEvent and lastSend + throttle <= cur_ts
+        
+        buffer.append(interaction)
+        if forceSend or canSend:
+            batches.append(simplify_buffer(buffer))
+            buffer = []
+            lastSend = cur_ts
+        elif len(buffer) > BUFFER_LIMIT:
+            buffer = simplify_buffer(buffer)
+    
+    if buffer:
+        batches.append(simplify_buffer(buffer))
+    return batches
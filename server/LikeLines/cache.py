@@ -0,0 +1,167 @@
+"""
+In-process caches.
+
+Note: these caches are local to a single server process. When running
+multiple processes, invalidations do not propagate and entries can be stale
+for at most their time-to-live. The exception is the ingestion worker (log
+mode), whose progress the server reads from the log's checkpoint to expire
+the responses of the videos it has updated (see ingest.expire_applied_responses).
+Until then, the server keeps serving the responses it computed before.
+"""
+
+from collections import OrderedDict
+from threading import Lock
+from hashlib import sha1
+from flaskutil import dumps
+
+import time
+
+
+class LRUCache(object):
+    """Bounded mapping that evicts the least recently used entries and,
+    optionally, entries older than `ttl` seconds."""
+    
+    def __init__(self, maxsize, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = Lock()
+    
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                ts, value = self._data.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            
+            if self.ttl is not None and ts + self.ttl < time.time():
+                self.misses += 1
+                return default
+            
+            self._data[key] = (ts, value)
+            self.hits += 1
+            return value
+    
+    def set(self, key, value):
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = (time.time(), value)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+    
+    def update(self, key, func):
+        """Replaces a cached value by func(value); missing keys are left alone."""
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None:
+                self._data[key] = (entry[0], func(entry[1]))
+    
+    def pop(self, key, default=None):
+        with self._lock:
+            entry = self._data.pop(key, None)
+            return default if entry is None else entry[1]
+    
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+    
+    def __len__(self):
+        return len(self._data)
+
+
+class ResponseCache(object):
+    """Caches the serialized, user-independent part of per-video responses.
+
+    Entries are grouped per video, such that all variants of a video's
+    responses (e.g., different widths or binnings) can be invalidated at once.
+    
+    Each invalidation advances the video's generation. A response computed
+    from data read before an invalidation is not stored if the caller passes
+    the generation it read before computing (see `generation`).
+    """
+    
+    # Bounds the number of response variants kept per video (the most
+    # recently used ones)
+    MAX_VARIANTS = 16
+    
+    # Bounds the number of generations kept; beyond it, they are all advanced
+    MAX_GENERATIONS = 100000
+    
+    def __init__(self, maxsize, ttl):
+        self.hits = 0
+        self.misses = 0
+        self._videos = LRUCache(maxsize, ttl)
+        self._lock = Lock()
+        self._generations = {}
+        self._counter = 0
+        self._floor = 0     # generation of the videos not in _generations
+    
+    def get(self, videoId, variant):
+        """
+        Returns the (etag, members) entry of a response variant or None. The
+        members are the serialized object without its opening brace, such
+        that responses can prepend members of their own without copying it.
+        """
+        variants = self._videos.get(videoId)
+        entry = None
+        if variants is not None:
+            with self._lock:
+                entry = variants.pop(variant, None)
+                if entry is not None:
+                    variants[variant] = entry
+        if entry is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return entry
+    
+    def generation(self, videoId):
+        """Returns the video's generation, to be read before computing a response."""
+        with self._lock:
+            return self._generations.get(videoId, self._floor)
+    
+    def set(self, videoId, variant, obj, generation=None):
+        """
+        Serializes and stores `obj` and returns its (etag, members) entry.
+        The entry is not stored if the video has been invalidated since
+        `generation` was read.
+        """
+        entry = response_entry(obj)
+        
+        with self._lock:
+            if generation is not None and self._generations.get(videoId, self._floor) != generation:
+                return entry
+            variants = self._videos.get(videoId)
+            if variants is None:
+                variants = OrderedDict()
+                self._videos.set(videoId, variants)
+            variants.pop(variant, None)
+            variants[variant] = entry
+            while len(variants) > self.MAX_VARIANTS:
+                variants.popitem(last=False)
+        return entry
+    
+    def invalidate(self, videoId):
+        with self._lock:
+            self._counter += 1
+            self._generations[videoId] = self._counter
+            if len(self._generations) > self.MAX_GENERATIONS:
+                self._generations.clear()
+                self._floor = self._counter
+            self._videos.pop(videoId)
+    
+    def clear(self):
+        with self._lock:
+            self._counter += 1
+            self._generations.clear()
+            self._floor = self._counter
+            self._videos.clear()
+
+
+def response_entry(obj):
+    """Serializes `obj` into a (etag, members) entry, see ResponseCache.get."""
+    serialized = dumps(obj)
+    return sha1(serialized).hexdigest(), serialized[1:]
@@ -0,0 +1,192 @@
+"""
+Compact encoding of interaction logs.
+
+An `interactions` array of an interaction session holds raw interactions
+([ts, evtType, tc, last_tc]) and/or packed blocks of interactions:
+
+  {'packed': base64}
+
+A packed block stores its interactions column by column as varints:
+
+  version, n, number of strings, strings (length + UTF-8),
+  n event codes, n timestamps, n timecodes, n last timecodes
+
+Event codes index EVENT_TYPES, followed by the block's own strings (e.g.,
+tag events). Timestamps and timecodes are stored in milliseconds as deltas
+from the previous value, the last timecode as a delta from the timecode.
+Values are therefore rounded to 1ms; None values are preserved. Blocks are
+base64-encoded, such that documents remain JSON-compatible in all storage
+engines and exports.
+
+Which encoding is used for new interactions is configured with
+INTERACTION_ENCODING ('raw' or 'packed'); both can be read at all times.
+"""
+
+import base64
+import math
+
+FORMAT_VERSION = 1
+EVENT_TYPES = ['TICK', 'PLAYING', 'PAUSED', 'ENDED', 'LIKE']
+EVENT_CODES = dict( (evtType, code) for code, evtType in enumerate(EVENT_TYPES) )
+
+ENCODINGS = ['raw', 'packed']
+
+
+def encode_interactions(interactions, encoding):
+    """Returns the elements to store for a batch of raw interactions."""
+    if encoding == 'packed' and interactions:
+        block = pack_interactions(interactions)
+        if block is not None:
+            return [block]
+    return list(interactions)
+
+def decode_interactions(interactions):
+    """Returns the raw interactions of a (possibly packed) interactions array."""
+    res = []
+    for element in interactions:
+        if isinstance(element, dict):
+            res.extend(unpack_interactions(element))
+        else:
+            res.append(element)
+    return res
+
+def decoded_session(interactionSession):
+    """Decodes the interactions of an interaction session document in place."""
+    interactionSession['interactions'] = decode_interactions(interactionSession.get('interactions', []))
+    return interactionSession
+
+
+def pack_interactions(interactions):
+    """Packs raw interactions into a block, or returns None if they do not fit the format."""
+    strings = []
+    stringCodes = {}
+    codes = []
+    ts_col = []
+    tc_col = []
+    last_tc_col = []
+    
+    prev_ts = 0
+    prev_tc = 0
+    for interaction in interactions:
+        if not isinstance(interaction, (list, tuple)) or len(interaction) != 4:
+            return None
+        ts, evtType, tc, last_tc = interaction
+        if not isinstance(evtType, basestring):
+            return None
+        
+        code = EVENT_CODES.get(evtType)
+        if code is None:
+            code = stringCodes.get(evtType)
+            if code is None:
+                code = stringCodes[evtType] = len(EVENT_TYPES) + len(strings)
+                strings.append(evtType)
+        codes.append(code)
+        
+        try:
+            ts = _millis(ts)
+            tc = _millis(tc)
+            last_tc = _millis(last_tc)
+        except ValueError:
+            return None
+        
+        ts_col.append(_delta(ts, prev_ts))
+        tc_col.append(_delta(tc, prev_tc))
+        last_tc_col.append(_delta(last_tc, tc if tc is not None else prev_tc))
+        if ts is not None:
+            prev_ts = ts
+        if tc is not None:
+            prev_tc = tc
+    
+    buf = bytearray()
+    _put_varint(buf, FORMAT_VERSION)
+    _put_varint(buf, len(codes))
+    _put_varint(buf, len(strings))
+    for s in strings:
+        s = s.encode('utf-8')
+        _put_varint(buf, len(s))
+        buf.extend(s)
+    for column in (codes, ts_col, tc_col, last_tc_col):
+        for value in column:
+            _put_varint(buf, value)
+    
+    return {'packed': base64.b64encode(str(buf))}
+
+def unpack_interactions(block):
+    """Unpacks a block into a list of raw interactions."""
+    buf = bytearray(base64.b64decode(block['packed']))
+    pos = 0
+    version, pos = _get_varint(buf, pos)
+    if version != FORMAT_VERSION:
+        raise ValueError('Unsupported packed interactions version: %d' % version)
+    
+    n, pos = _get_varint(buf, pos)
+    numStrings, pos = _get_varint(buf, pos)
+    eventTypes = list(EVENT_TYPES)
+    for _ in xrange(numStrings):
+        length, pos = _get_varint(buf, pos)
+        eventTypes.append(buf[pos:pos+length].decode('utf-8'))
+        pos += length
+    
+    columns = []
+    for _ in xrange(4):
+        column = []
+        for _ in xrange(n):
+            value, pos = _get_varint(buf, pos)
+            column.append(value)
+        columns.append(column)
+    codes, ts_col, tc_col, last_tc_col = columns
+    
+    res = []
+    prev_ts = 0
+    prev_tc = 0
+    for i in xrange(n):
+        ts = _undelta(ts_col[i], prev_ts)
+        tc = _undelta(tc_col[i], prev_tc)
+        last_tc = _undelta(last_tc_col[i], tc if tc is not None else prev_tc)
+        if ts is not None:
+            prev_ts = ts
+        if tc is not None:
+            prev_tc = tc
+        res.append([_seconds(ts), eventTypes[codes[i]], _seconds(tc), _seconds(last_tc)])
+    return res
+
+
+def _millis(value):
+    if value is None:
+        return None
+    if isinstance(value, bool) or not isinstance(value, (int, long, float)) or math.isinf(value) or math.isnan(value):
+        raise ValueError(value)
+    return int(round(value * 1000))
+
+def _seconds(value):
+    return value / 1000.0 if value is not None else None
+
+def _delta(value, base):
+    # 0 encodes None, otherwise the zigzag-encoded delta + 1
+    if value is None:
+        return 0
+    delta = value - base
+    return (delta << 1 if delta >= 0 else (-delta << 1) - 1) + 1
+
+def _undelta(value, base):
+    if value == 0:
+        return None
+    value -= 1
+    return base + (value >> 1 if not value & 1 else -((value + 1) >> 1))
+
+def _put_varint(buf, value):
+    while value > 0x7f:
+        buf.append((value & 0x7f) | 0x80)
+        value >>= 7
+    buf.append(value)
+
+def _get_varint(buf, pos):
+    value = 0
+    shift = 0
+    while True:
+        b = buf[pos]
+        pos += 1
+        value |= (b & 0x7f) << shift
+        if b < 0x80:
+            return value, pos
+        shift += 7
@@ -1,8 +1,14 @@
 """
 Debug Blueprints.
 """
-from flask import Blueprint, current_app, redirect, jsonify, url_for, request
+from flask import Blueprint, current_app, redirect, url_for, request
 from usersession import get_session_id
+from flaskutil import stream_response, ndjson_chunks, json_array_chunks, jsonify
+from codec import decoded_session
+
+import json
+
+DUMP_COLLECTIONS = ['userSessions', 'interactionSessions']
 
 debug_pages = Blueprint('debug', __name__)
 
@@ -12,17 +18,38 @@ def clear_all():
     if request.method == 'GET':
         return '<form method="POST"><input type="submit" value="CLEAR DATABASE"></form>'
     else:
-        mongo = current_app.mongo
-        mongo.db.userSessions.remove()
-        mongo.db.interactionSessions.remove()
+        current_app.storage.clear()
+        current_app.response_cache.clear()
+        current_app.user_likes_cache.clear()
         return redirect(url_for('end_session'))
 
 
 @debug_pages.route("/dump")
 def dump_session():
-    mongo = current_app.mongo
-    return jsonify({
-        "session['session_id']": get_session_id(),
-        'userSessions': list(mongo.db.userSessions.find()),
-        'interactionSessions': list(mongo.db.interactionSessions.find()),
-    })
+    storage = current_app.storage
+    
+    # A single collection as NDJSON, resumable with ?after=<last _id>
+    collection = request.args.get('collection')
+    if collection is not None:
+        if collection not in DUMP_COLLECTIONS:
+            return jsonify({'error': 'collection must be one of: %s' % ', '.join(DUMP_COLLECTIONS)})
+        docs = scan_decoded(storage, collection, request.args.get('after'))
+        return stream_response(ndjson_chunks(docs), 'application/x-ndjson')
+    
+    session_id = get_session_id()
+    def chunks():
+        yield '{"session[\'session_id\']":%s' % json.dumps(session_id)
+        for collection in DUMP_COLLECTIONS:
+            yield ',\n"%s":' % collection
+            for chunk in json_array_chunks(scan_decoded(storage, collection)):
+                yield chunk
+        yield '}\n'
+    
+    return stream_response(chunks(), 'application/json')
+
+
+def scan_decoded(storage, collection, after=None):
+    docs = storage.scan(collection, after=after)
+    if collection == 'interactionSessions':
+        docs = (decoded_session(doc) for doc in docs)
+    return docs
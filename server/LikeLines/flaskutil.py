@@ -4,28 +4,192 @@ Flask utility functions.
 
 from functools import wraps, update_wrapper
 from datetime import timedelta
-from flask import make_response, request, current_app
+from hashlib import sha1
+from flask import make_response, request, current_app, stream_with_context
+
+import json
+import zlib
+
+# ujson serializes considerably faster than the json module, if installed
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+# Streamed responses are written in chunks of about this many bytes
+STREAM_CHUNK_SIZE = 64*1024
+
+# Smaller responses are not worth compressing
+GZIP_MIN_SIZE = 1024
+GZIP_LEVEL = 6
+
+# Compressed request bodies (Content-Encoding) that can be decoded
+BODY_ENCODINGS = {
+    'identity': None,
+    'gzip': 16 + zlib.MAX_WBITS,
+    'deflate': zlib.MAX_WBITS
+}
+
+def dumps(obj):
+    """Serializes `obj` as compact JSON."""
+    if ujson is not None:
+        return ujson.dumps(obj)
+    return json.dumps(obj, separators=(',', ':'))
+
+def jsonify(obj):
+    """Returns a JSON response of `obj` (unlike flask.jsonify, never indented)."""
+    return current_app.response_class(dumps(obj), mimetype='application/json')
+
+def json_response(parts, etag=None):
+    """Returns a JSON response of the concatenation of `parts`, without joining them."""
+    resp = current_app.response_class(parts, mimetype='application/json')
+    if etag is not None:
+        resp.set_etag(etag)
+    return resp
 
 # http://flask.pocoo.org/snippets/79/
+#  -> modified: the body is wrapped without copying it (see wrap_jsonp)
 def jsonp(func):
     """Wraps JSONified output for JSONP requests."""
     @wraps(func)
     def decorated_function(*args, **kwargs):
-        callback = request.args.get('callback', False)
-        if callback:
-            data = str(func(*args, **kwargs).data)
-            content = str(callback) + '(' + data + ')'
-            mimetype = 'application/javascript'
-            return current_app.response_class(content, mimetype=mimetype)
-        else:
-            return func(*args, **kwargs)
+        return wrap_jsonp(func(*args, **kwargs))
     return decorated_function
 
+def wrap_jsonp(resp):
+    """Wraps a JSON response in the callback of a JSONP request, if any."""
+    callback = request.args.get('callback', False)
+    if not callback or resp.status_code != 200:
+        # e.g., 304 Not Modified
+        return resp
+    
+    parts = list(resp.response) if resp.is_sequence else [resp.get_data()]
+    wrapped = current_app.response_class([str(callback), '('] + parts + [')'], mimetype='application/javascript')
+    if 'ETag' in resp.headers:
+        wrapped.headers['ETag'] = resp.headers['ETag']
+    return wrapped
+
+def gzip_response(resp):
+    """Compresses a (non-streamed) response of at least GZIP_MIN_SIZE bytes if the client accepts gzip."""
+    if resp.status_code != 200 or not resp.is_sequence or 'Content-Encoding' in resp.headers:
+        return resp
+    if sum(len(part) for part in resp.response) < GZIP_MIN_SIZE:
+        return resp
+    
+    resp.headers.add('Vary', 'Accept-Encoding')
+    if 'gzip' in request.accept_encodings:
+        compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        compressed = [compressor.compress(part) for part in resp.response]
+        compressed.append(compressor.flush())
+        resp.set_data(''.join(compressed))
+        resp.headers['Content-Encoding'] = 'gzip'
+    return resp
+
+def make_etag(*parts):
+    """Computes an ETag over the given parts and the JSONP callback (if any)."""
+    h = sha1()
+    for part in parts + (request.args.get('callback', ''),):
+        h.update(part if isinstance(part, basestring) else json.dumps(part))
+        h.update('\0')
+    return h.hexdigest()
+
+def not_modified(etag):
+    """Returns a 304 response if the client already has the `etag` version."""
+    if request.if_none_match.contains(etag):
+        resp = current_app.response_class(status=304)
+        resp.set_etag(etag)
+        return resp
+    return None
+
+def ndjson_chunks(docs):
+    """Serializes documents as newline-delimited JSON."""
+    for doc in docs:
+        yield dumps(doc) + '\n'
+
+def json_array_chunks(docs):
+    """Serializes documents as a JSON array, one document per line."""
+    yield '['
+    sep = '\n'
+    for doc in docs:
+        yield sep + dumps(doc)
+        sep = ',\n'
+    yield '\n]\n'
+
+def stream_response(chunks, mimetype):
+    """
+    Returns a response that streams the given chunks of text, coalesced into
+    writes of about STREAM_CHUNK_SIZE bytes and gzip-compressed if the client
+    accepts it.
+    """
+    gzipped = 'gzip' in request.accept_encodings
+    
+    def generate():
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS) if gzipped else None
+        buf = []
+        size = 0
+        for chunk in chunks:
+            buf.append(chunk)
+            size += len(chunk)
+            if size >= STREAM_CHUNK_SIZE:
+                data = ''.join(buf)
+                buf = []
+                size = 0
+                if compressor is not None:
+                    data = compressor.compress(data)
+                if data:
+                    yield data
+        
+        data = ''.join(buf)
+        if compressor is not None:
+            data = compressor.compress(data) + compressor.flush()
+        if data:
+            yield data
+    
+    resp = current_app.response_class(stream_with_context(generate()), mimetype=mimetype)
+    resp.headers['Vary'] = 'Accept-Encoding'
+    if gzipped:
+        resp.headers['Content-Encoding'] = 'gzip'
+    return resp
+
+def read_body(max_size):
+    """
+    Returns the request body, decompressed according to its Content-Encoding.
+    Raises ValueError if the encoding is not supported or the (decompressed)
+    body exceeds `max_size` bytes.
+    """
+    encoding = request.headers.get('Content-Encoding', 'identity').strip().lower()
+    if encoding not in BODY_ENCODINGS:
+        raise ValueError('unsupported Content-Encoding: %s' % encoding)
+    
+    wbits = BODY_ENCODINGS[encoding]
+    decompressor = zlib.decompressobj(wbits) if wbits is not None else None
+    
+    buf = []
+    size = 0
+    for chunk in iter(lambda: request.stream.read(STREAM_CHUNK_SIZE), ''):
+        if decompressor is not None:
+            try:
+                chunk = decompressor.decompress(chunk, max_size + 1 - size)
+            except zlib.error, e:
+                raise ValueError('corrupt %s body: %s' % (encoding, e))
+            if decompressor.unconsumed_tail:
+                raise ValueError('body exceeds %d bytes' % max_size)
+        size += len(chunk)
+        if size > max_size:
+            raise ValueError('body exceeds %d bytes' % max_size)
+        buf.append(chunk)
+    
+    if decompressor is not None:
+        buf.append(decompressor.flush())
+    return ''.join(buf)
+
 # http://flask.pocoo.org/snippets/56/
 #  -> modified: origin=None is not a valid parameter value
+#  -> modified: credentials=True allows requests with cookies, for which the
+#     requesting origin has to be echoed instead of '*'
 def crossdomain(origin='*', methods=None, headers=None,
                 max_age=21600, attach_to_all=True,
-                automatic_options=True):
+                automatic_options=True, credentials=False):
     if methods is not None:
         methods = ', '.join(sorted(x.upper() for x in methods))
     if headers is not None and not isinstance(headers, basestring):
@@ -53,7 +217,14 @@ def crossdomain(origin='*', methods=None, headers=None,
 
             h = resp.headers
 
-            h['Access-Control-Allow-Origin'] = origin
+            if credentials and origin == '*' and 'Origin' in request.headers:
+                h['Access-Control-Allow-Origin'] = request.headers['Origin']
+                h['Access-Control-Allow-Credentials'] = 'true'
+                h.add('Vary', 'Origin')
+            else:
+                h['Access-Control-Allow-Origin'] = origin
+                if credentials:
+                    h['Access-Control-Allow-Credentials'] = 'true'
             h['Access-Control-Allow-Methods'] = get_methods()
             h['Access-Control-Max-Age'] = str(max_age)
             if headers is not None:
@@ -70,8 +241,26 @@ def p3p(func):
     @wraps(func)
     def decorated_function(*args, **kwargs):
         resp = make_response(func(*args, **kwargs))
-        h = resp.headers
-        h['P3P'] = 'CP="This is not a P3P policy! See //github.com/ShinNoNoir/likelines-player/blob/master/PRIVACY.txt for more info."'
+        set_p3p_header(resp)
         return resp
         
     return decorated_function
+
+def set_p3p_header(resp):
+    resp.headers['P3P'] = 'CP="This is not a P3P policy! See //github.com/ShinNoNoir/likelines-player/blob/master/PRIVACY.txt for more info."'
+
+
+def api_response(origin='*', methods=None, headers=None, credentials=False):
+    """
+    Finishes the responses of an API view in one pass: JSON is wrapped for
+    JSONP requests, large bodies are compressed and the P3P and CORS headers
+    (see crossdomain) are set. Replaces @crossdomain, @p3p and @jsonp.
+    """
+    def decorator(func):
+        @wraps(func)
+        def decorated_function(*args, **kwargs):
+            resp = gzip_response(wrap_jsonp(func(*args, **kwargs)))
+            set_p3p_header(resp)
+            return resp
+        return crossdomain(origin, methods, headers, credentials=credentials)(decorated_function)
+    return decorator
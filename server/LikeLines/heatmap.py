@@ -0,0 +1,216 @@
+"""
+Server-side heatmap computation.
+
+Vectorized NumPy port of LikeLines.GUI.Navigation.Heatmap.prototype.computeHeatmap
+and its helper functions in likelines.js. Results should match what the
+client would have painted for the same evidence and options.
+"""
+
+import math
+import numpy as np
+
+DEFAULT_KERNEL = 'gaussian'
+DEFAULT_BANDWIDTH = 1.0
+DEFAULT_HEATMAP_WEIGHTS = {
+    'likes':    1.0,
+    'playback': 1.0,
+    'seeks':    1.0,
+    'mca':      1.0
+}
+
+# Limits the size of the (width x points) matrices evaluated at once
+SMOOTHING_BLOCK_SIZE = 4096
+
+# Resolutions at which curve MCAs are stored besides their full resolution
+MCA_LEVELS = (64, 256, 1024)
+
+
+def gaussian(x):
+    return np.exp(x*x/-2) / math.sqrt(2*math.pi)
+
+def tricube(x):
+    # Mirrors LikeLines.Util.Kernels.tricube (only x > 1 is cut off)
+    subexp = 1 - np.abs(x*x*x)
+    return np.where(x > 1, 0.0, 70.0/81*subexp*subexp*subexp)
+
+KERNELS = {
+    'gaussian': gaussian,
+    'tricube':  tricube
+}
+
+
+def kernel_smooth(data, xs, h=DEFAULT_BANDWIDTH, K=gaussian, weights=None):
+    """Evaluates the kernel density of the points in `data` at every x in `xs`."""
+    data = np.asarray(data, dtype=float)
+    xs = np.asarray(xs, dtype=float)
+    n = len(data)
+    if n == 0:
+        return np.zeros(len(xs))
+    if not h:
+        h = 1.0
+    if weights is not None:
+        weights = np.asarray(weights, dtype=float)
+    
+    ys = np.zeros(len(xs))
+    for start in xrange(0, n, SMOOTHING_BLOCK_SIZE):
+        block = data[start:start+SMOOTHING_BLOCK_SIZE]
+        k = K( (xs[:, np.newaxis] - block[np.newaxis, :]) / h )
+        if weights is not None:
+            k *= weights[start:start+SMOOTHING_BLOCK_SIZE]
+        ys += k.sum(axis=1)
+    return ys / (n*h)
+
+
+def scale_array(data, new_size):
+    """Linearly resamples `data` to `new_size` elements (cf. LikeLines.Util.scaleArray)."""
+    data = np.asarray(data if data is not None else [], dtype=float)
+    n = len(data)
+    if n == 0 or new_size == 0:
+        return np.zeros(new_size)
+    elif n <= 2:
+        return np.linspace(data[0], data[n-1], new_size)
+    return np.interp(np.linspace(0, n-1, new_size), np.arange(n), data)
+
+
+def mca_level(width):
+    """Smallest MCA level of at least `width` elements, or None (full resolution)."""
+    if width is None:
+        return None
+    for level in MCA_LEVELS:
+        if width <= level:
+            return level
+    return None
+
+
+def mca_pyramid(mcaType, data):
+    """
+    Prepares MCA data for storage: curves are downsampled to each level
+    smaller than the curve, {str(level): [weights]}, and points are sorted.
+    Returns the (possibly sorted) data and the levels.
+    """
+    if mcaType == 'point':
+        return sorted(data), {}
+    levels = {}
+    for level in MCA_LEVELS:
+        if level < len(data):
+            levels[str(level)] = [round(x, 6) for x in scale_array(data, level)]
+    return data, levels
+
+
+def select_mca_level(mca, level):
+    """
+    Returns the MCAs of a video with curves replaced by the stored level
+    `level` (if any), leaving out the other levels.
+    """
+    res = {}
+    for mcaName, curMca in (mca or {}).iteritems():
+        curMca = dict(curMca)
+        levels = curMca.pop('levels', None) or {}
+        if level is not None and str(level) in levels:
+            curMca['data'] = levels[str(level)]
+        res[mcaName] = curMca
+    return res
+
+
+def normalize(arr):
+    """Scales `arr` in-place to [-1,1] (if not all zeros) and returns it."""
+    scale = np.abs(arr).max() if len(arr) else 0
+    if scale != 0:
+        arr /= scale
+    return arr
+
+
+def coverage_histogram(intervals, bins, binWidth=1.0):
+    """
+    Counts for each of the `bins` bins how many (start, end) intervals
+    overlap with it, using a difference array and a prefix sum.
+    """
+    if bins <= 0:
+        return np.zeros(0)
+    if not len(intervals):
+        return np.zeros(bins)
+    
+    intervals = np.floor(np.asarray(intervals, dtype=float) / binWidth).astype(int)
+    begin = intervals[:, 0]
+    end = np.minimum(intervals[:, 1], bins-1)
+    valid = (begin < bins) & (end >= 0) & (begin <= end)
+    
+    diff = np.zeros(bins+1)
+    np.add.at(diff, np.maximum(begin[valid], 0), 1)
+    np.add.at(diff, end[valid]+1, -1)
+    return np.cumsum(diff[:-1])
+
+
+def point_histogram(points, bins, binWidth=1.0):
+    """Counts the number of timepoints falling in each of the `bins` bins."""
+    if bins <= 0:
+        return np.zeros(0, dtype=int)
+    idx = np.floor(np.asarray(points, dtype=float) / binWidth).astype(int)
+    idx = idx[(idx >= 0) & (idx < bins)]
+    return np.bincount(idx, minlength=bins)
+
+
+def playback_curve(playbacks, duration):
+    """
+    Folds playback sessions into a per-second view count, as done in
+    LikeLines.Player.prototype.updateHeatmap.
+    """
+    intervals = [segment for playback in playbacks for segment in playback]
+    return coverage_histogram(intervals, int(math.ceil(duration)))
+
+
+def smooth_points(points, width, duration, K, h):
+    xs = np.linspace(0, duration-1, width)
+    return kernel_smooth(points, xs, h, K)
+
+
+def compute_heatmap(width, duration, likes, playback, seeks, mca,
+                    kernel=DEFAULT_KERNEL, bandwidth=DEFAULT_BANDWIDTH, heatmapWeights=None):
+    """
+    width: number of pixels of the heatmap
+    duration: number of seconds of corresponding video
+    likes: [timepoints] of likes
+    playback: [weights] per time bin from playing behaviour
+    seeks: [timepoints] of seeks or None
+    mca: {name: {"type": "curve"|"point", "data": [weights]|[timepoints], "weight"?: weight}}
+    """
+    K = KERNELS[kernel] if isinstance(kernel, basestring) else kernel
+    weights = dict(DEFAULT_HEATMAP_WEIGHTS)
+    if heatmapWeights:
+        weights.update(heatmapWeights)
+    
+    # compute the MCA curve
+    mcaCurve = np.zeros(width)
+    for curMca in (mca or {}).values():
+        if curMca['type'] == 'point':
+            arr = smooth_points(curMca['data'], width, duration, K, bandwidth)
+        elif curMca['type'] == 'curve':
+            arr = scale_array(curMca['data'], width)
+        else:
+            continue
+        mcaCurve += normalize(arr) * curMca.get('weight', 1.0)
+    
+    conversionTasks = {
+        'likes':    ('point', likes),
+        'playback': ('curve', playback),
+        'seeks':    ('point', seeks),
+        'mca':      ('curve', mcaCurve)
+    }
+    
+    heatmap = np.zeros(width)
+    for evidenceName, (evidenceType, evidenceData) in conversionTasks.iteritems():
+        if evidenceData is None:
+            continue
+        
+        if evidenceType == 'point':
+            arr = smooth_points(evidenceData, width, duration, K, bandwidth)
+        else:
+            arr = scale_array(evidenceData, width)
+        
+        heatmap += normalize(arr) * weights[evidenceName]
+    
+    heatmap = np.maximum(heatmap, 0)
+    scale = heatmap.max() if width else 0
+    if scale != 0:
+        heatmap /= scale
+    return heatmap
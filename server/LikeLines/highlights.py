@@ -0,0 +1,182 @@
+"""
+Precomputed highlights: the top segments of each video.
+
+The highlights of a video are the peaks of its server-side heatmap (see
+heatmap.py), computed from its aggregate and MCA at a resolution of (about)
+one bin per second, and are kept in the `videoHighlights` collection:
+
+  {
+    '_id':          videoId,
+    'version':      int,
+    'stale':        bool,
+    'numSessions':  int,
+    'duration':     seconds,
+    'segments':     [{'start', 'end', 'peak', 'score', 'views', 'likes'}, ...],
+    'ts':           time of computation,
+    'failures':     int,
+    'retryAfter':   time
+  }
+
+Each segment spans the seconds around a peak at which the heatmap is at least
+SEGMENT_THRESHOLD times the peak. Its score is the (relative) heatmap value
+of the peak, views the maximum number of sessions playing during the segment
+and likes the number of likes in it. Segments are stored by descending score.
+
+Updates of the aggregate or MCA of a video mark its highlights as stale and
+increment their version. A background job (admin/highlights.py) recomputes
+only the stale highlights; highlights that were never computed are computed
+on read. Highlights that fail to be recomputed are retried after a delay that
+doubles with each consecutive failure.
+"""
+
+from flask import current_app
+import aggregates
+import heatmap
+
+import heapq
+import logging
+import math
+import time
+
+import numpy as np
+
+log = logging.getLogger(__name__)
+
+# Delay (s) before stale highlights whose computation failed are retried,
+# doubled with each consecutive failure up to MAX_RETRY_DELAY
+RETRY_DELAY = 60
+MAX_RETRY_DELAY = 24 * 3600
+
+# Heatmap resolution used for peak detection, in bins per video
+MAX_BINS = 4096
+
+# A segment extends as far as the heatmap stays above this fraction of its peak
+SEGMENT_THRESHOLD = 0.5
+
+SORT_KEYS = ('score', 'views', 'likes')
+
+
+def find_peaks(curve, k, threshold=SEGMENT_THRESHOLD):
+    """
+    Returns the (start, peak, end) bins of the `k` highest peaks of `curve`,
+    highest first. A segment spans the bins around its peak whose values are
+    at least `threshold` times the peak; segments do not overlap.
+    """
+    curve = np.asarray(curve, dtype=float)
+    padded = np.concatenate(([-np.inf], curve, [-np.inf]))
+    
+    # Local maxima (the first bin of a plateau), highest first
+    candidates = np.flatnonzero((curve > padded[:-2]) & (curve >= padded[2:]) & (curve > 0))
+    candidates = candidates[np.argsort(-curve[candidates], kind='mergesort')]
+    
+    taken = np.zeros(len(curve), dtype=bool)
+    peaks = []
+    for peak in candidates:
+        if len(peaks) >= k:
+            break
+        if taken[peak]:
+            # Part of the segment of a higher peak
+            continue
+        below = (curve < threshold * curve[peak]) | taken
+        left = np.flatnonzero(below[:peak])
+        right = np.flatnonzero(below[peak+1:])
+        start = left[-1] + 1 if len(left) else 0
+        end = peak + right[0] if len(right) else len(curve) - 1
+        taken[start:end+1] = True
+        peaks.append( (int(start), int(peak), int(end)) )
+    return peaks
+
+
+def compute_highlights(videoAggregate, mca, k):
+    """Computes the `k` top segments of a video from its aggregate and MCA."""
+    duration = aggregates.observed_duration(videoAggregate)
+    highlights = {
+        'numSessions': videoAggregate['numSessions'],
+        'duration': duration,
+        'segments': [],
+        'ts': time.time()
+    }
+    
+    bins = int(min(math.ceil(duration), MAX_BINS))
+    if bins == 0:
+        return highlights
+    binWidth = float(duration) / bins
+    
+    intervals = [segment for playback in videoAggregate['playbacks'].itervalues() for segment in playback]
+    views = heatmap.coverage_histogram(intervals, bins, binWidth)
+    likedPoints = aggregates.liked_points(videoAggregate)
+    likes = np.cumsum(np.concatenate(([0], heatmap.point_histogram(likedPoints, bins, binWidth))))
+    mca = heatmap.select_mca_level(mca, heatmap.mca_level(bins))
+    values = heatmap.compute_heatmap(bins, duration, likedPoints, views, None, mca)
+    
+    for start, peak, end in find_peaks(values, k):
+        highlights['segments'].append({
+            'start': round(start * binWidth, 2),
+            'end': round((end+1) * binWidth, 2),
+            'peak': round(peak * binWidth, 2),
+            'score': round(values[peak], 3),
+            'views': int(views[start:end+1].max()),
+            'likes': int(likes[end+1] - likes[start])
+        })
+    return highlights
+
+
+def refresh_highlights(videoId, version=None):
+    """
+    Recomputes and stores the highlights of a video. `version` is the
+    version of its stale highlights, read before the aggregate is.
+    """
+    videoAggregate = aggregates.get_video_aggregate(videoId)
+    mca = current_app.storage.get_mca(videoId)
+    highlights = compute_highlights(videoAggregate, mca, current_app.config['HIGHLIGHTS_K'])
+    current_app.storage.save_highlights(videoId, highlights, version)
+    return dict(highlights, _id=videoId, version=version, stale=False)
+
+
+def refresh_stale_highlights(limit):
+    """
+    Recomputes at most `limit` stale highlights and returns their videoIds.
+    Videos whose highlights cannot be computed are logged and deferred (see
+    RETRY_DELAY), such that they do not hold up the others.
+    """
+    storage = current_app.storage
+    stale = storage.find_stale_highlights(limit)
+    for videoId, version in stale:
+        try:
+            refresh_highlights(videoId, version)
+        except storage.TRANSIENT_ERRORS:
+            raise
+        except Exception:
+            failures = (storage.get_highlights(videoId) or {}).get('failures', 0) + 1
+            delay = min(RETRY_DELAY * 2 ** (failures - 1), MAX_RETRY_DELAY)
+            log.exception('Cannot compute the highlights of video %s; retrying in %d s' % (videoId, delay))
+            storage.defer_highlights(videoId, failures, time.time() + delay)
+    return [videoId for videoId, _ in stale]
+
+
+def get_highlights(videoId):
+    """Returns the stored highlights of a video, computing them if there are none yet."""
+    highlights = current_app.storage.get_highlights(videoId)
+    if highlights is None or 'segments' not in highlights:
+        highlights = refresh_highlights(videoId, highlights and highlights['version'])
+    return highlights
+
+
+def get_highlights_many(videoIds):
+    """Like get_highlights for several videos: {videoId: highlights}."""
+    stored = current_app.storage.get_highlights_many(videoIds)
+    res = {}
+    for videoId in videoIds:
+        highlights = stored.get(videoId)
+        if highlights is None or 'segments' not in highlights:
+            highlights = refresh_highlights(videoId, highlights and highlights['version'])
+        res[videoId] = highlights
+    return res
+
+
+def top_segments(highlightsPerVideo, k, sort):
+    """Returns the `k` top segments across videos by `sort`, each with its videoId."""
+    segments = ( dict(segment, videoId=videoId)
+                 for videoId, highlights in highlightsPerVideo.iteritems()
+                 for segment in highlights['segments'] )
+    return heapq.nlargest(k, segments, key=lambda segment: (segment[sort], segment['score']))
@@ -0,0 +1,519 @@
+"""
+Ingestion of interaction batches sent by players.
+
+A batch is a tuple (token, videoId, session_id, interactions, seq), where
+seq is the batch's sequence number within its session (or None). Batches are
+either applied directly (INGEST_MODE = 'direct'), buffered in-process and
+written behind in bulk (INGEST_MODE = 'buffered'), either periodically or
+once enough interactions are pending, or appended to a durable log on local
+disk (INGEST_MODE = 'log') that a separate worker process folds into the
+database (see admin/ingestworker.py). Buffered and logged interactions
+become visible in aggregates only after they have been written.
+"""
+
+from flask import current_app
+from codec import encode_interactions
+from threading import Thread, Lock, Event
+from collections import OrderedDict
+
+from aggregates import extractLikesAndTags
+from usersession import add_user_likes, get_user_likes
+import aggregates
+
+import atexit
+import fcntl
+import json
+import logging
+import math
+import os
+import time
+
+log = logging.getLogger(__name__)
+
+
+def submit(token, videoId, session_id, interactions, seq=None):
+    """
+    Submits a batch; a batch with a sequence number (seq) is applied at most
+    once. The interactions must have been validated (validate_interactions).
+    """
+    batch = (token, videoId, session_id, interactions, seq)
+    buffer = current_app.interaction_buffer
+    ingestLog = current_app.ingest_log
+    if buffer is not None:
+        buffer.add(batch)
+    elif ingestLog is not None:
+        ingestLog.append(batch)
+        # The worker's writes do not reach this process's caches: the user's
+        # likes are cached now (the worker has not stored them yet), and the
+        # video's responses once the worker has applied the batch
+        likes, _ = extractLikesAndTags(interactions)
+        if likes:
+            get_user_likes(videoId, session_id)
+            add_user_likes({(session_id, videoId): likes})
+    else:
+        apply_batches([batch])
+
+
+def validate_interactions(interactions):
+    """Raises ValueError unless interactions is a list of [ts, evtType, tc, last_tc]."""
+    if not isinstance(interactions, list):
+        raise ValueError('interactions must be an array')
+    for interaction in interactions:
+        if not isinstance(interaction, list) or len(interaction) != 4:
+            raise ValueError('an interaction must be [ts, evtType, tc, last_tc]')
+        ts, evtType, tc, last_tc = interaction
+        if not isinstance(evtType, basestring):
+            raise ValueError('evtType must be a string')
+        for number in (ts, tc, last_tc):
+            if isinstance(number, bool) or not isinstance(number, (int, long, float)) \
+               or math.isinf(number) or math.isnan(number):
+                raise ValueError('ts, tc and last_tc must be finite numbers')
+
+
+def apply_batches(batches):
+    """
+    Applies interaction batches using one bulk write per collection, in the
+    stages of APPLY_STAGES. The interactions are only appended to sessions
+    owned by the batch's user session, so ownership need not be checked
+    against the database first.
+    
+    Batches with a sequence number are dropped if the session has already
+    received it (see Storage.append_interactions), so clients and queues
+    can safely retry them.
+    """
+    for stage in APPLY_STAGES:
+        batches = stage(batches)
+        if not batches:
+            return
+
+
+def apply_in_stages(pending):
+    """
+    Applies batches that still need the stages of APPLY_STAGES from the i-th
+    on: [batches of stage 0, batches of stage 1, ...]. A stage that fails is
+    retried batch by batch. Returns the batches to retry after a transient
+    error (a storage.TRANSIENT_ERRORS), in the same form, and the batches
+    that cannot be applied.
+    """
+    transient = current_app.storage.TRANSIENT_ERRORS
+    remaining = [[] for _ in APPLY_STAGES]
+    failed = []
+    batches = []
+    for i, stage in enumerate(APPLY_STAGES):
+        batches = batches + pending[i]
+        if not batches:
+            continue
+        try:
+            batches = stage(batches)
+            continue
+        except transient:
+            log.exception('Stage %s of %d interaction batches failed' % (stage.__name__, len(batches)))
+            remaining[i:] = [batches] + pending[i+1:]
+            return remaining, failed
+        except Exception:
+            log.exception('Stage %s of %d interaction batches failed; applying them one by one' % (stage.__name__, len(batches)))
+        
+        applied = []
+        for batch in batches:
+            try:
+                applied.extend(stage([batch]))
+            except transient:
+                remaining[i].append(batch)
+            except Exception:
+                log.exception('Cannot apply interaction batch of session %s' % batch[0])
+                failed.append(batch)
+        batches = applied
+    return remaining, failed
+
+
+def store_interactions(batches):
+    """Appends the interactions of batches, returns the batches their sessions have received."""
+    storage = current_app.storage
+    
+    # Sequence numbers of a session are applied in order, and only once
+    unique = []
+    seen = set()
+    for batch in sorted(batches, key=lambda batch: batch[4]):
+        token, seq = batch[0], batch[4]
+        if not batch[3] or (seq is not None and (token, seq) in seen):
+            continue
+        seen.add( (token, seq) )
+        unique.append(batch)
+    if not unique:
+        return []
+    
+    rejected = append_batches(unique)
+    accepted = [batch for batch in unique if batch[0] not in rejected]
+    
+    # A session that received some of the batches gets the remaining ones.
+    # The batches it has received may still lack their likes and aggregate
+    # updates (when applying those failed), which are applied only once too.
+    retry = []
+    for token in rejected:
+        tokenBatches = [batch for batch in unique if batch[0] == token]
+        if all(batch[4] is None for batch in tokenBatches):
+            continue
+        session = storage.get_interaction_session(token)
+        if session is None or session['userSession'] != tokenBatches[0][2]:
+            continue
+        mark = session.get('seq', 0)
+        retry.extend(batch for batch in tokenBatches if batch[4] is None or batch[4] > mark)
+        accepted.extend(batch for batch in tokenBatches if batch[4] is not None and batch[4] <= mark)
+    if retry:
+        rejected = append_batches(retry)
+        accepted.extend(batch for batch in retry if batch[0] not in rejected)
+    accepted.sort(key=lambda batch: batch[4])
+    return accepted
+
+
+def store_user_interactions(batches):
+    """Appends the likes and tags of batches to their user sessions, once per batch."""
+    rejected = append_user_batches(batches)
+    retry = []
+    for session_id, token in rejected:
+        tokenBatches = [batch for batch in batches if batch[0] == token and batch[2] == session_id]
+        interactionSession = current_app.storage.get_interaction_session(token) or {}
+        mark = interactionSession.get('userSeq', 0)
+        retry.extend(batch for batch in tokenBatches if batch[4] is None or batch[4] > mark)
+    if retry:
+        append_user_batches(retry)
+    return batches
+
+
+def update_aggregates(batches):
+    """Marks the sessions of batches as changed in their video aggregates (idempotent)."""
+    videoUpdates = {}                   # videoId -> tokens
+    for token, videoId, session_id, interactions, seq in batches:
+        videoTokens = videoUpdates.setdefault(videoId, [])
+        if token not in videoTokens:
+            videoTokens.append(token)
+    aggregates.apply_interaction_updates(videoUpdates)
+    return batches
+
+
+# Stages of applying batches, each passing the batches on to the next one
+APPLY_STAGES = (store_interactions, store_user_interactions, update_aggregates)
+
+
+def append_batches(batches):
+    """Appends the interactions of batches to their sessions, returns the set of rejected tokens."""
+    sessionInteractions = OrderedDict() # token -> interactions
+    owners = {}                         # token -> session_id
+    seqs = {}                           # token -> (first, last)
+    for token, videoId, session_id, interactions, seq in batches:
+        sessionInteractions.setdefault(token, []).extend(interactions)
+        owners[token] = session_id
+        if seq is not None:
+            first, last = seqs.get(token, (seq, seq))
+            seqs[token] = (min(first, seq), max(last, seq))
+    
+    encoding = current_app.config['INTERACTION_ENCODING']
+    if encoding != 'raw':
+        for token, interactions in sessionInteractions.iteritems():
+            sessionInteractions[token] = encode_interactions(interactions, encoding)
+    return set(current_app.storage.append_interactions(sessionInteractions, owners, seqs))
+
+
+def append_user_batches(batches):
+    """Appends the likes and tags of batches to their user sessions, returns the set of rejected (session_id, token)."""
+    userUpdates = OrderedDict()         # (session_id, token) -> (videoId, likes, tags)
+    seqs = {}                           # (session_id, token) -> (first, last)
+    for token, videoId, session_id, interactions, seq in batches:
+        likes, tags = extractLikesAndTags(interactions)
+        if not likes and not tags:
+            continue
+        key = (session_id, token)
+        _, userLikes, userTags = userUpdates.setdefault(key, (videoId, [], []))
+        userLikes.extend(likes)
+        userTags.extend(tags)
+        if seq is not None:
+            first, last = seqs.get(key, (seq, seq))
+            seqs[key] = (min(first, seq), max(last, seq))
+    if not userUpdates:
+        return set()
+    
+    rejected = set(current_app.storage.append_user_interactions(userUpdates, seqs))
+    userLikes = {}
+    for key, (videoId, likes, tags) in userUpdates.iteritems():
+        if likes and key not in rejected:
+            userLikes.setdefault( (key[0], videoId), [] ).extend(likes)
+    add_user_likes(userLikes)
+    return rejected
+
+
+class InteractionBuffer(object):
+    """Buffers interaction batches and flushes them from a background thread."""
+    
+    def __init__(self, app, flush_interval, flush_size):
+        self.app = app
+        self.flush_interval = flush_interval
+        self.flush_size = flush_size
+        
+        self._pending = [[] for _ in APPLY_STAGES]
+        self._numInteractions = 0
+        self._lock = Lock()
+        self._wakeup = Event()
+        self._stopping = False
+        self._thread = None
+    
+    def add(self, batch):
+        with self._lock:
+            if self._thread is None:
+                self._start()
+            self._pending[0].append(batch)
+            self._numInteractions += len(batch[3])
+            full = self._numInteractions >= self.flush_size
+        
+        if full:
+            self._wakeup.set()
+    
+    def pending(self):
+        """Returns the number of buffered interactions."""
+        return self._numInteractions
+    
+    def flush(self):
+        with self._lock:
+            pending = self._pending
+            self._pending = [[] for _ in APPLY_STAGES]
+            self._numInteractions = 0
+        
+        if not any(pending):
+            return
+        
+        # Batches are retried from the stage that failed, and only if it may succeed later
+        with self.app.app_context():
+            remaining, failed = apply_in_stages(pending)
+        if failed:
+            self.app.logger.error('Dropped %d interaction batches that cannot be applied: %s' % (len(failed), json.dumps(failed)))
+        if any(remaining):
+            self.app.logger.warning('Applying %d interaction batches failed; will retry' % sum(map(len, remaining)))
+            with self._lock:
+                for stage, batches in enumerate(remaining):
+                    self._pending[stage][0:0] = batches
+                self._numInteractions += sum(len(batch[3]) for batch in remaining[0])
+    
+    def stop(self):
+        """Stops the background thread and drains the buffer."""
+        thread = self._thread
+        self._stopping = True
+        self._wakeup.set()
+        if thread is not None:
+            thread.join()
+        self.flush()
+    
+    def _start(self):
+        # Started lazily, i.e., after a (pre-)forking server has forked
+        self._thread = Thread(target=self._run, name='InteractionBuffer')
+        self._thread.daemon = True
+        self._thread.start()
+        atexit.register(self.stop)
+    
+    def _run(self):
+        while not self._stopping:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            self.flush()
+
+
+# Ingestion log
+
+# File in the log directory holding the offset up to which batches have been applied
+CHECKPOINT_FILE = 'checkpoint'
+
+def list_segments(directory):
+    """Returns the (offset, path) of the segments of an ingestion log, oldest first."""
+    segments = []
+    for filename in os.listdir(directory):
+        name, ext = os.path.splitext(filename)
+        if ext == '.log' and name.isdigit():
+            segments.append( (int(name), os.path.join(directory, filename)) )
+    return sorted(segments)
+
+
+class IngestLog(object):
+    """
+    Durable, append-only log of interaction batches, one JSON line per batch.
+    The log is split into segment files named after the log offset of their
+    first byte. A new segment is started once the newest one reaches
+    segment_size bytes, and whenever the log is opened, so that only the
+    newest segment can end in a partially written line.
+    
+    fsync: 'always' (every batch), 'interval' (at most every fsync_interval
+    seconds) or 'never' (left to the OS). Only one process can write a log.
+    """
+    
+    def __init__(self, directory, segment_size, fsync='interval', fsync_interval=1.0):
+        self.directory = directory
+        self.segment_size = segment_size
+        self.fsync = fsync
+        self.fsync_interval = fsync_interval
+        
+        self._lock = Lock()
+        self._lockfile = None
+        self._fh = None
+        self._start = 0
+        self._size = 0
+        self._synced = time.time()
+        
+        self._pendingVideos = {}        # videoId -> log offset following its last batch
+        self._checkpointMtime = None
+    
+    def append(self, batch):
+        line = json.dumps(batch, separators=(',', ':')) + '\n'
+        with self._lock:
+            if self._lockfile is None:
+                self._acquire()
+            if self._size >= self.segment_size:
+                self._open(self._start + self._size)
+            self._fh.write(line)
+            self._fh.flush()
+            self._size += len(line)
+            self._pendingVideos[batch[1]] = self._start + self._size
+            
+            now = time.time()
+            if self.fsync == 'always' or (self.fsync == 'interval' and now - self._synced >= self.fsync_interval):
+                os.fsync(self._fh.fileno())
+                self._synced = now
+    
+    def applied_videos(self):
+        """
+        Returns the videos all of whose batches the worker has applied since
+        the previous call, as seen from its checkpoint.
+        """
+        checkpointPath = os.path.join(self.directory, CHECKPOINT_FILE)
+        with self._lock:
+            if not self._pendingVideos:
+                return []
+            try:
+                mtime = os.stat(checkpointPath).st_mtime
+                if mtime == self._checkpointMtime:
+                    return []
+                with open(checkpointPath, 'r') as fh:
+                    offset = json.load(fh)['offset']
+            except (EnvironmentError, ValueError, KeyError):
+                return []
+            self._checkpointMtime = mtime
+            
+            applied = [videoId for videoId, end in self._pendingVideos.iteritems() if end <= offset]
+            for videoId in applied:
+                del self._pendingVideos[videoId]
+            return applied
+    
+    def close(self):
+        with self._lock:
+            if self._fh is not None:
+                self._fh.flush()
+                os.fsync(self._fh.fileno())
+                self._fh.close()
+                self._fh = None
+    
+    def _acquire(self):
+        # Opened lazily, i.e., in the process that serves requests
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        lockfile = open(os.path.join(self.directory, 'writer.lock'), 'w')
+        try:
+            fcntl.flock(lockfile, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError:
+            lockfile.close()
+            raise IOError('Ingestion log %s is in use by another process' % self.directory)
+        self._lockfile = lockfile
+        
+        segments = list_segments(self.directory)
+        if segments:
+            offset, path = segments[-1]
+            self._start = offset
+            self._size = os.path.getsize(path)
+        self._open(self._start + self._size)
+        atexit.register(self.close)
+    
+    def _open(self, offset):
+        if self._fh is not None:
+            self._fh.flush()
+            os.fsync(self._fh.fileno())
+            self._fh.close()
+        self._start = offset
+        self._size = 0
+        self._fh = open(os.path.join(self.directory, '%020d.log' % offset), 'ab')
+
+
+def expire_applied_responses():
+    """In log mode, drops the cached responses of videos whose batches the worker has applied."""
+    ingestLog = current_app.ingest_log
+    if ingestLog is not None:
+        for videoId in ingestLog.applied_videos():
+            current_app.response_cache.invalidate(videoId)
+
+
+class IngestLogReader(object):
+    """
+    Reads the batches of an ingestion log following a checkpoint, the log
+    offset up to which batches have been applied. The checkpoint is only
+    advanced after the batches have been applied, so batches are applied at
+    least once. Segments before the checkpoint are deleted.
+    """
+    
+    def __init__(self, directory):
+        self.directory = directory
+        self.checkpointPath = os.path.join(directory, CHECKPOINT_FILE)
+        self.offset = 0
+        if os.path.exists(self.checkpointPath):
+            with open(self.checkpointPath, 'r') as fh:
+                self.offset = json.load(fh)['offset']
+    
+    def read(self, maxInteractions):
+        """Returns the next batches (about maxInteractions interactions) and the offset following them."""
+        batches = []
+        numInteractions = 0
+        offset = self.offset
+        
+        segments = list_segments(self.directory)
+        for i, (start, path) in enumerate(segments):
+            newest = i == len(segments) - 1
+            if not newest and offset >= segments[i+1][0]:
+                continue
+            offset = max(offset, start)
+            
+            with open(path, 'rb') as fh:
+                fh.seek(offset - start)
+                for line in fh:
+                    if not line.endswith('\n'):
+                        if newest:
+                            # Still being written
+                            break
+                        log.warning('Skipping partially written batch at offset %d' % offset)
+                    offset += len(line)
+                    try:
+                        batch = json.loads(line)
+                        numInteractions += len(batch[3])
+                    except (ValueError, TypeError, KeyError, IndexError):
+                        log.error('Skipping malformed batch before offset %d: %r' % (offset, line))
+                        continue
+                    # Batches logged before sequence numbers have none
+                    batches.append(tuple(batch) + (None,) * (5 - len(batch)))
+                    if numInteractions >= maxInteractions:
+                        return batches, offset
+        return batches, offset
+    
+    def commit(self, offset):
+        """Stores the checkpoint and deletes the segments that precede it."""
+        tmpPath = self.checkpointPath + '.tmp'
+        with open(tmpPath, 'w') as fh:
+            json.dump({'offset': offset}, fh)
+            fh.flush()
+            os.fsync(fh.fileno())
+        os.rename(tmpPath, self.checkpointPath)
+        self.offset = offset
+        
+        segments = list_segments(self.directory)
+        for (start, path), (end, _) in zip(segments, segments[1:]):
+            if end <= offset:
+                os.remove(path)
+    
+    def pending(self):
+        """Returns the number of bytes of the log following the checkpoint."""
+        segments = list_segments(self.directory)
+        if not segments:
+            return 0
+        start, path = segments[-1]
+        return max(0, start + os.path.getsize(path) - self.offset)
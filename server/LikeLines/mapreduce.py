@@ -0,0 +1,110 @@
+"""
+Parallel (map-reduce) aggregation of the interaction sessions of a video.
+
+The sessions of a video are split into ranges of _ids. A pool of worker
+processes aggregates the ranges (map), after which the partial aggregates
+are merged in _id order (reduce). Workers read their ranges through their
+own storage connection. With the 'memory' engine, whose data only lives in
+the server process, the sessions are read by the server and sent to the
+workers in batches instead.
+
+Enabled with AGGREGATE_WORKERS > 0. Videos with fewer sessions than
+AGGREGATE_PARALLEL_MIN_SESSIONS are aggregated serially, as starting the
+map tasks would take longer than aggregating them.
+"""
+
+from flask import current_app
+import aggregates
+
+import atexit
+import multiprocessing
+
+# Ranges per worker, such that workers that finish early pick up more work
+RANGES_PER_WORKER = 4
+# Sessions per batch sent to the workers (memory engine)
+BATCH_SIZE = 1000
+
+# State of a worker process, see _init_worker
+_worker = {}
+
+
+def create_pool(app):
+    """Starts the worker processes. Must be called before any threads are started."""
+    workers = app.config['AGGREGATE_WORKERS']
+    pool = multiprocessing.Pool(workers, _init_worker, (dict(app.config),))
+    atexit.register(pool.terminate)
+    return pool
+
+
+def rebuild(pool, aggregate):
+    """
+    Aggregates all sessions of the video of `aggregate` (an empty aggregate
+    object) in parallel. Returns False if the video is too small to do so.
+    """
+    storage = current_app.storage
+    videoId = aggregate['_id']
+    
+    ids = storage.find_interaction_session_ids(videoId)
+    if len(ids) < current_app.config['AGGREGATE_PARALLEL_MIN_SESSIONS']:
+        return False
+    
+    if current_app.config['STORAGE_ENGINE'] == 'memory':
+        partials = pool.imap(aggregate_batch, batches(storage.find_interaction_sessions(videoId), BATCH_SIZE))
+    else:
+        numRanges = current_app.config['AGGREGATE_WORKERS'] * RANGES_PER_WORKER
+        tasks = [(videoId, after, until) for after, until in split_ranges(ids, numRanges)]
+        partials = pool.imap(_aggregate_range, tasks)
+    
+    for partial in partials:
+        aggregates.merge_aggregates(aggregate, partial)
+    return True
+
+
+def split_ranges(ids, numRanges):
+    """
+    Splits sorted _ids into at most numRanges ranges of about equal size:
+    [(after, until), ...]. The first and last range are open-ended.
+    """
+    size = max(1, -(-len(ids) // numRanges))
+    bounds = ids[size-1:len(ids)-1:size]
+    return zip([None] + bounds, bounds + [None])
+
+
+def batches(interactionSessions, size):
+    """Groups (_id, interactions) of interaction sessions in lists of `size`."""
+    batch = []
+    for interactionSession in interactionSessions:
+        batch.append( (interactionSession['_id'], interactionSession['interactions']) )
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+# Worker processes
+
+def _init_worker(config):
+    from server import create_app, create_db
+    
+    config.update({
+        'INGEST_MODE': 'direct',
+        'METRICS_ENABLED': False,
+        'AGGREGATE_WORKERS': 0
+    })
+    app = create_app(config)
+    if config['STORAGE_ENGINE'] != 'memory':
+        with app.app_context():
+            app.storage = create_db(app)
+    _worker['app'] = app
+
+def _aggregate_range( (videoId, after, until) ):
+    app = _worker['app']
+    with app.app_context():
+        interactionSessions = app.storage.scan('interactionSessions', videoId, after, until)
+        return aggregates.aggregate_sessions(interactionSessions, aggregates.empty_aggregate_object(videoId))
+
+def aggregate_batch(batch):
+    """Aggregates a batch of (_id, interactions). Needs no worker state."""
+    interactionSessions = ({'_id': token, 'interactions': interactions} for token, interactions in batch)
+    return aggregates.aggregate_sessions(interactionSessions, aggregates.empty_aggregate_object(None))
@@ -0,0 +1,196 @@
+"""
+Request, database and cache metrics, exposed in the Prometheus text format
+on /metrics.
+
+Recording a sample only updates a few in-process counters; nothing is
+computed until /metrics is scraped. Like the caches, metrics are local to a
+single server process.
+"""
+
+from flask import Blueprint, current_app, request, g, has_request_context
+from threading import Lock
+from bisect import bisect_left
+
+from usersession import sessionless
+
+import time
+
+blueprint = Blueprint('metrics', __name__)
+
+DURATION_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SIZE_BUCKETS = (64, 256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+class Metrics(object):
+    """Registry of counters and histograms, keyed by metric name and labels.
+
+    Labels are passed as a tuple of (name, value) pairs.
+    """
+    
+    def __init__(self):
+        self._lock = Lock()
+        self._meta = {}       # name -> (type, help, buckets)
+        self._values = {}     # name -> {labels: value or [bucket counts..., +Inf, count, sum]}
+        self._collectors = [] # (name, type, help, fn) with fn() -> {labels: value}
+    
+    def counter(self, name, help):
+        self._meta[name] = ('counter', help, None)
+        self._values[name] = {}
+    
+    def histogram(self, name, help, buckets=DURATION_BUCKETS):
+        self._meta[name] = ('histogram', help, buckets)
+        self._values[name] = {}
+    
+    def collector(self, name, type, help, fn):
+        """Registers a metric whose values are read from `fn` when scraped."""
+        self._collectors.append((name, type, help, fn))
+    
+    def inc(self, name, labels=(), value=1):
+        values = self._values[name]
+        with self._lock:
+            values[labels] = values.get(labels, 0) + value
+    
+    def observe(self, name, labels, value):
+        buckets = self._meta[name][2]
+        values = self._values[name]
+        with self._lock:
+            sample = values.get(labels)
+            if sample is None:
+                sample = values[labels] = [0] * (len(buckets) + 3)
+            sample[bisect_left(buckets, value)] += 1
+            sample[-2] += 1
+            sample[-1] += value
+    
+    def render(self):
+        lines = []
+        with self._lock:
+            snapshot = [(name, self._meta[name], dict((labels, list(sample) if isinstance(sample, list) else sample)
+                                                      for labels, sample in values.iteritems()))
+                        for name, values in sorted(self._values.iteritems())]
+        
+        for name, (type, help, buckets), values in snapshot:
+            lines.append('# HELP %s %s' % (name, help))
+            lines.append('# TYPE %s %s' % (name, type))
+            for labels, sample in sorted(values.iteritems()):
+                if type == 'histogram':
+                    cumulative = 0
+                    for le, n in zip(buckets, sample):
+                        cumulative += n
+                        lines.append('%s_bucket%s %d' % (name, format_labels(labels + (('le', repr(float(le))),)), cumulative))
+                    lines.append('%s_bucket%s %d' % (name, format_labels(labels + (('le', '+Inf'),)), sample[-2]))
+                    lines.append('%s_count%s %d' % (name, format_labels(labels), sample[-2]))
+                    lines.append('%s_sum%s %s' % (name, format_labels(labels), repr(float(sample[-1]))))
+                else:
+                    lines.append('%s%s %s' % (name, format_labels(labels), format_value(sample)))
+        
+        for name, type, help, fn in self._collectors:
+            lines.append('# HELP %s %s' % (name, help))
+            lines.append('# TYPE %s %s' % (name, type))
+            for labels, value in sorted(fn().iteritems()):
+                lines.append('%s%s %s' % (name, format_labels(labels), format_value(value)))
+        
+        return '\n'.join(lines) + '\n'
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (k, str(v).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n'))
+                             for k, v in labels)
+
+def format_value(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class InstrumentedStorage(object):
+    """Wraps a storage engine to count and time its operations.
+
+    Operations returning lazily evaluated results (e.g., cursors) are timed
+    up to the creation of the result.
+    """
+    
+    def __init__(self, storage, metrics):
+        self._storage = storage
+        self._metrics = metrics
+    
+    def __getattr__(self, name):
+        attr = getattr(self._storage, name)
+        if name.startswith('_') or not callable(attr):
+            return attr
+        
+        metrics = self._metrics
+        labels = (('operation', name),)
+        def timed(*args, **kwargs):
+            start = time.time()
+            try:
+                return attr(*args, **kwargs)
+            finally:
+                metrics.observe('likelines_db_operation_duration_seconds', labels, time.time() - start)
+                if has_request_context():
+                    g.metrics_db_operations = getattr(g, 'metrics_db_operations', 0) + 1
+        
+        # Subsequent lookups no longer go through __getattr__
+        setattr(self, name, timed)
+        return timed
+
+
+def create_metrics(app):
+    metrics = Metrics()
+    metrics.counter('likelines_requests_total',
+                    'Number of requests by endpoint and status code.')
+    metrics.histogram('likelines_request_duration_seconds',
+                      'Request processing time by endpoint.')
+    metrics.histogram('likelines_request_size_bytes',
+                      'Size of the request payload (query string and body) by endpoint.', SIZE_BUCKETS)
+    metrics.histogram('likelines_response_size_bytes',
+                      'Size of the response body by endpoint.', SIZE_BUCKETS)
+    metrics.histogram('likelines_request_db_operations',
+                      'Number of database operations per request by endpoint.', COUNT_BUCKETS)
+    metrics.histogram('likelines_db_operation_duration_seconds',
+                      'Database operation time by operation; its _count is the number of operations.')
+    
+    metrics.collector('likelines_cache_hits_total', 'counter',
+                      'Number of cache hits by cache.',
+                      lambda: {(('cache', 'response'),): app.response_cache.hits,
+                               (('cache', 'user_likes'),): app.user_likes_cache.hits,
+                               (('cache', 'session_owner'),): app.session_owner_cache.hits})
+    metrics.collector('likelines_cache_misses_total', 'counter',
+                      'Number of cache misses by cache.',
+                      lambda: {(('cache', 'response'),): app.response_cache.misses,
+                               (('cache', 'user_likes'),): app.user_likes_cache.misses,
+                               (('cache', 'session_owner'),): app.session_owner_cache.misses})
+    if app.interaction_buffer is not None:
+        metrics.collector('likelines_ingest_buffered_interactions', 'gauge',
+                          'Number of buffered interactions waiting to be flushed.',
+                          lambda: {(): app.interaction_buffer.pending()})
+    return metrics
+
+
+def start_request():
+    g.metrics_start = time.time()
+    g.metrics_db_operations = 0
+
+def finish_request(response):
+    start = getattr(g, 'metrics_start', None)
+    if start is None:
+        return response
+    
+    metrics = current_app.metrics
+    labels = (('endpoint', request.endpoint or 'none'),)
+    metrics.inc('likelines_requests_total', labels + (('status', response.status_code),))
+    metrics.observe('likelines_request_duration_seconds', labels, time.time() - start)
+    metrics.observe('likelines_request_size_bytes', labels,
+                    len(request.query_string) + (request.content_length or 0))
+    if response.content_length is not None:
+        metrics.observe('likelines_response_size_bytes', labels, response.content_length)
+    metrics.observe('likelines_request_db_operations', labels, g.metrics_db_operations)
+    return response
+
+
+@blueprint.route('/metrics')
+@sessionless
+def LL_metrics():
+    return current_app.response_class(current_app.metrics.render(), content_type=CONTENT_TYPE)
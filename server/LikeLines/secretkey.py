@@ -32,6 +32,13 @@ def load_secret_key(path, app=None):
 def compute_signature(key, msg):
     return "%s" % hmac(key, msg, sha1).digest().encode('base64')[:-1]
 
+def new_signature(key):
+    """Returns an HMAC object to compute a signature incrementally with update()."""
+    return hmac(key, '', sha1)
+
+def finish_signature(mac):
+    return "%s" % mac.digest().encode('base64')[:-1]
+
 if __name__ == '__main__':
     print generate_secret_key()
 
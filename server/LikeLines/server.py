@@ -8,16 +8,21 @@ DEFAULT_PORT = 9090
 SECRET_KEY_PATH = '.likelines_secret_key'
 
 from flask import Flask, session, request, redirect, url_for
-from flask.ext.pymongo import PyMongo
 
 from debug import debug_pages
 from usersession import ensure_session, get_session_id
 from flaskutil import crossdomain, p3p
+from cache import ResponseCache, LRUCache
+from storage import create_storage
+from ingest import InteractionBuffer, IngestLog
+import mapreduce
 import api
+import metrics
 
 from secretkey import load_secret_key
 
 import os
+import logging
 from optparse import OptionParser
 
 default_config = {
@@ -31,7 +36,46 @@ default_config = {
     'MONGO_USERNAME': None,
     'MONGO_PASSWORD': None,
     
-    'MONGO_DBNAME': 'LikeLinesDB'
+    'MONGO_DBNAME': 'LikeLinesDB',
+    
+    'STORAGE_ENGINE': 'mongo',   # 'mongo' | 'sqlite' | 'memory'
+    'SQLITE_PATH': 'likelines.sqlite',
+    
+    'MAX_HEATMAP_WIDTH': 4096,
+    'MAX_HEATMAP_DURATION': 24*3600, # seconds
+    'MAX_AGGREGATE_BINS': 100000,
+    'MAX_AGGREGATE_VIDEOS': 100, # per /aggregateMany request
+    
+    'RESPONSE_CACHE_SIZE': 1000, # videos
+    'RESPONSE_CACHE_TTL': 60,    # seconds
+    
+    'USER_CACHE_SIZE': 10000,    # (user session, video) pairs
+    'USER_CACHE_TTL': 300,       # seconds
+    
+    'SESSION_OWNER_CACHE_SIZE': 100000, # interaction sessions
+    
+    'INGEST_MODE': 'direct',     # 'direct' | 'buffered' | 'log'
+    'INGEST_FLUSH_INTERVAL': 2.0, # seconds
+    'INGEST_FLUSH_SIZE': 1000,   # interactions
+    'INGEST_LOG_DIR': 'ingest-log',
+    'INGEST_LOG_SEGMENT_SIZE': 64*1024*1024, # bytes
+    'INGEST_LOG_FSYNC': 'interval', # 'always' | 'interval' | 'never'
+    'INGEST_LOG_FSYNC_INTERVAL': 1.0, # seconds
+    
+    'INTERACTION_ENCODING': 'raw', # 'raw' | 'packed', see codec.py
+    
+    'MAX_BATCH_BODY_SIZE': 1024*1024, # bytes, decompressed /postInteractions body
+    'MAX_MCA_BODY_SIZE': 64*1024*1024, # bytes, decompressed /postMCA body
+    'MAX_UPLOAD_BODY_SIZE': 1024*1024*1024, # bytes, bulk /adminInteractions upload (spooled to disk)
+    
+    'AGGREGATE_WORKERS': 0,      # processes, 0: aggregate in the request thread
+    'AGGREGATE_PARALLEL_MIN_SESSIONS': 10000,
+    'AGGREGATE_SAMPLE_SIZE': 1000, # sessions kept in the sample of each video
+    'AGGREGATE_APPROX_MIN_SESSIONS': 0, # approximate /aggregate from this many sessions, 0: only on request
+    
+    'HIGHLIGHTS_K': 10,          # top segments kept per video
+    
+    'METRICS_ENABLED': True
 }
 
 def create_app(config=None):
@@ -42,14 +86,41 @@ def create_app(config=None):
     if config is not None:
         app.config.update(config)
     
+    app.response_cache = ResponseCache(app.config['RESPONSE_CACHE_SIZE'], app.config['RESPONSE_CACHE_TTL'])
+    app.user_likes_cache = LRUCache(app.config['USER_CACHE_SIZE'], app.config['USER_CACHE_TTL'])
+    app.session_owner_cache = LRUCache(app.config['SESSION_OWNER_CACHE_SIZE'])
+    
+    # Started first, as worker processes are forked
+    app.aggregate_pool = None
+    if app.config['AGGREGATE_WORKERS'] > 0:
+        app.aggregate_pool = mapreduce.create_pool(app)
+    
+    app.interaction_buffer = None
+    if app.config['INGEST_MODE'] == 'buffered':
+        app.interaction_buffer = InteractionBuffer(app, app.config['INGEST_FLUSH_INTERVAL'], app.config['INGEST_FLUSH_SIZE'])
+    
+    app.ingest_log = None
+    if app.config['INGEST_MODE'] == 'log':
+        app.ingest_log = IngestLog(app.config['INGEST_LOG_DIR'], app.config['INGEST_LOG_SEGMENT_SIZE'],
+                                   app.config['INGEST_LOG_FSYNC'], app.config['INGEST_LOG_FSYNC_INTERVAL'])
+    
+    app.metrics = None
+    if app.config['METRICS_ENABLED']:
+        app.metrics = metrics.create_metrics(app)
+        app.before_request(metrics.start_request)
+        app.after_request(metrics.finish_request)
+        app.register_blueprint(metrics.blueprint)
+    
     app.before_request(ensure_session)
     app.register_blueprint(api.blueprint)
     
     return app
 
 def create_db(app):
-    mongo = PyMongo(app)
-    return mongo
+    storage = create_storage(app)
+    if app.metrics is not None:
+        storage = metrics.InstrumentedStorage(storage, app.metrics)
+    return storage
 
 def get_optionparser():
     qualified_module_name = '%s.%s' % (__package__, os.path.splitext(os.path.basename(__file__))[0])
@@ -67,13 +138,68 @@ def get_optionparser():
                       default=DEFAULT_HOST,
                       help='Listen ip (default: %s)' % DEFAULT_HOST)
     
+    parser.add_option('--storage',
+                      dest='storage',
+                      metavar='ENGINE',
+                      choices=['mongo', 'sqlite', 'memory'],
+                      default=default_config['STORAGE_ENGINE'],
+                      help='Storage engine: mongo, sqlite or memory (default: %s)' % default_config['STORAGE_ENGINE'])
+    
+    parser.add_option('--sqlite',
+                      dest='sqlite_path',
+                      metavar='PATH',
+                      default=default_config['SQLITE_PATH'],
+                      help='SQLite database file (default: %s)' % default_config['SQLITE_PATH'])
+    
+    parser.add_option('--aggregate-workers',
+                      dest='aggregate_workers',
+                      metavar='N',
+                      type='int',
+                      default=default_config['AGGREGATE_WORKERS'],
+                      help='Number of processes that rebuild aggregates of large videos (default: %d)' % default_config['AGGREGATE_WORKERS'])
+    
+    parser.add_option('--ingest',
+                      dest='ingest_mode',
+                      metavar='MODE',
+                      choices=['direct', 'buffered', 'log'],
+                      default=default_config['INGEST_MODE'],
+                      help='Ingestion of interactions: direct, buffered or log (default: %s)' % default_config['INGEST_MODE'])
+    
+    parser.add_option('--ingest-log',
+                      dest='ingest_log_dir',
+                      metavar='DIR',
+                      default=default_config['INGEST_LOG_DIR'],
+                      help='Directory of the ingestion log (default: %s)' % default_config['INGEST_LOG_DIR'])
+    
+    parser.add_option('--log-level',
+                      dest='log_level',
+                      metavar='LEVEL',
+                      choices=['debug', 'info', 'warning', 'error'],
+                      default='info',
+                      help='Log level: debug, info, warning or error (default: info)')
+    
+    parser.add_option('--no-metrics',
+                      dest='metrics',
+                      action='store_false',
+                      default=True,
+                      help='Disable the /metrics endpoint and request instrumentation')
+    
     return parser
 
 if __name__ == "__main__":
     options, _ = get_optionparser().parse_args()
+    logging.basicConfig(level=getattr(logging, options.log_level.upper()),
+                        format='%(asctime)s %(levelname)s %(name)s: %(message)s')
     
-    app = create_app()
-    app.mongo = create_db(app)
+    app = create_app({
+        'STORAGE_ENGINE': options.storage,
+        'SQLITE_PATH': options.sqlite_path,
+        'METRICS_ENABLED': options.metrics,
+        'AGGREGATE_WORKERS': options.aggregate_workers,
+        'INGEST_MODE': options.ingest_mode,
+        'INGEST_LOG_DIR': options.ingest_log_dir
+    })
+    app.storage = create_db(app)
     
     @app.route("/")
     @crossdomain()
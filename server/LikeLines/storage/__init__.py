@@ -0,0 +1,43 @@
+"""
+Pluggable storage engines.
+
+All data access of the LikeLines server goes through a storage engine
+(`current_app.storage`), selected with the STORAGE_ENGINE config setting:
+
+ * 'mongo':  MongoDB (default), see storage.mongo
+ * 'sqlite': embedded SQLite database file (SQLITE_PATH), see storage.sqlite
+ * 'memory': non-persistent, in-process storage, see storage.memory
+
+Stored documents:
+
+ * interaction session: {'_id': token, 'videoId', 'ts', 'interactions', 'numInteractions', 'userSession',
+                         'seq', 'userSeq'}, with the marks of the batches it and its user session
+                        received (see Storage.append_interactions, append_user_interactions)
+ * interaction chunk:   {'_id': token/seq, 'token', 'seq', 'videoId', 'n', 'interactions'}
+                        holding the interactions of a session, see base.INTERACTION_CHUNK_SIZE;
+                        the chunks (buckets) appended to by MongoDB are not filled by slot, but
+                        list the 'appends' they received, and the session has the open 'bucket'
+ * user session:        {'_id': session_id, 'ts', 'likes': {videoId: [tc]}, 'tags': {videoId: [[tc, tag]]}},
+                        with the most recent 'batches' appended by MongoDB
+ * MCA:                 {mcaName: {'type', 'data', 'weight'}} per videoId
+ * video aggregate:     {'_id': videoId, 'numSessions', 'epoch', 'size', 'playbacks', 'likedPoints',
+                         'taggedPoints', 'changed', 'versions', 'sizes'}, see aggregates.py
+ * session sample:      {'_id': videoId, 'n', 'tokens'}, see aggregates.get_session_sample
+"""
+
+from base import Storage
+
+
+def create_storage(app):
+    engine = app.config.get('STORAGE_ENGINE', 'mongo')
+    if engine == 'mongo':
+        from mongo import MongoStorage
+        return MongoStorage(app)
+    elif engine == 'sqlite':
+        from sqlite import SQLiteStorage
+        return SQLiteStorage(app.config['SQLITE_PATH'])
+    elif engine == 'memory':
+        from memory import MemoryStorage
+        return MemoryStorage()
+    else:
+        raise ValueError('Unknown storage engine: %s' % engine)
@@ -0,0 +1,278 @@
+"""
+Storage engine interface.
+"""
+
+import random
+
+# The interactions of a session are appended to chunk documents with room
+# for this many elements, identified by (token, seq)
+INTERACTION_CHUNK_SIZE = 256
+
+# Likes and tags kept per user session and video (the most recent ones)
+MAX_USER_POINTS = 1000
+
+# Bytes (as JSON) of session entries kept per video aggregate document, well
+# below the 16 MB document limit of MongoDB
+MAX_AGGREGATE_SIZE = 8 * 1024 * 1024
+
+
+
+def chunk_id(token, seq):
+    return '%s/%d' % (token, seq)
+
+def split_into_chunks(start, elements):
+    """Splits elements that occupy the slots start, start+1, ... of a session
+    into [(seq, elements), ...] per chunk."""
+    res = []
+    pos = 0
+    while pos < len(elements):
+        seq, offset = divmod(start + pos, INTERACTION_CHUNK_SIZE)
+        n = min(INTERACTION_CHUNK_SIZE - offset, len(elements) - pos)
+        res.append( (seq, elements[pos:pos+n]) )
+        pos += n
+    return res
+
+def set_aggregate_session(aggregate, token, changed, version, playback, likedPoints, taggedPoints, size):
+    """
+    Sets (or removes, if empty) the entry of a session in a video aggregate
+    (see aggregates.py), unless the entries of the aggregate would then take
+    more than MAX_AGGREGATE_SIZE bytes. Returns whether it was set.
+    """
+    delta = size - aggregate['sizes'].get(token, 0)
+    if aggregate['size'] + delta > MAX_AGGREGATE_SIZE:
+        return False
+    for key, value in (('playbacks', playback), ('likedPoints', likedPoints), ('taggedPoints', taggedPoints)):
+        if value:
+            aggregate[key][token] = value
+        else:
+            aggregate[key].pop(token, None)
+    aggregate['changed'][token] = changed
+    aggregate['versions'][token] = version
+    aggregate['sizes'][token] = size
+    aggregate['size'] += delta
+    return True
+
+def keep_folded_sessions(aggregate, stored):
+    """
+    Sets the entries of sessions folded into the stored version of a video
+    aggregate (see Storage.fold_aggregate_sessions) while it was rebuilt,
+    i.e., of a higher version, in the rebuilt aggregate.
+    """
+    for token, version in stored.get('versions', {}).iteritems():
+        if version > aggregate['versions'].get(token, -1):
+            set_aggregate_session(aggregate, token, stored['changed'][token], version,
+                                  stored['playbacks'].get(token, []), stored['likedPoints'].get(token, []),
+                                  stored['taggedPoints'].get(token, []), stored['sizes'][token])
+
+def reservoir_slot(n, size):
+    """Slot of a sample of `size` to store the n-th (1-based) item of a
+    stream in (reservoir sampling), or None if it is not sampled."""
+    slot = n - 1 if n <= size else random.randrange(n)
+    return slot if slot < size else None
+
+
+class Storage(object):
+    """Interface of the operations the LikeLines server performs on its data."""
+    
+    # Errors after which an operation may succeed when retried (e.g., an
+    # unavailable database), as opposed to errors caused by the data
+    TRANSIENT_ERRORS = (EnvironmentError,)
+    
+    # Interaction sessions
+    
+    def create_interaction_session(self, session):
+        raise NotImplementedError
+    
+    def get_interaction_session(self, token):
+        """Returns the interaction session with the given token, without its
+        interactions, or None."""
+        raise NotImplementedError
+    
+    def get_interaction_session_owner(self, token):
+        """Returns only the videoId and userSession of an interaction session, or None."""
+        raise NotImplementedError
+    
+    def find_interaction_sessions(self, videoId):
+        """Iterates over all interaction sessions of a video, with their interactions."""
+        raise NotImplementedError
+    
+    def get_interaction_sessions(self, tokens):
+        """Iterates over the interaction sessions with the given tokens, with their interactions."""
+        raise NotImplementedError
+    
+    def find_interaction_session_ids(self, videoId):
+        """Returns the sorted _ids of all interaction sessions of a video."""
+        raise NotImplementedError
+    
+    def insert_interaction_sessions(self, sessions):
+        """Inserts sessions and returns the _ids of those that already existed.
+        The session samples of their videos are deleted (to be redrawn)."""
+        raise NotImplementedError
+    
+    def delete_interaction_sessions(self, videoId):
+        """Deletes all interaction sessions of a video and its session sample."""
+        raise NotImplementedError
+    
+    def append_interactions(self, sessionInteractions, owners=None, seqs=None):
+        """Appends interactions in bulk: {token: [interaction, ...]}. If owners
+        ({token: userSession}) is given, interactions are only appended to
+        sessions of those user sessions. If seqs ({token: (first, last)}) has
+        the sequence numbers of a token's batches, its interactions are only
+        appended if the session's high-water mark ('seq') is below `first`,
+        and the mark is raised to `last`. Returns the tokens of the sessions
+        that were not found, not owned or had already received the batches."""
+        raise NotImplementedError
+    
+    def reencode_interactions(self, token, encode):
+        """
+        Replaces each stored array (chunk) of a session's interactions by
+        encode(elements). Chunks that receive new interactions in the
+        meantime are left alone. Returns the numbers of replaced and
+        skipped chunks.
+        """
+        raise NotImplementedError
+    
+    # Session samples: {'_id': videoId, 'n': numSessions, 'tokens': [token, ...]}
+    
+    def get_session_sample(self, videoId):
+        raise NotImplementedError
+    
+    def save_session_sample(self, sample):
+        raise NotImplementedError
+    
+    def delete_session_sample(self, videoId):
+        raise NotImplementedError
+    
+    def add_to_session_sample(self, videoId, token, size):
+        """Counts a new session in the sample of a video (if any) and adds it
+        with reservoir sampling, keeping at most `size` tokens."""
+        raise NotImplementedError
+    
+    # User sessions
+    
+    def get_user_session(self, session_id):
+        """Returns the user session with the given id or None."""
+        raise NotImplementedError
+    
+    def get_user_likes(self, session_id, videoId):
+        """Returns the likes of a user session for a single video."""
+        raise NotImplementedError
+    
+    def get_user_likes_many(self, session_id, videoIds):
+        """Returns the likes of a user session for several videos: {videoId: likes}."""
+        raise NotImplementedError
+    
+    def append_user_interactions(self, userUpdates, seqs=None):
+        """Appends likes and tags in bulk: {(session_id, token): (videoId,
+        likes, tags)}. User sessions that do not exist yet are created. Only
+        the last MAX_USER_POINTS likes and tags per video are kept. If seqs
+        ({(session_id, token): (first, last)}) has the sequence numbers of the
+        batches, they are only appended if the mark of the interaction
+        session ('userSeq') is below `first`, and the mark is raised to `last`.
+        Returns the keys that had already been appended."""
+        raise NotImplementedError
+    
+    # Multimedia content analysis (MCA)
+    
+    def get_mca(self, videoId):
+        """Returns all MCA data of a video: {mcaName: mca}."""
+        raise NotImplementedError
+    
+    def get_mcas(self, videoIds):
+        """Returns all MCA data of several videos: {videoId: {mcaName: mca}}."""
+        raise NotImplementedError
+    
+    def set_mca(self, videoId, mcaName, mca):
+        raise NotImplementedError
+    
+    def delete_mca(self, videoId, mcaName):
+        raise NotImplementedError
+    
+    def update_mcas(self, updates):
+        """Sets MCAs in bulk: [(videoId, mcaName, mca)], where an mca of None
+        deletes the MCA."""
+        raise NotImplementedError
+    
+    # Video aggregates: one document per video, read and written as a whole
+    # in the form described in aggregates.py
+    
+    def get_video_aggregate(self, videoId):
+        """Returns the aggregate of a video or None."""
+        raise NotImplementedError
+    
+    def get_video_aggregates(self, videoIds):
+        """Returns the existing aggregates of several videos: {videoId: aggregate}."""
+        raise NotImplementedError
+    
+    def save_video_aggregate(self, aggregate):
+        """Replaces the aggregate of a video by a rebuilt one, keeping the
+        sessions folded in the meantime (see keep_folded_sessions)."""
+        raise NotImplementedError
+    
+    def delete_video_aggregate(self, videoId):
+        raise NotImplementedError
+    
+    def increment_session_count(self, videoId):
+        """Increments numSessions of a video aggregate, creating a stub (with
+        a size of 0) if needed."""
+        raise NotImplementedError
+    
+    def fold_aggregate_sessions(self, videoUpdates, changed):
+        """
+        Sets the entries of sessions in the (possibly stub) aggregates of
+        their videos in bulk: {videoId: {token: (version, playback,
+        likedPoints, taggedPoints, size)}}, see set_aggregate_session, marking
+        them `changed` (ms). An entry only replaces one of a lower version.
+        """
+        raise NotImplementedError
+    
+    # Highlights: {'_id': videoId, 'version': int, 'stale': bool, 'numSessions',
+    #              'duration', 'segments': [...], 'ts', 'failures', 'retryAfter'},
+    #             see highlights.py
+    
+    def get_highlights(self, videoId):
+        """Returns the highlights of a video or None."""
+        raise NotImplementedError
+    
+    def get_highlights_many(self, videoIds):
+        """Returns the existing highlights of several videos: {videoId: highlights}."""
+        raise NotImplementedError
+    
+    def mark_highlights_stale(self, videoIds):
+        """Marks the highlights of videos as stale and increments their version,
+        creating stubs if needed."""
+        raise NotImplementedError
+    
+    def find_stale_highlights(self, limit):
+        """Returns [(videoId, version), ...] of at most `limit` stale highlights,
+        leaving out deferred ones (see defer_highlights)."""
+        raise NotImplementedError
+    
+    def save_highlights(self, videoId, highlights, version):
+        """
+        Sets the fields of `highlights` of a video and resets its failures.
+        The highlights are no longer stale, unless they were marked stale
+        again after `version` (None: never marked) was read.
+        """
+        raise NotImplementedError
+    
+    def defer_highlights(self, videoId, failures, retryAfter):
+        """Sets the number of consecutive `failures` to compute the highlights
+        of a video, which are not stale again before time `retryAfter` (s)."""
+        raise NotImplementedError
+    
+    # Maintenance
+    
+    def clear(self):
+        """Deletes all user sessions, interaction sessions, aggregates and highlights."""
+        raise NotImplementedError
+    
+    def scan(self, collection, videoId=None, after=None, until=None):
+        """
+        Iterates in _id order over the documents of the 'userSessions' or
+        'interactionSessions' collection (with their interactions), fetched
+        in batches. Optionally restricted to the documents of a video and/or
+        those whose _id comes after `after` (to resume an interrupted scan)
+        and/or is at most `until`.
+        """
+        raise NotImplementedError
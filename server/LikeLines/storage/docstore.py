@@ -0,0 +1,358 @@
+"""
+Storage engine on top of a simple document store.
+
+Implements the Storage interface in terms of a handful of primitive
+operations on collections of JSON-compatible documents, which are provided
+by the embedded engines (see storage.memory and storage.sqlite). Compound
+operations are serialized with a single lock, as these engines are meant for
+single-node deployments and benchmarking.
+"""
+
+from threading import RLock
+
+from base import Storage, INTERACTION_CHUNK_SIZE, MAX_USER_POINTS
+from base import chunk_id, split_into_chunks, reservoir_slot, set_aggregate_session, keep_folded_sessions
+
+import time
+
+
+class DocumentStorage(Storage):
+    """Base class of engines that provide the following primitives:
+
+     * _get(collection, _id):       document or None
+     * _put(collection, doc):       insert or replace a document
+     * _delete(collection, _id)
+     * _find(collection, videoId):  iterate over the documents of a video
+     * _scan(collection, videoId, after, until):
+                                    iterate in _id order, see Storage.scan
+     * _clear(collection)
+
+    Only the 'interactionSessions' collection needs to support _find.
+    Interactions are stored in the 'interactionChunks' collection.
+    """
+    
+    def __init__(self):
+        self._lock = RLock()
+    
+    # Interaction sessions
+    
+    def create_interaction_session(self, session):
+        with self._lock:
+            self._put('interactionSessions', session)
+    
+    def get_interaction_session(self, token):
+        session = self._get('interactionSessions', token)
+        if session is not None:
+            session.pop('interactions', None)
+        return session
+    
+    def get_interaction_session_owner(self, token):
+        session = self._get('interactionSessions', token)
+        if session is None:
+            return None
+        return {'_id': token, 'videoId': session['videoId'], 'userSession': session['userSession']}
+    
+    def find_interaction_sessions(self, videoId):
+        for session in self._find('interactionSessions', videoId):
+            yield self._with_interactions(session)
+    
+    def get_interaction_sessions(self, tokens):
+        for token in tokens:
+            session = self._get('interactionSessions', token)
+            if session is not None:
+                yield self._with_interactions(session)
+    
+    def find_interaction_session_ids(self, videoId):
+        return [session['_id'] for session in self._scan('interactionSessions', videoId, None, None)]
+    
+    def _chunk_ids(self, session):
+        numChunks = -(-session.get('numInteractions', 0) // INTERACTION_CHUNK_SIZE)
+        return [chunk_id(session['_id'], seq) for seq in xrange(numChunks)]
+    
+    def _with_interactions(self, session):
+        interactions = session.setdefault('interactions', [])
+        for _id in self._chunk_ids(session):
+            chunk = self._get('interactionChunks', _id)
+            if chunk is not None:
+                interactions.extend(chunk['interactions'])
+        return session
+    
+    def _append_chunks(self, session, interactions):
+        token = session['_id']
+        start = session.get('numInteractions', 0)
+        for seq, elements in split_into_chunks(start, interactions):
+            chunk = self._get('interactionChunks', chunk_id(token, seq))
+            if chunk is None:
+                chunk = {'_id': chunk_id(token, seq), 'token': token, 'seq': seq, 'videoId': session['videoId'],
+                         'n': 0, 'interactions': []}
+            chunk['interactions'].extend(elements)
+            chunk['n'] += len(elements)
+            self._put('interactionChunks', chunk)
+        session['numInteractions'] = start + len(interactions)
+    
+    def insert_interaction_sessions(self, sessions):
+        dups = []
+        with self._lock:
+            for session in sessions:
+                if self._get('interactionSessions', session['_id']) is not None:
+                    dups.append(session['_id'])
+                else:
+                    interactions = session.get('interactions', [])
+                    session = dict(session, interactions=[], numInteractions=0)
+                    self._append_chunks(session, interactions)
+                    self._put('interactionSessions', session)
+            for videoId in set(session['videoId'] for session in sessions):
+                self._delete('videoSamples', videoId)
+        return dups
+    
+    def delete_interaction_sessions(self, videoId):
+        with self._lock:
+            for session in list(self._find('interactionSessions', videoId)):
+                for _id in self._chunk_ids(session):
+                    self._delete('interactionChunks', _id)
+                self._delete('interactionSessions', session['_id'])
+            self._delete('videoSamples', videoId)
+    
+    def append_interactions(self, sessionInteractions, owners=None, seqs=None):
+        rejected = []
+        with self._lock:
+            for token, interactions in sessionInteractions.iteritems():
+                session = self._get('interactionSessions', token)
+                if session is None or (owners is not None and session['userSession'] != owners[token]):
+                    rejected.append(token)
+                    continue
+                if seqs is not None and token in seqs:
+                    first, last = seqs[token]
+                    if session.get('seq', 0) >= first:
+                        rejected.append(token)
+                        continue
+                    session['seq'] = last
+                self._append_chunks(session, interactions)
+                self._put('interactionSessions', session)
+        return rejected
+    
+    def reencode_interactions(self, token, encode):
+        # Chunks are re-encoded under the lock, so none are skipped
+        replaced = 0
+        with self._lock:
+            session = self._get('interactionSessions', token)
+            if session is None:
+                return 0, 0
+            if session.get('interactions'):
+                encoded = encode(session['interactions'])
+                if encoded != session['interactions']:
+                    session['interactions'] = encoded
+                    self._put('interactionSessions', session)
+                    replaced += 1
+            for _id in self._chunk_ids(session):
+                chunk = self._get('interactionChunks', _id)
+                if chunk is None:
+                    continue
+                encoded = encode(chunk['interactions'])
+                if encoded != chunk['interactions']:
+                    chunk['interactions'] = encoded
+                    self._put('interactionChunks', chunk)
+                    replaced += 1
+        return replaced, 0
+    
+    # Session samples
+    
+    def get_session_sample(self, videoId):
+        return self._get('videoSamples', videoId)
+    
+    def save_session_sample(self, sample):
+        with self._lock:
+            self._put('videoSamples', sample)
+    
+    def delete_session_sample(self, videoId):
+        with self._lock:
+            self._delete('videoSamples', videoId)
+    
+    def add_to_session_sample(self, videoId, token, size):
+        with self._lock:
+            sample = self._get('videoSamples', videoId)
+            if sample is None:
+                return
+            sample['n'] += 1
+            slot = reservoir_slot(sample['n'], size)
+            if slot is not None:
+                tokens = sample['tokens']
+                tokens.extend([None] * (slot + 1 - len(tokens)))
+                tokens[slot] = token
+            self._put('videoSamples', sample)
+    
+    # User sessions
+    
+    def get_user_session(self, session_id):
+        return self._get('userSessions', session_id)
+    
+    def get_user_likes(self, session_id, videoId):
+        session = self._get('userSessions', session_id)
+        return session.get('likes', {}).get(videoId, []) if session else []
+    
+    def get_user_likes_many(self, session_id, videoIds):
+        session = self._get('userSessions', session_id)
+        likes = session.get('likes', {}) if session else {}
+        return dict( (videoId, likes.get(videoId, [])) for videoId in videoIds )
+    
+    def append_user_interactions(self, userUpdates, seqs=None):
+        rejected = []
+        with self._lock:
+            for (session_id, token), (videoId, likes, tags) in userUpdates.iteritems():
+                session = self._get('userSessions', session_id)
+                if session is None:
+                    session = {'_id': session_id, 'likes': {}, 'ts': time.time()}
+                interactionSession = None
+                if seqs is not None and (session_id, token) in seqs:
+                    first, last = seqs[session_id, token]
+                    interactionSession = self._get('interactionSessions', token)
+                    if interactionSession is not None and interactionSession.get('userSeq', -1) >= first:
+                        rejected.append( (session_id, token) )
+                        continue
+                if likes:
+                    points = session.setdefault('likes', {}).setdefault(videoId, [])
+                    points.extend(likes)
+                    del points[:-MAX_USER_POINTS]
+                if tags:
+                    points = session.setdefault('tags', {}).setdefault(videoId, [])
+                    points.extend(tags)
+                    del points[:-MAX_USER_POINTS]
+                self._put('userSessions', session)
+                if interactionSession is not None:
+                    interactionSession['userSeq'] = last
+                    self._put('interactionSessions', interactionSession)
+        return rejected
+    
+    # MCA
+    
+    def get_mca(self, videoId):
+        doc = self._get('mca', videoId)
+        return doc['mca'] if doc else {}
+    
+    def get_mcas(self, videoIds):
+        return dict( (videoId, self.get_mca(videoId)) for videoId in videoIds )
+    
+    def set_mca(self, videoId, mcaName, mca):
+        with self._lock:
+            doc = self._get('mca', videoId) or {'_id': videoId, 'mca': {}}
+            doc['mca'][mcaName] = mca
+            self._put('mca', doc)
+    
+    def delete_mca(self, videoId, mcaName):
+        with self._lock:
+            doc = self._get('mca', videoId)
+            if doc and mcaName in doc['mca']:
+                del doc['mca'][mcaName]
+                self._put('mca', doc)
+    
+    def update_mcas(self, updates):
+        with self._lock:
+            docs = {}
+            for videoId, mcaName, mca in updates:
+                if videoId not in docs:
+                    docs[videoId] = self._get('mca', videoId) or {'_id': videoId, 'mca': {}}
+                if mca is None:
+                    docs[videoId]['mca'].pop(mcaName, None)
+                else:
+                    docs[videoId]['mca'][mcaName] = mca
+            for doc in docs.itervalues():
+                self._put('mca', doc)
+    
+    # Video aggregates
+    
+    def get_video_aggregate(self, videoId):
+        return self._get('videoAggregates', videoId)
+    
+    def get_video_aggregates(self, videoIds):
+        aggregates = ( self._get('videoAggregates', videoId) for videoId in videoIds )
+        return dict( (aggregate['_id'], aggregate) for aggregate in aggregates if aggregate is not None )
+    
+    def save_video_aggregate(self, aggregate):
+        with self._lock:
+            stored = self._get('videoAggregates', aggregate['_id'])
+            if stored is not None:
+                keep_folded_sessions(aggregate, stored)
+            self._put('videoAggregates', aggregate)
+    
+    def delete_video_aggregate(self, videoId):
+        with self._lock:
+            self._delete('videoAggregates', videoId)
+    
+    def increment_session_count(self, videoId):
+        with self._lock:
+            aggregate = self._get('videoAggregates', videoId) or {'_id': videoId, 'numSessions': 0, 'size': 0}
+            aggregate['numSessions'] += 1
+            self._put('videoAggregates', aggregate)
+    
+    def fold_aggregate_sessions(self, videoUpdates, changed):
+        with self._lock:
+            for videoId, sessions in videoUpdates.iteritems():
+                aggregate = self._get('videoAggregates', videoId)
+                if aggregate is None or 'size' not in aggregate:
+                    continue
+                for key in ('playbacks', 'likedPoints', 'taggedPoints', 'changed', 'versions', 'sizes'):
+                    aggregate.setdefault(key, {})
+                for token, entry in sessions.iteritems():
+                    if entry[0] > aggregate['versions'].get(token, -1):
+                        set_aggregate_session(aggregate, token, changed, *entry)
+                self._put('videoAggregates', aggregate)
+    
+    # Highlights
+    
+    def get_highlights(self, videoId):
+        return self._get('videoHighlights', videoId)
+    
+    def get_highlights_many(self, videoIds):
+        docs = ( self._get('videoHighlights', videoId) for videoId in videoIds )
+        return dict( (doc['_id'], doc) for doc in docs if doc is not None )
+    
+    def mark_highlights_stale(self, videoIds):
+        with self._lock:
+            for videoId in videoIds:
+                doc = self._get('videoHighlights', videoId) or {'_id': videoId, 'version': 0}
+                doc['version'] += 1
+                doc['stale'] = True
+                self._put('videoHighlights', doc)
+    
+    def find_stale_highlights(self, limit):
+        res = []
+        now = time.time()
+        for doc in self._scan('videoHighlights', None, None, None):
+            if len(res) >= limit:
+                break
+            if doc.get('stale') and doc.get('retryAfter', 0) <= now:
+                res.append( (doc['_id'], doc['version']) )
+        return res
+    
+    def save_highlights(self, videoId, highlights, version):
+        with self._lock:
+            doc = self._get('videoHighlights', videoId) or {'_id': videoId}
+            doc.update(highlights)
+            doc.pop('failures', None)
+            doc.pop('retryAfter', None)
+            if doc.get('version') == version:
+                doc['stale'] = False
+            self._put('videoHighlights', doc)
+    
+    def defer_highlights(self, videoId, failures, retryAfter):
+        with self._lock:
+            doc = self._get('videoHighlights', videoId) or {'_id': videoId, 'version': 0}
+            doc.update(failures=failures, retryAfter=retryAfter)
+            self._put('videoHighlights', doc)
+    
+    # Maintenance
+    
+    def clear(self):
+        with self._lock:
+            self._clear('userSessions')
+            self._clear('interactionSessions')
+            self._clear('interactionChunks')
+            self._clear('videoSamples')
+            self._clear('videoAggregates')
+            self._clear('videoHighlights')
+    
+    def scan(self, collection, videoId=None, after=None, until=None):
+        docs = self._scan(collection, videoId, after, until)
+        if collection == 'interactionSessions':
+            docs = (self._with_interactions(doc) for doc in docs)
+        return docs
@@ -0,0 +1,55 @@
+"""
+In-memory storage engine.
+
+Keeps all data in process memory; nothing is persisted. Useful for tests,
+benchmarks and throw-away single-process instances.
+"""
+
+from collections import defaultdict
+from copy import deepcopy
+
+from docstore import DocumentStorage
+
+
+class MemoryStorage(DocumentStorage):
+    def __init__(self):
+        DocumentStorage.__init__(self)
+        self._collections = defaultdict(dict)              # collection -> _id -> doc
+        self._byVideo = defaultdict(lambda: defaultdict(set)) # collection -> videoId -> set(_id)
+    
+    def _get(self, collection, _id):
+        doc = self._collections[collection].get(_id)
+        return deepcopy(doc) if doc is not None else None
+    
+    def _put(self, collection, doc):
+        docs = self._collections[collection]
+        old = docs.get(doc['_id'])
+        if old is not None and 'videoId' in old:
+            self._byVideo[collection][old['videoId']].discard(doc['_id'])
+        docs[doc['_id']] = deepcopy(doc)
+        if 'videoId' in doc:
+            self._byVideo[collection][doc['videoId']].add(doc['_id'])
+    
+    def _delete(self, collection, _id):
+        doc = self._collections[collection].pop(_id, None)
+        if doc is not None and 'videoId' in doc:
+            self._byVideo[collection][doc['videoId']].discard(_id)
+    
+    def _find(self, collection, videoId):
+        docs = self._collections[collection]
+        for _id in list(self._byVideo[collection].get(videoId, ())):
+            doc = docs.get(_id)
+            if doc is not None:
+                yield deepcopy(doc)
+    
+    def _scan(self, collection, videoId, after, until):
+        docs = self._collections[collection]
+        ids = self._byVideo[collection].get(videoId, ()) if videoId is not None else docs.keys()
+        for _id in sorted(_id for _id in list(ids) if (after is None or _id > after) and (until is None or _id <= until)):
+            doc = docs.get(_id)
+            if doc is not None:
+                yield deepcopy(doc)
+    
+    def _clear(self, collection):
+        self._collections.pop(collection, None)
+        self._byVideo.pop(collection, None)
@@ -0,0 +1,524 @@
+"""
+MongoDB storage engine.
+"""
+
+from flask.ext.pymongo import PyMongo
+from pymongo.errors import BulkWriteError, ConnectionFailure, DuplicateKeyError
+
+from base import Storage, INTERACTION_CHUNK_SIZE, MAX_USER_POINTS, MAX_AGGREGATE_SIZE
+from base import chunk_id, split_into_chunks, reservoir_slot, keep_folded_sessions
+
+import hashlib
+import time
+
+SCAN_BATCH_SIZE = 1000
+DUPLICATE_KEY_ERRORS = (11000, 11001)
+
+# Keys of the batches most recently appended to a user session, such that a
+# batch retried before the mark of its interaction session was raised is not
+# appended twice
+MAX_USER_BATCHES = 100
+
+# Times the entries of sessions are folded into their video aggregates before
+# giving up on concurrently updated ones (a later fold sets them anyway)
+FOLD_ATTEMPTS = 3
+
+
+class MongoStorage(Storage):
+    TRANSIENT_ERRORS = (EnvironmentError, ConnectionFailure)
+    
+    def __init__(self, app):
+        self.mongo = PyMongo(app)
+    
+    @property
+    def db(self):
+        return self.mongo.db
+    
+    # Interaction sessions
+    
+    def create_interaction_session(self, session):
+        self.db.interactionSessions.insert(session)
+        self.db.interactionSessions.ensure_index('videoId')
+        self.db.interactionSessions.ensure_index('userSession')
+        self.db.interactionSessions.ensure_index([('videoId', 1), ('_id', 1)])
+        self.db.interactionChunks.ensure_index([('token', 1), ('seq', 1)])
+        self.db.interactionChunks.ensure_index([('videoId', 1), ('token', 1), ('seq', 1)])
+    
+    def get_interaction_session(self, token):
+        return self.db.interactionSessions.find_one({'_id': token}, {'interactions': False})
+    
+    def get_interaction_session_owner(self, token):
+        return self.db.interactionSessions.find_one({'_id': token}, {'videoId': True, 'userSession': True})
+    
+    def find_interaction_sessions(self, videoId):
+        sessions = self.db.interactionSessions.find({'videoId': videoId})
+        return self._with_interactions(sessions, {'videoId': videoId})
+    
+    def get_interaction_sessions(self, tokens):
+        tokens = list(tokens)
+        sessions = self.db.interactionSessions.find({'_id': {'$in': tokens}})
+        return self._with_interactions(sessions, {'token': {'$in': tokens}})
+    
+    def find_interaction_session_ids(self, videoId):
+        sessions = self.db.interactionSessions.find({'videoId': videoId}, {'_id': True}).sort('_id', 1)
+        return [session['_id'] for session in sessions.batch_size(SCAN_BATCH_SIZE)]
+    
+    def _with_interactions(self, sessions, chunkSpec):
+        """Merges the chunks matching chunkSpec into the sessions they belong to."""
+        sessions = sessions.sort('_id', 1).batch_size(SCAN_BATCH_SIZE)
+        chunks = self.db.interactionChunks.find(chunkSpec).sort([('token', 1), ('seq', 1)]).batch_size(SCAN_BATCH_SIZE)
+        chunk = next(chunks, None)
+        for session in sessions:
+            interactions = session.setdefault('interactions', [])
+            while chunk is not None and chunk['token'] < session['_id']:
+                chunk = next(chunks, None)
+            while chunk is not None and chunk['token'] == session['_id']:
+                interactions.extend(chunk['interactions'])
+                chunk = next(chunks, None)
+            yield session
+    
+    def insert_interaction_sessions(self, sessions):
+        if not sessions:
+            return []
+        
+        chunks = {}
+        bulk = self.db.interactionSessions.initialize_unordered_bulk_op()
+        for session in sessions:
+            interactions = session.get('interactions', [])
+            chunks[session['_id']] = split_into_chunks(0, interactions)
+            bulk.insert(dict(session, interactions=[], numInteractions=len(interactions)))
+        
+        dups = []
+        try:
+            bulk.execute()
+        except BulkWriteError, e:
+            errors = e.details['writeErrors']
+            if any(error['code'] not in DUPLICATE_KEY_ERRORS for error in errors):
+                raise
+            dups = [sessions[error['index']]['_id'] for error in errors]
+        
+        bulk = self.db.interactionChunks.initialize_unordered_bulk_op()
+        empty = True
+        for session in sessions:
+            if session['_id'] in dups:
+                continue
+            for seq, elements in chunks[session['_id']]:
+                bulk.find({'_id': chunk_id(session['_id'], seq)}).upsert().replace_one({
+                    'token': session['_id'],
+                    'seq': seq,
+                    'videoId': session['videoId'],
+                    'n': len(elements),
+                    'interactions': elements
+                })
+                empty = False
+        if not empty:
+            bulk.execute()
+        
+        for videoId in set(session['videoId'] for session in sessions):
+            self.delete_session_sample(videoId)
+        return dups
+    
+    def delete_interaction_sessions(self, videoId):
+        self.db.interactionSessions.remove({'videoId': videoId})
+        self.db.interactionChunks.remove({'videoId': videoId})
+        self.delete_session_sample(videoId)
+    
+    def append_interactions(self, sessionInteractions, owners=None, seqs=None):
+        rejected = []
+        if not sessionInteractions:
+            return rejected
+        
+        sessions = self.db.interactionSessions.find({'_id': {'$in': sessionInteractions.keys()}},
+                                                    {'videoId': True, 'userSession': True, 'seq': True,
+                                                     'numInteractions': True, 'bucket': True})
+        sessions = dict( (session['_id'], session) for session in sessions )
+        
+        # The interactions of each append are pushed into the open bucket of
+        # the session (or the next ones, when full) in pieces, each with a key
+        # derived from its contents: a retried append finds its pieces pushed.
+        accepted = []
+        pieces = []                         # [token, key, elements, bucket]
+        openBucket = {}                     # token -> bucket
+        nextBucket = {}                     # token -> bucket
+        for token, interactions in sessionInteractions.iteritems():
+            session = sessions.get(token)
+            first = seqs[token][0] if seqs is not None and token in seqs else None
+            if session is None or (owners is not None and session.get('userSession') != owners[token]) \
+               or (first is not None and session.get('seq', -1) >= first):
+                rejected.append(token)
+                continue
+            accepted.append(token)
+            digest = hashlib.sha1(repr((first, interactions))).hexdigest()
+            bucket = openBucket[token] = session.get('bucket', session.get('numInteractions', 0) // INTERACTION_CHUNK_SIZE)
+            for i in xrange(0, len(interactions), INTERACTION_CHUNK_SIZE):
+                pieces.append([token, '%s/%d' % (digest, i), interactions[i:i+INTERACTION_CHUNK_SIZE], bucket])
+                bucket += 1
+            nextBucket[token] = bucket
+        
+        lastBucket = {}                     # token -> bucket
+        while pieces:
+            bulk = self.db.interactionChunks.initialize_unordered_bulk_op()
+            for token, key, elements, bucket in pieces:
+                bulk.find({
+                    '_id': chunk_id(token, bucket),
+                    'n': {'$lte': INTERACTION_CHUNK_SIZE - len(elements)},
+                    'appends': {'$ne': key}
+                }).upsert().update({
+                    '$push': {'interactions': {'$each': elements}, 'appends': key},
+                    '$inc': {'n': len(elements)},
+                    '$setOnInsert': {'token': token, 'seq': bucket, 'videoId': sessions[token]['videoId']}
+                })
+            try:
+                bulk.execute()
+                full = []
+            except BulkWriteError, e:
+                # Upserts into buckets that are full or already have the piece
+                errors = e.details['writeErrors']
+                if any(error['code'] not in DUPLICATE_KEY_ERRORS for error in errors):
+                    raise
+                full = [pieces[error['index']] for error in errors]
+            
+            for token, key, elements, bucket in pieces:
+                lastBucket[token] = max(bucket, lastBucket.get(token, 0))
+            if full:
+                # Skip the pieces found in any bucket of their session (from
+                # the open one on), the others go to new buckets
+                tokens = set(token for token, key, elements, bucket in full)
+                spec = {'$or': [{'token': token, 'seq': {'$gte': openBucket[token]}} for token in tokens]}
+                appended = set()
+                for chunk in self.db.interactionChunks.find(spec, {'token': True, 'seq': True, 'appends': True}):
+                    appended.update( (chunk['token'], key) for key in chunk.get('appends', []) )
+                    nextBucket[chunk['token']] = max(nextBucket[chunk['token']], chunk['seq'] + 1)
+                full = [piece for piece in full if (piece[0], piece[1]) not in appended]
+                for piece in full:
+                    piece[3] = nextBucket[piece[0]]
+                    nextBucket[piece[0]] += 1
+            pieces = full
+        
+        # Only then count the interactions and raise the high-water marks
+        if not accepted:
+            return rejected
+        bulk = self.db.interactionSessions.initialize_unordered_bulk_op()
+        for token in accepted:
+            spec = {'_id': token}
+            update = {'$inc': {'numInteractions': len(sessionInteractions[token])}}
+            if token in lastBucket:
+                update['$max'] = {'bucket': lastBucket[token]}
+            if owners is not None:
+                spec['userSession'] = owners[token]
+            if seqs is not None and token in seqs:
+                first, last = seqs[token]
+                # Sessions created before sequence numbers have no mark
+                spec['seq'] = {'$not': {'$gte': first}}
+                update['$set'] = {'seq': last}
+            bulk.find(spec).update_one(update)
+        bulk.execute()
+        return rejected
+    
+    def reencode_interactions(self, token, encode):
+        replaced = skipped = 0
+        
+        # Interactions stored in the session document itself (legacy)
+        session = self.db.interactionSessions.find_one({'_id': token}, {'interactions': True})
+        interactions = session.get('interactions', []) if session else []
+        if interactions:
+            encoded = encode(interactions)
+            if encoded != interactions:
+                res = self.db.interactionSessions.update({'_id': token, 'interactions': {'$size': len(interactions)}},
+                                                         {'$set': {'interactions': encoded}})
+                if res['n']:
+                    replaced += 1
+                else:
+                    skipped += 1
+        
+        for chunk in self.db.interactionChunks.find({'token': token}):
+            encoded = encode(chunk['interactions'])
+            if encoded == chunk['interactions']:
+                continue
+            # n only changes when interactions are pushed into the chunk
+            res = self.db.interactionChunks.update({'_id': chunk['_id'], 'n': chunk['n']},
+                                                   {'$set': {'interactions': encoded}})
+            if res['n']:
+                replaced += 1
+            else:
+                skipped += 1
+        
+        return replaced, skipped
+    
+    # Session samples
+    
+    def get_session_sample(self, videoId):
+        return self.db.videoSamples.find_one({'_id': videoId})
+    
+    def save_session_sample(self, sample):
+        self.db.videoSamples.save(sample)
+    
+    def delete_session_sample(self, videoId):
+        self.db.videoSamples.remove({'_id': videoId})
+    
+    def add_to_session_sample(self, videoId, token, size):
+        sample = self.db.videoSamples.find_and_modify({'_id': videoId}, {'$inc': {'n': 1}},
+                                                      fields={'n': True}, new=True)
+        if sample is None:
+            return
+        slot = reservoir_slot(sample['n'], size)
+        if slot is not None:
+            self.db.videoSamples.update({'_id': videoId}, {'$set': {'tokens.%d' % slot: token}})
+    
+    # User sessions
+    
+    def get_user_session(self, session_id):
+        return self.db.userSessions.find_one({'_id': session_id})
+    
+    def get_user_likes(self, session_id, videoId):
+        session = self.db.userSessions.find_one({'_id': session_id}, {'likes.%s' % videoId: True})
+        return session.get('likes', {}).get(videoId, []) if session else []
+    
+    def get_user_likes_many(self, session_id, videoIds):
+        fields = dict( ('likes.%s' % videoId, True) for videoId in videoIds )
+        session = self.db.userSessions.find_one({'_id': session_id}, fields) if fields else None
+        likes = session.get('likes', {}) if session else {}
+        return dict( (videoId, likes.get(videoId, [])) for videoId in videoIds )
+    
+    def append_user_interactions(self, userUpdates, seqs=None):
+        if not userUpdates:
+            return []
+        marks = {}
+        if seqs:
+            tokens = list(set(token for _, token in seqs))
+            for session in self.db.interactionSessions.find({'_id': {'$in': tokens}}, {'userSeq': True}):
+                marks[session['_id']] = session.get('userSeq', -1)
+        
+        ts = time.time()
+        rejected = []
+        keys = []
+        bulk = self.db.userSessions.initialize_unordered_bulk_op()
+        for (session_id, token), (videoId, likes, tags) in userUpdates.iteritems():
+            spec = {'_id': session_id}
+            update = {'$push': {}, '$setOnInsert': {'ts': ts}}
+            if likes:
+                update['$push']['likes.%s' % videoId] = {'$each': likes, '$slice': -MAX_USER_POINTS}
+            if tags:
+                update['$push']['tags.%s' % videoId] = {'$each': tags, '$slice': -MAX_USER_POINTS}
+            if seqs is not None and (session_id, token) in seqs:
+                first, last = seqs[session_id, token]
+                if marks.get(token, -1) >= first:
+                    rejected.append( (session_id, token) )
+                    continue
+                key = '%s/%d' % (token, first)
+                spec['batches'] = {'$ne': key}
+                update['$push']['batches'] = {'$each': [key], '$slice': -MAX_USER_BATCHES}
+            keys.append( (session_id, token) )
+            bulk.find(spec).upsert().update(update)
+        if not keys:
+            return rejected
+        
+        try:
+            bulk.execute()
+        except BulkWriteError, e:
+            # An upsert whose batch check fails collides with the existing session
+            errors = e.details['writeErrors']
+            if any(error['code'] not in DUPLICATE_KEY_ERRORS for error in errors):
+                raise
+            rejected.extend(keys[error['index']] for error in errors)
+        
+        # Only then raise the marks, also of batches appended before a failure
+        if seqs:
+            bulk = self.db.interactionSessions.initialize_unordered_bulk_op()
+            empty = True
+            for session_id, token in keys:
+                if (session_id, token) in seqs:
+                    bulk.find({'_id': token}).update_one({'$max': {'userSeq': seqs[session_id, token][1]}})
+                    empty = False
+            if not empty:
+                bulk.execute()
+        return rejected
+    
+    # MCA
+    
+    def get_mca(self, videoId):
+        return self._mca_fields(self.db.mca.find_one({'_id': videoId}))
+    
+    def get_mcas(self, videoIds):
+        res = dict( (videoId, {}) for videoId in videoIds )
+        for mca in self.db.mca.find({'_id': {'$in': list(videoIds)}}):
+            res[mca['_id']] = self._mca_fields(mca)
+        return res
+    
+    def _mca_fields(self, mca):
+        res = {}
+        if mca:
+            for key in mca.keys():
+                if key.startswith('mca-'):
+                    res[key[4:]] = mca[key]
+        return res
+    
+    def set_mca(self, videoId, mcaName, mca):
+        self.db.mca.update({'_id': videoId}, {'$set': {
+            'mca-%s' % mcaName: mca
+        }}, True)
+    
+    def delete_mca(self, videoId, mcaName):
+        self.db.mca.update({'_id': videoId}, {'$unset': {
+            'mca-%s' % mcaName: ""
+        }})
+    
+    def update_mcas(self, updates):
+        if not updates:
+            return
+        bulk = self.db.mca.initialize_unordered_bulk_op()
+        for videoId, mcaName, mca in updates:
+            if mca is None:
+                bulk.find({'_id': videoId}).update({'$unset': {'mca-%s' % mcaName: ""}})
+            else:
+                bulk.find({'_id': videoId}).upsert().update({'$set': {'mca-%s' % mcaName: mca}})
+        bulk.execute()
+    
+    # Video aggregates
+    
+    def get_video_aggregate(self, videoId):
+        return self.db.videoAggregates.find_one({'_id': videoId})
+    
+    def get_video_aggregates(self, videoIds):
+        return dict( (aggregate['_id'], aggregate)
+                     for aggregate in self.db.videoAggregates.find({'_id': {'$in': list(videoIds)}}) )
+    
+    def save_video_aggregate(self, aggregate):
+        # Replaced only if no fold happened after reading the stored version
+        while True:
+            stored = self.db.videoAggregates.find_one({'_id': aggregate['_id']}) or {}
+            keep_folded_sessions(aggregate, stored)
+            aggregate['revision'] = stored.get('revision', 0) + 1
+            try:
+                self.db.videoAggregates.update({'_id': aggregate['_id'], 'revision': stored.get('revision')}, aggregate, True)
+                return
+            except DuplicateKeyError:
+                pass
+    
+    def delete_video_aggregate(self, videoId):
+        self.db.videoAggregates.remove({'_id': videoId})
+    
+    def increment_session_count(self, videoId):
+        self.db.videoAggregates.update({'_id': videoId}, {
+            '$inc': {'numSessions': 1},
+            '$setOnInsert': {'size': 0}
+        }, True)
+    
+    def fold_aggregate_sessions(self, videoUpdates, changed):
+        # Each entry is set conditionally on the version and total size read,
+        # such that concurrent folds neither go back nor exceed the limit
+        pending = videoUpdates
+        for _ in xrange(FOLD_ATTEMPTS):
+            fields = {'size': True}
+            for videoId, sessions in pending.iteritems():
+                for token in sessions:
+                    fields['versions.%s' % token] = True
+                    fields['sizes.%s' % token] = True
+            spec = {'_id': {'$in': pending.keys()}, 'size': {'$exists': True}}
+            
+            bulk = self.db.videoAggregates.initialize_unordered_bulk_op()
+            retry = {}
+            for doc in self.db.videoAggregates.find(spec, fields):
+                versions = doc.get('versions', {})
+                sizes = doc.get('sizes', {})
+                for token, (version, playback, likedPoints, taggedPoints, size) in pending[doc['_id']].iteritems():
+                    if version <= versions.get(token, -1):
+                        continue
+                    delta = size - sizes.get(token, 0)
+                    if doc.get('size', 0) + delta > MAX_AGGREGATE_SIZE:
+                        continue
+                    
+                    update = {
+                        '$set': {'changed.%s' % token: changed, 'versions.%s' % token: version, 'sizes.%s' % token: size},
+                        '$inc': {'size': delta, 'revision': 1}
+                    }
+                    for key, value in (('playbacks', playback), ('likedPoints', likedPoints), ('taggedPoints', taggedPoints)):
+                        if value:
+                            update['$set']['%s.%s' % (key, token)] = value
+                        else:
+                            update.setdefault('$unset', {})['%s.%s' % (key, token)] = ""
+                    bulk.find({
+                        '_id': doc['_id'],
+                        'versions.%s' % token: versions.get(token),
+                        'size': {'$lte': MAX_AGGREGATE_SIZE - delta}
+                    }).update_one(update)
+                    retry.setdefault(doc['_id'], {})[token] = pending[doc['_id']][token]
+            
+            numUpdates = sum(len(sessions) for sessions in retry.itervalues())
+            if not numUpdates or bulk.execute()['nMatched'] == numUpdates:
+                return
+            pending = retry
+    
+    # Highlights
+    
+    def get_highlights(self, videoId):
+        return self.db.videoHighlights.find_one({'_id': videoId})
+    
+    def get_highlights_many(self, videoIds):
+        return dict( (doc['_id'], doc)
+                     for doc in self.db.videoHighlights.find({'_id': {'$in': list(videoIds)}}) )
+    
+    def mark_highlights_stale(self, videoIds):
+        if not videoIds:
+            return
+        bulk = self.db.videoHighlights.initialize_unordered_bulk_op()
+        for videoId in videoIds:
+            bulk.find({'_id': videoId}).upsert().update({
+                '$inc': {'version': 1},
+                '$set': {'stale': True}
+            })
+        bulk.execute()
+    
+    def find_stale_highlights(self, limit):
+        self.db.videoHighlights.ensure_index('stale', sparse=True)
+        spec = {'stale': True, 'retryAfter': {'$not': {'$gt': time.time()}}}
+        docs = self.db.videoHighlights.find(spec, {'version': True}).limit(limit)
+        return [(doc['_id'], doc['version']) for doc in docs]
+    
+    def save_highlights(self, videoId, highlights, version):
+        unset = {'failures': "", 'retryAfter': ""}
+        res = self.db.videoHighlights.update({'_id': videoId, 'version': version}, {
+            '$set': dict(highlights, stale=False),
+            '$unset': unset
+        })
+        if not res['n']:
+            # Marked stale again in the meantime (or never marked)
+            self.db.videoHighlights.update({'_id': videoId}, {'$set': highlights, '$unset': unset}, True)
+    
+    def defer_highlights(self, videoId, failures, retryAfter):
+        self.db.videoHighlights.update({'_id': videoId}, {
+            '$set': {'failures': failures, 'retryAfter': retryAfter}
+        }, True)
+    
+    # Maintenance
+    
+    def clear(self):
+        self.db.userSessions.remove()
+        self.db.interactionSessions.remove()
+        self.db.interactionChunks.remove()
+        self.db.videoSamples.remove()
+        self.db.videoAggregates.remove()
+        self.db.videoHighlights.remove()
+    
+    def scan(self, collection, videoId=None, after=None, until=None):
+        spec = {}
+        if videoId is not None:
+            spec['videoId'] = videoId
+            self.db[collection].ensure_index([('videoId', 1), ('_id', 1)])
+        idRange = {}
+        if after is not None:
+            idRange['$gt'] = after
+        if until is not None:
+            idRange['$lte'] = until
+        if idRange:
+            spec['_id'] = idRange
+        docs = self.db[collection].find(spec).sort('_id', 1).batch_size(SCAN_BATCH_SIZE)
+        
+        if collection == 'interactionSessions':
+            chunkSpec = {}
+            if videoId is not None:
+                chunkSpec['videoId'] = videoId
+            if idRange:
+                chunkSpec['token'] = idRange
+            docs = self._with_interactions(docs, chunkSpec)
+        return docs
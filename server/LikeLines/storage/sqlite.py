@@ -0,0 +1,78 @@
+"""
+Embedded SQLite storage engine.
+
+Each collection is stored in its own table of JSON-encoded documents, with
+an index on the videoId of a document (if any).
+"""
+
+import sqlite3
+import json
+from threading import Lock
+
+from docstore import DocumentStorage
+
+COLLECTIONS = ['interactionSessions', 'interactionChunks', 'userSessions', 'mca', 'videoAggregates', 'videoSamples',
+               'videoHighlights']
+SCAN_BATCH_SIZE = 1000
+
+
+class SQLiteStorage(DocumentStorage):
+    # e.g., "database is locked"
+    TRANSIENT_ERRORS = (EnvironmentError, sqlite3.OperationalError)
+    
+    def __init__(self, path):
+        DocumentStorage.__init__(self)
+        self.path = path
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._connLock = Lock()
+        
+        with self._connLock:
+            if path != ':memory:':
+                self._conn.execute('PRAGMA journal_mode=WAL')
+            for collection in COLLECTIONS:
+                self._conn.execute('CREATE TABLE IF NOT EXISTS %s (id TEXT PRIMARY KEY, videoId TEXT, doc TEXT NOT NULL)' % collection)
+                self._conn.execute('CREATE INDEX IF NOT EXISTS %s_videoId ON %s (videoId)' % (collection, collection))
+    
+    def _query(self, sql, *args):
+        with self._connLock:
+            return self._conn.execute(sql, args).fetchall()
+    
+    def _get(self, collection, _id):
+        rows = self._query('SELECT doc FROM %s WHERE id = ?' % collection, _id)
+        return json.loads(rows[0][0]) if rows else None
+    
+    def _put(self, collection, doc):
+        self._query('INSERT OR REPLACE INTO %s (id, videoId, doc) VALUES (?, ?, ?)' % collection,
+                    doc['_id'], doc.get('videoId'), json.dumps(doc))
+    
+    def _delete(self, collection, _id):
+        self._query('DELETE FROM %s WHERE id = ?' % collection, _id)
+    
+    def _find(self, collection, videoId):
+        for (doc,) in self._query('SELECT doc FROM %s WHERE videoId = ?' % collection, videoId):
+            yield json.loads(doc)
+    
+    def _scan(self, collection, videoId, after, until):
+        # Fetched in batches, such that the connection is not held while
+        # the caller consumes the documents
+        sql = 'SELECT id, doc FROM %s WHERE id > ?' % collection
+        args = []
+        if videoId is not None:
+            sql += ' AND videoId = ?'
+            args.append(videoId)
+        if until is not None:
+            sql += ' AND id <= ?'
+            args.append(until)
+        sql += ' ORDER BY id LIMIT %d' % SCAN_BATCH_SIZE
+        
+        last = after if after is not None else ''
+        while True:
+            rows = self._query(sql, last, *args)
+            for _id, doc in rows:
+                yield json.loads(doc)
+            if len(rows) < SCAN_BATCH_SIZE:
+                break
+            last = rows[-1][0]
+    
+    def _clear(self, collection):
+        self._query('DELETE FROM %s' % collection)
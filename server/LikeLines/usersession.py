@@ -7,26 +7,37 @@ Future features to be implemented:
 
 from flask import session, current_app, request
 from tokengen import generate_unique_token
+from storage.base import MAX_USER_POINTS
 
-import sys
+import logging
 import time
 
+log = logging.getLogger(__name__)
+
+
+def sessionless(func):
+    """Marks a view that must not create or resume a user session,
+    e.g., because its clients do not keep cookies."""
+    func.sessionless = True
+    return func
+
 
 def ensure_session():
     # Don't create a session if there is no endpoint, e.g., favicon.ico
     # (Browsers don't send cookies for security reasons for favicon.ico)
     if request.endpoint is None:
         return
+    if getattr(current_app.view_functions.get(request.endpoint), 'sessionless', False):
+        return
     
+    # The server-side session document is only created once the user
+    # sends likes or tags (see storage.append_user_interactions)
     session.permanent = True
     if 'session_id' not in session:
-        print >>sys.stderr, 'Creating new session'
-        session_id = generate_unique_token()
-        session['session_id'] = session_id
-        current_app.mongo.db.userSessions.insert(empty_session_object(session_id))
+        log.debug('Creating new session')
+        session['session_id'] = generate_unique_token()
     else:
-        print >>sys.stderr, 'Resuming previous session'
-        session_id = session['session_id']
+        log.debug('Resuming previous session')
 
 def empty_session_object(session_id):
     return {
@@ -42,9 +53,60 @@ def get_serverside_session(session_id=None):
     if session_id is None:
         session_id = session['session_id']
     
-    server_session = current_app.mongo.db.userSessions.find_one({'_id': session_id})
-    if not server_session:
-        server_session = empty_session_object(session_id)
-        current_app.mongo.db.userSessions.insert(server_session)
-    return current_app.mongo.db.userSessions.find_one({'_id': session_id}) or empty_session_object(session_id)
+    return current_app.storage.get_user_session(session_id) or empty_session_object(session_id)
+
+def get_user_likes(videoId, session_id=None):
+    """Returns the user's likes of a video, cached per (session_id, videoId)."""
+    if session_id is None:
+        session_id = session['session_id']
+    
+    cache = current_app.user_likes_cache
+    likes = cache.get( (session_id, videoId) )
+    if likes is None:
+        likes = current_app.storage.get_user_likes(session_id, videoId)
+        cache.set( (session_id, videoId), likes )
+    return likes
+
+def get_user_likes_many(videoIds, session_id=None):
+    """Returns the user's likes of several videos, fetching uncached ones at once: {videoId: likes}."""
+    if session_id is None:
+        session_id = session['session_id']
+    
+    cache = current_app.user_likes_cache
+    res = {}
+    missing = []
+    for videoId in videoIds:
+        likes = cache.get( (session_id, videoId) )
+        if likes is None:
+            missing.append(videoId)
+        else:
+            res[videoId] = likes
+    
+    if missing:
+        for videoId, likes in current_app.storage.get_user_likes_many(session_id, missing).iteritems():
+            cache.set( (session_id, videoId), likes )
+            res[videoId] = likes
+    return res
+
+def remember_interaction_session(token, videoId, session_id):
+    """Caches the owner of a newly created interaction session."""
+    current_app.session_owner_cache.set(token, (videoId, session_id))
+
+def get_interaction_session_owner(token):
+    """Returns (videoId, session_id) of an interaction session, or None if it does not exist."""
+    cache = current_app.session_owner_cache
+    owner = cache.get(token)
+    if owner is None:
+        interactionSession = current_app.storage.get_interaction_session_owner(token)
+        if interactionSession is None:
+            return None
+        owner = (interactionSession['videoId'], interactionSession['userSession'])
+        cache.set(token, owner)
+    return owner
+
+def add_user_likes(userLikes):
+    """Writes newly stored likes through to cached entries: {(session_id, videoId): likes}."""
+    cache = current_app.user_likes_cache
+    for key, likes in userLikes.iteritems():
+        cache.update(key, lambda cached: (cached + likes)[-MAX_USER_POINTS:])
 
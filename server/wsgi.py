@@ -28,7 +28,7 @@ dotcloud_config = {
 }
 
 app = create_app(dotcloud_config)
-app.mongo = create_db(app)
+app.storage = create_db(app)
 
 @app.route("/")
 @crossdomain()